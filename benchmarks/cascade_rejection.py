@@ -0,0 +1,68 @@
+"""
+Check the header stage of the cascade (Pipeline cascade_lines) with the fuzzy validity check: an image whose top
+line is a short non-card text is rejected at the 'header' stage, an image whose top line is a card title goes on
+to the 'full' stage. VietOCR is replaced by a reader returning a fixed text for every region, so no model is loaded.
+
+> python -m benchmarks.cascade_rejection
+"""
+from unittest import mock
+import numpy as np
+from exe.pipeline import Pipeline
+from models.craft.detections import Detections
+
+# (text of the top line, field mode, expected stage, expected validity)
+CASES = (('Minh', False, 'header', False),
+         ('an', False, 'header', False),
+         ('Chúng tôi', False, 'header', False),
+         ('Minh', True, 'header', False),
+         ('Chúng tôi', True, 'header', False),
+         ('CĂN CƯỚC CÔNG DÂN', False, 'full', True))
+
+
+def cascade_pipeline(fields):
+    """
+    :param fields: field mode.
+    :return: a Pipeline with the cascade and the fuzzy validity check, without models (VietOCR must be replaced).
+    """
+    pipeline = Pipeline.__new__(Pipeline)
+    pipeline.fields = fields
+    pipeline.cascade_lines = 5
+    pipeline.fuzzy_valid = True
+    pipeline.save_crops = False
+    pipeline.result_path = None
+    pipeline.ocr_config = {}
+    pipeline.recognizer = None
+    pipeline.ocr_batch_size = 16
+    pipeline.ocr_bucket_width = 10
+    pipeline.ocr_memo = None
+    return pipeline
+
+
+def run_case(text, fields):
+    """
+    :param text: text VietOCR reads on every region.
+    :param fields: field mode.
+    :return: Result of a card with a single text region, in its header zone.
+    """
+    image = np.full((540, 856, 3), 255, dtype=np.uint8)
+    detections = Detections([[[300, 10], [800, 10], [800, 50], [300, 50]]], [0.9])
+
+    def read_texts(imgs, *args, **kwargs):
+        return [text] * len(imgs)
+
+    with mock.patch('exe.ocr_from_text_regions.read_texts', read_texts), \
+            mock.patch('exe.field_extraction.read_texts', read_texts):
+        return cascade_pipeline(fields)._recognize_once(image, 'card.jpg', detections)
+
+
+if __name__ == '__main__':
+    failed = 0
+    for text, fields, stage, is_valid in CASES:
+        result = run_case(text, fields)
+        ok = result.stage == stage and result.is_valid == is_valid
+        failed += not ok
+        print('{!r} (fields {}): stage {}, valid {}{}'.format(text, fields, result.stage, result.is_valid,
+                                                             '' if ok else ' MISMATCH'))
+    if failed:
+        raise SystemExit('{} cascade cases do not match'.format(failed))
+    print('All {} cascade cases match'.format(len(CASES)))
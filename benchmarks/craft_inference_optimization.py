@@ -0,0 +1,73 @@
+"""
+Check that the inference optimization of CRAFT and the refiner (optimize_for_inference() in
+exe/craft_text_regions_coordinates.py: BatchNorm folding, channels_last weights, inference_mode) gives the
+same score maps as the models as loaded, and report the forward time per image of both.
+
+> python -m benchmarks.craft_inference_optimization --images data
+"""
+import argparse
+import copy
+import os
+import time
+import numpy as np
+import torch
+from exe.craft_text_regions_coordinates import load_craft_models, optimize_for_inference
+from exe.precision import calibration_input
+from models.craft import imgproc
+
+ACCEPTED_FORMATS = (".jpg", ".jpeg", ".jp2", ".png", ".bmp", ".tiff", ".tif")
+
+
+def forward(net, refine_net, x, grad_mode):
+    """
+    :param grad_mode: context manager disabling the gradients (torch.no_grad or torch.inference_mode).
+    :return: score map (H x W x 2: text score, refined link), forward time (in seconds).
+    """
+    with grad_mode():
+        t = time.time()
+        y, feature = net(x)
+        if refine_net is not None:
+            y = torch.cat([y[..., :1], refine_net(y, feature)[..., :1]], dim=-1)
+        return y[0].numpy(), time.time() - t
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("CRAFT inference optimization check")
+    parser.add_argument("--images", default="data", help="Path to the folder of images")
+    parser.add_argument("--max-images", type=int, default=8, help="Maximum number of images")
+    parser.add_argument("--weights", default="weights/craft", help="Path to the CRAFT weight files")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timed passes per image")
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="Maximum score difference")
+    args = parser.parse_args()
+
+    paths = sorted(os.path.join(args.images, name) for name in os.listdir(args.images)
+                   if os.path.splitext(name)[1].lower() in ACCEPTED_FORMATS)[:args.max_images]
+    if not paths:
+        raise SystemExit('No image in {}'.format(args.images))
+    inputs = [calibration_input(imgproc.loadImage(path)) for path in paths]
+
+    net, refine_net = load_craft_models(args.weights, optimize=False)
+    optimized_net = optimize_for_inference(copy.deepcopy(net))
+    optimized_refine_net = optimize_for_inference(copy.deepcopy(refine_net)) if refine_net is not None else None
+
+    # warm-up, so the first timed pass does not pay for the allocations
+    forward(net, refine_net, inputs[0], torch.no_grad)
+    forward(optimized_net, optimized_refine_net, inputs[0], torch.inference_mode)
+
+    times, optimized_times, max_diff = [], [], 0.0
+    for x in inputs:
+        for _ in range(args.repeats):
+            scores, t = forward(net, refine_net, x, torch.no_grad)
+            optimized_scores, optimized_t = forward(optimized_net, optimized_refine_net, x, torch.inference_mode)
+            times.append(t)
+            optimized_times.append(optimized_t)
+        max_diff = max(max_diff, float(np.abs(scores - optimized_scores).max()))
+
+    print('{} images, {} repeats'.format(len(inputs), args.repeats))
+    print('as loaded: p50 {:.3f}s, mean {:.3f}s per image'.format(np.median(times), np.mean(times)))
+    print('optimized: p50 {:.3f}s, mean {:.3f}s per image ({:.1%} saved)'.
+          format(np.median(optimized_times), np.mean(optimized_times), 1 - np.mean(optimized_times) / np.mean(times)))
+    print('max score difference {:.2e}'.format(max_diff))
+    if max_diff > args.tolerance:
+        raise SystemExit('The optimized models do not match the models as loaded')
+    print('The optimized models match the models as loaded')
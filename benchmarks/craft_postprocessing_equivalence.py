@@ -0,0 +1,392 @@
+"""
+Check that the optimized CRAFT post-processing in models/craft/craft_utils.py (getDetBoxes_core, getPoly_core)
+gives the same boxes and polygons as the original (reference) implementation, on recorded or synthetic score maps.
+
+Record score maps from a folder of images (needs the CRAFT weights):
+> python -m benchmarks.craft_postprocessing_equivalence --record data --maps result/score_maps
+
+Compare on recorded score maps (or on synthetic ones, without --maps):
+> python -m benchmarks.craft_postprocessing_equivalence --maps result/score_maps
+"""
+import argparse
+import math
+import os
+import time
+import cv2
+import numpy as np
+from models.craft import craft_utils
+from models.craft.craft_utils import warpCoord
+
+""" reference implementation (original code) """
+
+
+def reference_getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text):
+    # prepare data
+    linkmap = linkmap.copy()
+    textmap = textmap.copy()
+    img_h, img_w = textmap.shape
+
+    """ labeling method """
+    ret, text_score = cv2.threshold(textmap, low_text, 1, 0)
+    ret, link_score = cv2.threshold(linkmap, link_threshold, 1, 0)
+
+    text_score_comb = np.clip(text_score + link_score, 0, 1)
+    nLabels, labels, stats, centroids = cv2.connectedComponentsWithStats(text_score_comb.astype(np.uint8),
+                                                                         connectivity=4)
+
+    det = []
+    det_scores = []
+    mapper = []
+    for k in range(1, nLabels):
+        # size filtering
+        size = stats[k, cv2.CC_STAT_AREA]
+        if size < 10: continue
+
+        # thresholding
+        if np.max(textmap[labels == k]) < text_threshold: continue
+
+        # make segmentation map
+        segmap = np.zeros(textmap.shape, dtype=np.uint8)
+        segmap[labels == k] = 255
+        segmap[np.logical_and(link_score == 1, text_score == 0)] = 0  # remove link area
+        x, y = stats[k, cv2.CC_STAT_LEFT], stats[k, cv2.CC_STAT_TOP]
+        w, h = stats[k, cv2.CC_STAT_WIDTH], stats[k, cv2.CC_STAT_HEIGHT]
+        niter = int(math.sqrt(size * min(w, h) / (w * h)) * 2)
+        sx, ex, sy, ey = x - niter, x + w + niter + 1, y - niter, y + h + niter + 1
+        # boundary check
+        if sx < 0: sx = 0
+        if sy < 0: sy = 0
+        if ex >= img_w: ex = img_w
+        if ey >= img_h: ey = img_h
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1 + niter, 1 + niter))
+        segmap[sy:ey, sx:ex] = cv2.dilate(segmap[sy:ey, sx:ex], kernel)
+
+        # make box
+        np_contours = np.roll(np.array(np.where(segmap != 0)), 1, axis=0).transpose().reshape(-1, 2)
+        rectangle = cv2.minAreaRect(np_contours)
+        box = cv2.boxPoints(rectangle)
+
+        # align diamond-shape
+        w, h = np.linalg.norm(box[0] - box[1]), np.linalg.norm(box[1] - box[2])
+        box_ratio = max(w, h) / (min(w, h) + 1e-5)
+        if abs(1 - box_ratio) <= 0.1:
+            l, r = min(np_contours[:, 0]), max(np_contours[:, 0])
+            t, b = min(np_contours[:, 1]), max(np_contours[:, 1])
+            box = np.array([[l, t], [r, t], [r, b], [l, b]], dtype=np.float32)
+
+        # make clock-wise order
+        startidx = box.sum(axis=1).argmin()
+        box = np.roll(box, 4 - startidx, 0)
+        box = np.array(box)
+
+        det.append(box)
+        mapper.append(k)
+        det_scores.append(np.max(textmap[labels == k]))
+
+    return det, labels, mapper, det_scores
+
+
+
+def reference_getPoly_core(boxes, labels, mapper, linkmap):
+    # configs
+    num_cp = 5
+    max_len_ratio = 0.7
+    expand_ratio = 1.45
+    max_r = 2.0
+    step_r = 0.2
+
+    polys = []
+    for k, box in enumerate(boxes):
+        # size filter for small instance
+        w, h = int(np.linalg.norm(box[0] - box[1]) + 1), int(np.linalg.norm(box[1] - box[2]) + 1)
+        if w < 10 or h < 10:
+            polys.append(None);
+            continue
+
+        # warp image
+        tar = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+        M = cv2.getPerspectiveTransform(box, tar)
+        word_label = cv2.warpPerspective(labels, M, (w, h), flags=cv2.INTER_NEAREST)
+        try:
+            Minv = np.linalg.inv(M)
+        except:
+            polys.append(None);
+            continue
+
+        # binarization for selected label
+        cur_label = mapper[k]
+        word_label[word_label != cur_label] = 0
+        word_label[word_label > 0] = 1
+
+        """ Polygon generation """
+        # find top/bottom contours
+        cp = []
+        max_len = -1
+        for i in range(w):
+            region = np.where(word_label[:, i] != 0)[0]
+            if len(region) < 2: continue
+            cp.append((i, region[0], region[-1]))
+            length = region[-1] - region[0] + 1
+            if length > max_len: max_len = length
+
+        # pass if max_len is similar to h
+        if h * max_len_ratio < max_len:
+            polys.append(None);
+            continue
+
+        # get pivot points with fixed length
+        tot_seg = num_cp * 2 + 1
+        seg_w = w / tot_seg  # segment width
+        pp = [None] * num_cp  # init pivot points
+        cp_section = [[0, 0]] * tot_seg
+        seg_height = [0] * num_cp
+        seg_num = 0
+        num_sec = 0
+        prev_h = -1
+        for i in range(0, len(cp)):
+            (x, sy, ey) = cp[i]
+            if (seg_num + 1) * seg_w <= x and seg_num <= tot_seg:
+                # average previous segment
+                if num_sec == 0: break
+                cp_section[seg_num] = [cp_section[seg_num][0] / num_sec, cp_section[seg_num][1] / num_sec]
+                num_sec = 0
+
+                # reset variables
+                seg_num += 1
+                prev_h = -1
+
+            # accumulate center points
+            cy = (sy + ey) * 0.5
+            cur_h = ey - sy + 1
+            cp_section[seg_num] = [cp_section[seg_num][0] + x, cp_section[seg_num][1] + cy]
+            num_sec += 1
+
+            if seg_num % 2 == 0: continue  # No polygon area
+
+            if prev_h < cur_h:
+                pp[int((seg_num - 1) / 2)] = (x, cy)
+                seg_height[int((seg_num - 1) / 2)] = cur_h
+                prev_h = cur_h
+
+        # processing last segment
+        if num_sec != 0:
+            cp_section[-1] = [cp_section[-1][0] / num_sec, cp_section[-1][1] / num_sec]
+
+        # pass if num of pivots is not sufficient or segment widh is smaller than character height 
+        if None in pp or seg_w < np.max(seg_height) * 0.25:
+            polys.append(None);
+            continue
+
+        # calc median maximum of pivot points
+        half_char_h = np.median(seg_height) * expand_ratio / 2
+
+        # calc gradiant and apply to make horizontal pivots
+        new_pp = []
+        for i, (x, cy) in enumerate(pp):
+            dx = cp_section[i * 2 + 2][0] - cp_section[i * 2][0]
+            dy = cp_section[i * 2 + 2][1] - cp_section[i * 2][1]
+            if dx == 0:  # gradient if zero
+                new_pp.append([x, cy - half_char_h, x, cy + half_char_h])
+                continue
+            rad = - math.atan2(dy, dx)
+            c, s = half_char_h * math.cos(rad), half_char_h * math.sin(rad)
+            new_pp.append([x - s, cy - c, x + s, cy + c])
+
+        # get edge points to cover character heatmaps
+        isSppFound, isEppFound = False, False
+        grad_s = (pp[1][1] - pp[0][1]) / (pp[1][0] - pp[0][0]) + (pp[2][1] - pp[1][1]) / (pp[2][0] - pp[1][0])
+        grad_e = (pp[-2][1] - pp[-1][1]) / (pp[-2][0] - pp[-1][0]) + (pp[-3][1] - pp[-2][1]) / (pp[-3][0] - pp[-2][0])
+        for r in np.arange(0.5, max_r, step_r):
+            dx = 2 * half_char_h * r
+            if not isSppFound:
+                line_img = np.zeros(word_label.shape, dtype=np.uint8)
+                dy = grad_s * dx
+                p = np.array(new_pp[0]) - np.array([dx, dy, dx, dy])
+                cv2.line(line_img, (int(p[0]), int(p[1])), (int(p[2]), int(p[3])), 1, thickness=1)
+                if np.sum(np.logical_and(word_label, line_img)) == 0 or r + 2 * step_r >= max_r:
+                    spp = p
+                    isSppFound = True
+            if not isEppFound:
+                line_img = np.zeros(word_label.shape, dtype=np.uint8)
+                dy = grad_e * dx
+                p = np.array(new_pp[-1]) + np.array([dx, dy, dx, dy])
+                cv2.line(line_img, (int(p[0]), int(p[1])), (int(p[2]), int(p[3])), 1, thickness=1)
+                if np.sum(np.logical_and(word_label, line_img)) == 0 or r + 2 * step_r >= max_r:
+                    epp = p
+                    isEppFound = True
+            if isSppFound and isEppFound:
+                break
+
+        # pass if boundary of polygon is not found
+        if not (isSppFound and isEppFound):
+            polys.append(None);
+            continue
+
+        # make final polygon
+        poly = []
+        poly.append(warpCoord(Minv, (spp[0], spp[1])))
+        for p in new_pp:
+            poly.append(warpCoord(Minv, (p[0], p[1])))
+        poly.append(warpCoord(Minv, (epp[0], epp[1])))
+        poly.append(warpCoord(Minv, (epp[2], epp[3])))
+        for p in reversed(new_pp):
+            poly.append(warpCoord(Minv, (p[2], p[3])))
+        poly.append(warpCoord(Minv, (spp[2], spp[3])))
+
+        # add to final result
+        polys.append(np.array(poly))
+
+    return polys
+
+
+""" end of reference implementation """
+
+
+def record_score_maps(image_folder, maps_path):
+    """
+    Run CRAFT (and the refiner) on every image of a folder and save the raw score maps.
+    :param image_folder: path to a folder of images.
+    :param maps_path: path to the output folder, one .npz file (textmap, linkmap) per image.
+    """
+    import torch
+    from exe.craft_text_regions_coordinates import craft_constants, load_craft_models
+    from models.craft import imgproc
+
+    (text_threshold, low_text, link_threshold,
+     cuda, canvas_size, mag_ratio, poly,
+     show_time, refine, trained_model, pretrained_weight_url, refiner_model, refiner_weight_url) = craft_constants()
+    net, refine_net = load_craft_models()
+
+    if not os.path.isdir(maps_path):
+        os.makedirs(maps_path)
+
+    for image_file in sorted(os.listdir(image_folder)):
+        image = imgproc.loadImage(os.path.join(image_folder, image_file))
+        img_resized, target_ratio, size_heatmap = imgproc.resize_aspect_ratio(image, canvas_size,
+                                                                              interpolation=cv2.INTER_LINEAR,
+                                                                              mag_ratio=mag_ratio)
+        x = torch.from_numpy(imgproc.normalizeMeanVariance(img_resized)).permute(2, 0, 1).unsqueeze(0)
+        with torch.no_grad():
+            y, feature = net(x)
+            textmap = y[0, :, :, 0].numpy()
+            linkmap = y[0, :, :, 1].numpy()
+            if refine_net is not None:
+                linkmap = refine_net(y, feature)[0, :, :, 0].numpy()
+        np.savez_compressed(os.path.join(maps_path, os.path.splitext(image_file)[0] + '.npz'),
+                            textmap=textmap, linkmap=linkmap)
+        print('Recorded score maps of {}'.format(image_file))
+
+
+def synthetic_score_maps(num_maps, seed=0):
+    """
+    :param num_maps: number of score map pairs to generate.
+    :param seed: random seed.
+    :return: list of (name, textmap, linkmap) with text-line like blobs of characters.
+    """
+    rng = np.random.default_rng(seed)
+    maps = []
+    for num in range(num_maps):
+        h, w = 416, 640
+        textmap = np.zeros((h, w), np.float32)
+        linkmap = np.zeros((h, w), np.float32)
+        for line in range(rng.integers(5, 25)):
+            cy, x = rng.integers(10, h - 10), rng.integers(0, w // 2)
+            char_h = rng.integers(4, 14)
+            # some lines are curved, so that the refined polygons differ from the boxes
+            amplitude = rng.choice([0, rng.uniform(1, 3) * char_h])
+            for char in range(rng.integers(1, 20)):
+                cx = x + char * char_h
+                if cx >= w:
+                    break
+                y = cy + amplitude * math.sin(char / 3)
+                next_y = cy + amplitude * math.sin((char + 1) / 3)
+                cv2.circle(textmap, (int(cx), int(y)), int(char_h // 2), float(rng.uniform(0.3, 1.0)), -1)
+                cv2.line(linkmap, (int(cx), int(y)), (int(cx + char_h), int(next_y)), float(rng.uniform(0.2, 0.9)),
+                         int(max(1, char_h // 3)))
+        textmap = cv2.GaussianBlur(textmap, (5, 5), 0)
+        linkmap = cv2.GaussianBlur(linkmap, (5, 5), 0)
+        maps.append(('synthetic_{}'.format(num), textmap, linkmap))
+    return maps
+
+
+def load_score_maps(maps_path):
+    """
+    :param maps_path: path to a folder of .npz files from record_score_maps.
+    :return: list of (name, textmap, linkmap).
+    """
+    maps = []
+    for map_file in sorted(os.listdir(maps_path)):
+        if map_file.endswith('.npz'):
+            data = np.load(os.path.join(maps_path, map_file))
+            maps.append((map_file, data['textmap'], data['linkmap']))
+    return maps
+
+
+def same_boxes(boxes, reference_boxes):
+    """
+    :return: True if both lists hold the same boxes, in the same order.
+    """
+    return len(boxes) == len(reference_boxes) and all(np.array_equal(box, reference_box)
+                                                      for box, reference_box in zip(boxes, reference_boxes))
+
+
+def same_polys(polys, reference_polys):
+    """
+    :return: True if both lists hold the same polygons (or None), in the same order.
+    """
+    return len(polys) == len(reference_polys) and all(
+        (poly is None and reference_poly is None)
+        or (poly is not None and reference_poly is not None and np.array_equal(poly, reference_poly))
+        for poly, reference_poly in zip(polys, reference_polys))
+
+
+def compare(maps, text_threshold=0.7, link_threshold=0.4, low_text=0.4):
+    """
+    :param maps: list of (name, textmap, linkmap).
+    :return: True if the optimized post-processing matches the reference on every map.
+    """
+    all_equal = True
+    for name, textmap, linkmap in maps:
+        t = time.time()
+        ref_det, ref_labels, ref_mapper, ref_scores = reference_getDetBoxes_core(textmap, linkmap, text_threshold,
+                                                                                 link_threshold, low_text)
+        t_ref = time.time() - t
+
+        t = time.time()
+        det, labels, mapper, det_scores = craft_utils.getDetBoxes_core(textmap, linkmap, text_threshold,
+                                                                       link_threshold, low_text)
+        t_new = time.time() - t
+
+        t = time.time()
+        ref_polys = reference_getPoly_core(ref_det, ref_labels, ref_mapper, linkmap)
+        t_ref_poly = time.time() - t
+
+        t = time.time()
+        polys = craft_utils.getPoly_core(det, labels, mapper, linkmap)
+        t_new_poly = time.time() - t
+
+        equal = (same_boxes(det, ref_det) and mapper == ref_mapper
+                 and np.array_equal(np.array(det_scores), np.array(ref_scores))
+                 and same_polys(polys, ref_polys))
+
+        all_equal = all_equal and equal
+        print('{}: {} boxes, {} polygons, getDetBoxes_core {:.4f}s -> {:.4f}s, getPoly_core {:.4f}s -> {:.4f}s, {}'.
+              format(name, len(ref_det), sum(poly is not None for poly in ref_polys), t_ref, t_new,
+                     t_ref_poly, t_new_poly, 'OK' if equal else 'MISMATCH'))
+    return all_equal
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("CRAFT post-processing equivalence check")
+    parser.add_argument("--maps", default=None, help="Path to a folder of recorded score maps (.npz)")
+    parser.add_argument("--record", default=None, help="Path to a folder of images to record score maps from")
+    parser.add_argument("--synthetic", type=int, default=20, help="Number of synthetic score maps if --maps is not set")
+    args = parser.parse_args()
+
+    if args.record:
+        record_score_maps(args.record, args.maps or 'result/score_maps')
+    else:
+        score_maps = load_score_maps(args.maps) if args.maps else synthetic_score_maps(args.synthetic)
+        if not compare(score_maps):
+            raise SystemExit('Optimized post-processing does not match the reference implementation')
+        print('All {} score maps match'.format(len(score_maps)))
@@ -0,0 +1,103 @@
+"""
+Compare the detector backends of exe/detector_backends.py with the eager CRAFT and RefineNet on a folder of
+extracted-card images: per-image latency of test_net(), and equivalence of the score maps (text score and
+refined link) and of the detected boxes.
+
+> python -m benchmarks.detector_backends --images data --backends torchscript onnxruntime
+"""
+import argparse
+import os
+import time
+import numpy as np
+import torch
+from exe.craft_text_regions_coordinates import load_craft_models, craft_constants
+from exe.detector_backends import DETECTOR_BACKENDS, RefinedCraft, load_detector
+from exe.precision import calibration_input
+from models.craft import imgproc, test
+
+ACCEPTED_FORMATS = (".jpg", ".jpeg", ".jp2", ".png", ".bmp", ".tiff", ".tif")
+
+
+def run(net, refine_net, images, repeats=3):
+    """
+    :return: list of the boxes of every image, list of the test_net() latencies (in seconds).
+    """
+    (text_threshold, low_text, link_threshold,
+     cuda, canvas_size, mag_ratio, poly,
+     show_time, refine, trained_model, pretrained_weight_url, refiner_model, refiner_weight_url) = craft_constants()
+
+    all_boxes = []
+    latencies = []
+    # warm-up, so the first timed pass does not pay for the allocations
+    test.test_net(net, images[0], text_threshold, link_threshold, low_text, cuda, poly, canvas_size, mag_ratio,
+                  False, refine_net, render=False)
+    for image in images:
+        for _ in range(repeats):
+            t = time.time()
+            boxes, polys, ret_score_text, det_scores = test.test_net(net, image, text_threshold, link_threshold,
+                                                                     low_text, cuda, poly, canvas_size, mag_ratio,
+                                                                     False, refine_net, render=False)
+            latencies.append(time.time() - t)
+        all_boxes.append(np.array(boxes, dtype=np.float32).reshape(-1, 4, 2))
+    return all_boxes, latencies
+
+
+def score_maps(net, images):
+    """
+    :param net: RefinedCraft, or the net of an exported backend.
+    :return: list of the score maps (H x W x 2: text score, refined link) of every image.
+    """
+    maps = []
+    with torch.no_grad():
+        for image in images:
+            y = net(calibration_input(image))
+            if isinstance(y, tuple):
+                y = y[0]
+            maps.append(y[0].numpy())
+    return maps
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Detector backends benchmark")
+    parser.add_argument("--images", default="data", help="Path to the folder of images")
+    parser.add_argument("--max-images", type=int, default=8, help="Maximum number of images")
+    parser.add_argument("--weights", default="weights/craft", help="Path to the CRAFT weight files")
+    parser.add_argument("--backends", nargs="+", choices=DETECTOR_BACKENDS[1:], default=list(DETECTOR_BACKENDS[1:]))
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timed passes per image")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="Maximum score difference with eager CRAFT")
+    args = parser.parse_args()
+
+    paths = sorted(os.path.join(args.images, name) for name in os.listdir(args.images)
+                   if os.path.splitext(name)[1].lower() in ACCEPTED_FORMATS)[:args.max_images]
+    if not paths:
+        raise SystemExit('No image in {}'.format(args.images))
+    images = [imgproc.loadImage(path) for path in paths]
+
+    net, refine_net = load_craft_models(args.weights)
+    eager_maps = score_maps(RefinedCraft(net, refine_net).eval(), images)
+    eager_boxes, eager_latencies = run(net, refine_net, images, args.repeats)
+    print('{} images, {} repeats'.format(len(images), args.repeats))
+    print('torch: p50 {:.3f}s, mean {:.3f}s per image'.format(np.median(eager_latencies), np.mean(eager_latencies)))
+
+    all_equivalent = True
+    for backend in args.backends:
+        backend_net, backend_refine_net = load_detector(net, refine_net, backend,
+                                                        os.path.join(args.weights, 'exported'))
+        if backend_refine_net is not None:
+            print('{}: not available'.format(backend))
+            continue
+        maps = score_maps(backend_net, images)
+        boxes, latencies = run(backend_net, backend_refine_net, images, args.repeats)
+
+        max_diff = max(float(np.abs(a - b).max()) for a, b in zip(eager_maps, maps))
+        same_boxes = sum(a.shape == b.shape and np.allclose(a, b, atol=1.0) for a, b in zip(eager_boxes, boxes))
+        equivalent = max_diff <= args.tolerance and same_boxes == len(images)
+        all_equivalent = all_equivalent and equivalent
+        print('{}: p50 {:.3f}s, mean {:.3f}s per image (x{:.2f}), max score difference {:.2e}, '
+              'same boxes on {}/{} images{}'.format(backend, np.median(latencies), np.mean(latencies),
+                                                    np.mean(eager_latencies) / np.mean(latencies), max_diff,
+                                                    same_boxes, len(images), '' if equivalent else ' MISMATCH'))
+
+    if not all_equivalent:
+        raise SystemExit('The detector backends do not match the eager models')
+    print('All backends match the eager models')
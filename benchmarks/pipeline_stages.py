@@ -0,0 +1,374 @@
+"""
+Offline benchmark of the pipeline stages on synthetic cards (benchmarks/synthetic_cards.py): image decoding,
+CRAFT forward pass (with the refiner), box extraction (getDetBoxes/getPoly), cropping, VietOCR and line sorting.
+Every stage reports its throughput, p50/p95 latency and peak memory as JSON, optionally compared with the report
+of an earlier run on the same machine. Save a report with --output, then pass it as --baseline to a later run:
+
+> python -m benchmarks.pipeline_stages --count 20 --output result/benchmark.json
+> python -m benchmarks.pipeline_stages --count 20 --baseline result/benchmark.json
+
+It runs without network access: CRAFT loads the weights of --weights and VietOCR the weights of --vietocr-weights
+when the files exist, and random weights otherwise (the timings stay meaningful, the texts do not). With a random
+CRAFT, the known text lines of the synthetic cards are cropped and read instead of the detected ones.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from vietocr.tool.config import Cfg
+from vietocr.tool.predictor import Predictor
+from vietocr.tool.translate import build_model
+from benchmarks.quantization_accuracy import character_error_rate
+from benchmarks.synthetic_cards import write_cards
+from exe.craft_text_regions_coordinates import craft_constants, load_craft_models, optimize_for_inference
+from exe.crop_text_regions import crop_regions
+from models.craft import imgproc, test
+from models.craft.craft import CRAFT
+from models.craft.detections import Detections
+from models.craft.refinenet import RefineNet
+from models.vietocr.utils import pred_text_batch
+from modules.process_output.ocr_processing import order_lines
+
+STAGES = ('decode', 'craft_forward', 'craft_postprocess', 'crop', 'vietocr', 'sort')
+
+# Version of the JSON report, bumped when its layout changes
+REPORT_VERSION = 1
+
+_VIETOCR_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vietocr_vgg_seq2seq.yml')
+
+
+def reset_peak_memory():
+    """
+    Reset the peak resident set size of the process (Linux only).
+    :return: True if the peak was reset, False if only the peak since the start of the process is available.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def memory_usage():
+    """
+    :return: current and peak resident set size of the process (in MB). The current size is None if unknown.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(status['VmRSS'].split()[0]) / 1024, int(status['VmHWM'].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        # ru_maxrss is in KB on Linux, in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return None, peak / (1024 * 1024 if platform.system() == 'Darwin' else 1024)
+
+
+def measure(stats, stage, function, *args):
+    """
+    Call function(*args), adding its latency and the peak memory of the process during the call to stats.
+    :param stats: dict stage -> {'latencies': [...], 'peaks': [...], 'increases': [...]}.
+    :param stage: one of STAGES.
+    :return: the output of function.
+    """
+    reset = reset_peak_memory()
+    before, _ = memory_usage()
+    t = time.perf_counter()
+    output = function(*args)
+    latency = time.perf_counter() - t
+    _, peak = memory_usage()
+
+    stage_stats = stats.setdefault(stage, {'latencies': [], 'peaks': [], 'increases': []})
+    stage_stats['latencies'].append(latency)
+    stage_stats['peaks'].append(peak)
+    if reset and before is not None:
+        stage_stats['increases'].append(max(0.0, peak - before))
+    return output
+
+
+def random_craft_models(seed=0):
+    """
+    :param seed: seed of the random weights.
+    :return: CRAFT net, RefineNet (None if the refiner is disabled) with random weights, prepared for inference.
+    """
+    refine = craft_constants()[8]
+    torch.manual_seed(seed)
+    net = optimize_for_inference(CRAFT())
+    refine_net = optimize_for_inference(RefineNet()) if refine else None
+    return net, refine_net
+
+
+def craft_weights_exist(weights_path):
+    """
+    :param weights_path: path to the folder of the CRAFT weight files.
+    :return: True if the weight files of CRAFT (and of the refiner if it is enabled) exist.
+    """
+    (text_threshold, low_text, link_threshold,
+     cuda, canvas_size, mag_ratio, poly,
+     show_time, refine, trained_model, pretrained_weight_url, refiner_model, refiner_weight_url) = craft_constants()
+    names = [trained_model, refiner_model] if refine else [trained_model]
+    return all(os.path.exists(os.path.join(weights_path, name)) for name in names)
+
+
+def vietocr_predictor(weights_path=None, config_path=_VIETOCR_CONFIG, seed=0):
+    """
+    :param weights_path: path to VietOCR weights, None (or a missing file) for random weights.
+    :param config_path: path to the VietOCR config (YAML).
+    :param seed: seed of the random weights.
+    :return: VietOCR config, VietOCR Predictor, True if the weights are the ones of weights_path.
+    """
+    config = Cfg.load_config_from_file(config_path)
+    config['device'] = 'cpu'
+    config['cnn']['pretrained'] = False
+
+    pretrained = weights_path is not None and os.path.exists(weights_path)
+    if pretrained:
+        config['weights'] = weights_path
+        return config, Predictor(config), True
+
+    with tempfile.TemporaryDirectory() as folder:
+        torch.manual_seed(seed)
+        model, vocab = build_model(config)
+        config['weights'] = os.path.join(folder, 'vietocr_random.pth')
+        torch.save(model.state_dict(), config['weights'])
+        return config, Predictor(config), False
+
+
+def craft_forward(net, refine_net, image):
+    """
+    The CRAFT part of test_net(): resize, normalize, forward pass and refiner.
+    :return: text score map, link score map, ratio of the image to the score maps.
+    """
+    (text_threshold, low_text, link_threshold,
+     cuda, canvas_size, mag_ratio, poly,
+     show_time, refine, trained_model, pretrained_weight_url, refiner_model, refiner_weight_url) = craft_constants()
+
+    img_resized, target_ratio, size_heatmap = imgproc.resize_aspect_ratio(image, canvas_size,
+                                                                          interpolation=cv2.INTER_LINEAR,
+                                                                          mag_ratio=mag_ratio)
+    x = torch.from_numpy(imgproc.normalizeMeanVariance(img_resized)).permute(2, 0, 1).unsqueeze(0)
+    with torch.inference_mode():
+        y, feature = net(x)
+        score_text = y[0, :, :, 0].numpy()
+        score_link = y[0, :, :, 1].numpy()
+        if refine_net is not None:
+            score_link = refine_net(y, feature)[0, :, :, 0].numpy()
+    return score_text, score_link, 1 / target_ratio
+
+
+def craft_postprocess(score_text, score_link, ratio, refined):
+    """
+    The box extraction part of test_net() (getDetBoxes, and getPoly with the refiner, as detect_text_regions()).
+    :return: Detections.
+    """
+    (text_threshold, low_text, link_threshold,
+     cuda, canvas_size, mag_ratio, poly,
+     show_time, refine, trained_model, pretrained_weight_url, refiner_model, refiner_weight_url) = craft_constants()
+
+    boxes, polys, det_scores = test.postprocess(score_text, score_link, ratio, ratio, text_threshold, link_threshold,
+                                                low_text, poly or refined)
+    return Detections(boxes, det_scores)
+
+
+def read_regions(regions, config, detector, batch_size, bucket_width):
+    """
+    :param regions: list of (box, cropped text region) from crop_regions().
+    :return: list of the texts of the regions.
+    """
+    return pred_text_batch([Image.fromarray(cropped) for box, cropped in regions], config, detector, batch_size,
+                           bucket_width)
+
+
+def sort_lines(regions, texts):
+    """
+    :return: the texts of the regions, joined in reading order into lines.
+    """
+    return order_lines([box for box, cropped in regions], texts)
+
+
+def run_image(path, label, net, refine_net, config, detector, stats, known_regions=False, batch_size=16,
+              bucket_width=10):
+    """
+    Run every stage on one image.
+    :param path: path to the image.
+    :param label: list of (text, box) of the known text lines of the image.
+    :param known_regions: crop and read the known text lines instead of the detected text regions.
+    :param stats: dict collecting the measures of every stage (see measure()), None to measure nothing.
+    :return: number of text regions, straighten string.
+    """
+    if stats is None:
+        stats = {}
+    image = measure(stats, 'decode', imgproc.loadImage, path)
+    score_text, score_link, ratio = measure(stats, 'craft_forward', craft_forward, net, refine_net, image)
+    detections = measure(stats, 'craft_postprocess', craft_postprocess, score_text, score_link, ratio,
+                         refine_net is not None)
+    if known_regions:
+        detections = Detections([box for text, box in label], np.ones(len(label)))
+    regions = measure(stats, 'crop', crop_regions, image, detections)
+    texts = measure(stats, 'vietocr', read_regions, regions, config, detector, batch_size, bucket_width)
+    lines = measure(stats, 'sort', sort_lines, regions, texts)
+    return len(regions), ' '.join(lines)
+
+
+def summarize(stats, num_images, num_regions):
+    """
+    :param stats: dict of the measures of every stage (see measure()).
+    :param num_images: number of images.
+    :param num_regions: number of text regions cropped and read.
+    :return: dict stage -> summary (latencies in milliseconds, throughput in images per second, memory in MB),
+    with an 'end_to_end' entry for the whole run of an image.
+    """
+    summary = {}
+    for stage in STAGES:
+        latencies = np.array(stats[stage]['latencies'])
+        summary[stage] = {'calls': len(latencies),
+                          'total_s': float(latencies.sum()),
+                          'mean_ms': float(latencies.mean() * 1000),
+                          'p50_ms': float(np.percentile(latencies, 50) * 1000),
+                          'p95_ms': float(np.percentile(latencies, 95) * 1000),
+                          'images_per_s': float(num_images / latencies.sum()) if latencies.sum() else None,
+                          'peak_rss_mb': float(max(stats[stage]['peaks'])),
+                          'peak_increase_mb': float(max(stats[stage]['increases']))
+                          if stats[stage]['increases'] else None}
+        if stage in ('crop', 'vietocr', 'sort'):
+            summary[stage]['regions_per_s'] = float(num_regions / latencies.sum()) if latencies.sum() else None
+
+    totals = np.sum([stats[stage]['latencies'] for stage in STAGES], axis=0)
+    summary['end_to_end'] = {'calls': len(totals),
+                             'total_s': float(totals.sum()),
+                             'mean_ms': float(totals.mean() * 1000),
+                             'p50_ms': float(np.percentile(totals, 50) * 1000),
+                             'p95_ms': float(np.percentile(totals, 95) * 1000),
+                             'images_per_s': float(num_images / totals.sum()) if totals.sum() else None,
+                             'peak_rss_mb': float(max(max(stats[stage]['peaks']) for stage in STAGES))}
+    return summary
+
+
+def compare(report, baseline, max_regression=0.2, min_delta_ms=1.0):
+    """
+    :param report: report of this run.
+    :param baseline: report of a previous run.
+    :param max_regression: maximum relative increase of the p50 and p95 latencies of a stage.
+    :param min_delta_ms: increases below this many milliseconds are noise, never regressions.
+    :return: dict stage -> comparison, list of the regressed stages.
+    """
+    comparison, regressions = {}, []
+    for stage, current in report['stages'].items():
+        previous = baseline.get('stages', {}).get(stage)
+        if previous is None:
+            continue
+        comparison[stage] = {}
+        for key in ('p50_ms', 'p95_ms'):
+            ratio = current[key] / previous[key] if previous[key] else None
+            comparison[stage][key] = {'baseline': previous[key], 'current': current[key], 'ratio': ratio}
+            if ratio is not None and ratio > 1 + max_regression and current[key] - previous[key] > min_delta_ms:
+                if stage not in regressions:
+                    regressions.append(stage)
+    return comparison, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Pipeline stages benchmark")
+    parser.add_argument("--count", type=int, default=20, help="Number of synthetic cards")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic cards and of the random weights")
+    parser.add_argument("--font", default=None, help="Path to a TrueType font with Vietnamese glyphs")
+    parser.add_argument("--max-rotation", type=float, default=3.0, help="Maximum rotation of the cards (degrees)")
+    parser.add_argument("--noise", type=float, default=6.0, help="Standard deviation of the noise of the cards")
+    parser.add_argument("--weights", default="weights/craft", help="Path to the CRAFT weight files")
+    parser.add_argument("--vietocr-weights", default=None, help="Path to the VietOCR weight file")
+    parser.add_argument("--vietocr-config", default=_VIETOCR_CONFIG, help="Path to the VietOCR config (YAML)")
+    parser.add_argument("--ocr-batch-size", type=int, default=16, help="Maximum text regions per VietOCR pass")
+    parser.add_argument("--threads", type=int, default=None, help="Number of torch threads")
+    parser.add_argument("--output", default="result/benchmark.json", help="Path to the JSON report")
+    parser.add_argument("--baseline", default=None, help="Path to the JSON report of a previous run")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Maximum relative increase of a stage latency over the baseline")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    if craft_weights_exist(args.weights):
+        net, refine_net = load_craft_models(args.weights)
+        craft_pretrained = True
+    else:
+        print('No CRAFT weights in {}, using random weights'.format(args.weights))
+        net, refine_net = random_craft_models(args.seed)
+        craft_pretrained = False
+    config, detector, vietocr_pretrained = vietocr_predictor(args.vietocr_weights, args.vietocr_config, args.seed)
+    if not vietocr_pretrained:
+        print('No VietOCR weights, using random weights')
+
+    with tempfile.TemporaryDirectory() as folder:
+        paths, labels = write_cards(folder, args.count, args.seed, args.font, args.max_rotation, args.noise)
+
+        # warm-up, so the first measured image does not pay for the allocations
+        run_image(paths[0], labels[0], net, refine_net, config, detector, None, not craft_pretrained,
+                  args.ocr_batch_size)
+
+        stats = {}
+        num_regions = 0
+        references, predictions = [], []
+        t = time.perf_counter()
+        for path, label in zip(paths, labels):
+            regions, straighten = run_image(path, label, net, refine_net, config, detector, stats,
+                                            not craft_pretrained, args.ocr_batch_size)
+            num_regions += regions
+            references.append(' '.join(text for text, box in label))
+            predictions.append(straighten)
+        wall_time = time.perf_counter() - t
+
+    report = {'version': REPORT_VERSION,
+              'environment': {'python': platform.python_version(), 'torch': torch.__version__,
+                              'platform': platform.platform(), 'threads': torch.get_num_threads()},
+              'settings': {'count': args.count, 'seed': args.seed, 'max_rotation': args.max_rotation,
+                           'noise': args.noise, 'canvas_size': craft_constants()[4],
+                           'mag_ratio': craft_constants()[5], 'ocr_batch_size': args.ocr_batch_size,
+                           'craft_weights': 'pretrained' if craft_pretrained else 'random',
+                           'vietocr_weights': 'pretrained' if vietocr_pretrained else 'random',
+                           'regions': 'detected' if craft_pretrained else 'known'},
+              'images': args.count,
+              'regions': num_regions,
+              'wall_time_s': wall_time,
+              'stages': summarize(stats, args.count, num_regions)}
+    # the texts are only worth comparing with the known texts if both models are the pre-trained ones
+    if craft_pretrained and vietocr_pretrained:
+        report['cer'] = character_error_rate(references, predictions)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        different = [key for key, value in report['settings'].items() if baseline.get('settings', {}).get(key) != value]
+        if different:
+            print('The baseline was run with other settings: {}'.format(', '.join(different)))
+        report['baseline'] = args.baseline
+        report['comparison'], regressions = compare(report, baseline, args.max_regression)
+        report['regressions'] = regressions
+
+    output_folder = os.path.dirname(args.output)
+    if output_folder and not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    print('{} images, {} text regions, {:.2f}s'.format(args.count, num_regions, wall_time))
+    for stage, summary in report['stages'].items():
+        line = '{:<18} p50 {:8.1f}ms  p95 {:8.1f}ms  {:7.2f} images/s  peak {:7.1f}MB'.format(
+            stage, summary['p50_ms'], summary['p95_ms'], summary['images_per_s'] or 0, summary['peak_rss_mb'])
+        if stage in report.get('comparison', {}):
+            line += '  x{:.2f} p50 vs baseline'.format(report['comparison'][stage]['p50_ms']['ratio'] or 0)
+        print(line)
+    if 'cer' in report:
+        print('CER against the known texts: {:.4f}'.format(report['cer']))
+    print('Report saved at {}'.format(args.output))
+
+    if regressions:
+        raise SystemExit('Slower than the baseline: {}'.format(', '.join(regressions)))
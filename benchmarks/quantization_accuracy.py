@@ -0,0 +1,191 @@
+"""
+Compare the reduced-precision models of exe/precision.py with the float32 models on a fixture set of
+extracted-card images: detection precision and recall of CRAFT (boxes of the reduced-precision models
+matched to the float32 boxes by IoU) and character error rate (CER) of VietOCR (texts of the same crops,
+read by both recognizers), with the time of every model.
+
+> python -m benchmarks.quantization_accuracy --images data --ocr-precision int8 --craft-precision int8
+
+Without --images, the fixture set is --synthetic cards of benchmarks/synthetic_cards.py:
+> python -m benchmarks.quantization_accuracy --synthetic 20
+
+The int8 CRAFT is calibrated on --calibration-folder (the fixture images if it is not set) unless
+weights/craft/quantized already holds it.
+"""
+import argparse
+import os
+import time
+import numpy as np
+from PIL import Image
+from rapidfuzz.distance import Levenshtein
+from benchmarks.synthetic_cards import generate_cards
+from exe.craft_text_regions_coordinates import load_craft_models, detect_text_regions_batch
+from exe.crop_text_regions import crop_regions
+from exe.precision import OCR_PRECISIONS, CRAFT_PRECISIONS, quantize_recognizer, convert_craft
+from models.craft import imgproc
+from models.craft.detections import Detections
+from models.vietocr.utils import init_config, get_predictor, pred_text_batch
+
+ACCEPTED_FORMATS = (".jpg", ".jpeg", ".jp2", ".png", ".bmp", ".tiff", ".tif")
+
+
+def load_images(folder_path, max_images=None):
+    """
+    :param folder_path: path to a folder of extracted-card images.
+    :param max_images: maximum number of images to load (all if None).
+    :return: list of paths, list of images (RGB).
+    """
+    paths = sorted(os.path.join(folder_path, name) for name in os.listdir(folder_path)
+                   if os.path.splitext(name)[1].lower() in ACCEPTED_FORMATS)[:max_images]
+    return paths, [imgproc.loadImage(path) for path in paths]
+
+
+def synthetic_images(count, seed=0):
+    """
+    :param count: number of synthetic cards (see benchmarks/synthetic_cards.py).
+    :param seed: seed of the first card.
+    :return: list of names, list of images (RGB).
+    """
+    images = [image for template, image, lines in generate_cards(count, seed)]
+    return ['synthetic_{:05d}'.format(index) for index in range(count)], images
+
+
+def box_iou(box_a, box_b):
+    """
+    :param box_a: 4 x 2 array of corners.
+    :param box_b: 4 x 2 array of corners.
+    :return: IoU of the axis-aligned rectangles bounding the two boxes.
+    """
+    (ax0, ay0), (ax1, ay1) = box_a.min(axis=0), box_a.max(axis=0)
+    (bx0, by0), (bx1, by1) = box_b.min(axis=0), box_b.max(axis=0)
+    inter = max(0, min(ax1, bx1) - max(ax0, bx0)) * max(0, min(ay1, by1) - max(ay0, by0))
+    union = (ax1 - ax0) * (ay1 - ay0) + (bx1 - bx0) * (by1 - by0) - inter
+    return inter / union if union > 0 else 0
+
+
+def match_boxes(reference, predicted, iou_threshold=0.5):
+    """
+    Greedy one-to-one matching of the predicted boxes to the reference boxes, best IoU first.
+    :param reference: Detections of the float32 models.
+    :param predicted: Detections of the reduced-precision models.
+    :param iou_threshold: minimum IoU of a match.
+    :return: number of matched boxes.
+    """
+    pairs = sorted(((box_iou(ref_box, box), i, j) for i, ref_box in enumerate(reference.boxes)
+                    for j, box in enumerate(predicted.boxes)), reverse=True)
+    used_ref, used_pred = set(), set()
+    for iou, i, j in pairs:
+        if iou < iou_threshold:
+            break
+        if i not in used_ref and j not in used_pred:
+            used_ref.add(i)
+            used_pred.add(j)
+    return len(used_ref)
+
+
+def detection_scores(reference, predicted, iou_threshold=0.5):
+    """
+    :param reference: list of Detections of the float32 models (None if the detection failed).
+    :param predicted: list of Detections of the reduced-precision models (None if the detection failed).
+    :param iou_threshold: minimum IoU of a match.
+    :return: precision, recall of the predicted boxes over all images.
+    """
+    # a failed detection has no box
+    reference = [Detections() if ref is None else ref for ref in reference]
+    predicted = [Detections() if pred is None else pred for pred in predicted]
+    matched = sum(match_boxes(ref, pred, iou_threshold) for ref, pred in zip(reference, predicted))
+    num_ref = sum(len(ref) for ref in reference)
+    num_pred = sum(len(pred) for pred in predicted)
+    precision = matched / num_pred if num_pred else 1.0
+    recall = matched / num_ref if num_ref else 1.0
+    return precision, recall
+
+
+def character_error_rate(references, predictions):
+    """
+    :param references: texts read by the float32 recognizer.
+    :param predictions: texts read by the reduced-precision recognizer.
+    :return: total edit distance over the total length of the references.
+    """
+    distance = sum(Levenshtein.distance(ref, pred) for ref, pred in zip(references, predictions))
+    length = sum(len(ref) for ref in references)
+    return distance / length if length else float(distance > 0)
+
+
+def detect(images, paths, net, refine_net):
+    """
+    :return: list of Detections, time (in seconds).
+    """
+    t = time.time()
+    detections = detect_text_regions_batch(images, paths, net, refine_net, result_path=None, artifact_level='none')
+    return detections, time.time() - t
+
+
+def read(crops, config, detector):
+    """
+    :return: list of texts, time (in seconds).
+    """
+    t = time.time()
+    texts = pred_text_batch(crops, config, detector)
+    return texts, time.time() - t
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Accuracy of the reduced-precision models")
+    parser.add_argument("--images", default=None,
+                        help="Path to the folder of fixture images (synthetic cards if it is not set)")
+    parser.add_argument("--max-images", type=int, default=None, help="Maximum number of fixture images")
+    parser.add_argument("--synthetic", type=int, default=20, help="Number of synthetic cards if --images is not set")
+    parser.add_argument("--weights", default="weights/craft", help="Path to the CRAFT weight files")
+    parser.add_argument("--ocr-precision", choices=OCR_PRECISIONS, default="int8")
+    parser.add_argument("--craft-precision", choices=CRAFT_PRECISIONS, default="int8")
+    parser.add_argument("--calibration-folder", default=None,
+                        help="Folder of images calibrating the int8 CRAFT (the fixture images if it is not set)")
+    parser.add_argument("--max-cer", type=float, default=0.02, help="Maximum CER against the float32 recognizer")
+    parser.add_argument("--min-precision", type=float, default=0.95,
+                        help="Minimum detection precision (and recall) against the float32 CRAFT")
+    args = parser.parse_args()
+
+    if args.images:
+        paths, images = load_images(args.images, args.max_images)
+    else:
+        paths, images = synthetic_images(args.synthetic)
+    if not images:
+        raise SystemExit('No image in {}'.format(args.images))
+
+    net, refine_net = load_craft_models(args.weights)
+    calibration = images
+    if args.calibration_folder:
+        calibration = load_images(args.calibration_folder, 16)[1]
+    reduced_net, reduced_refine_net = convert_craft(net, refine_net, args.craft_precision, calibration,
+                                                    os.path.join(args.weights, 'quantized'))
+
+    config = init_config()
+    recognizer = get_predictor(config)
+    reduced_recognizer = quantize_recognizer(recognizer) if args.ocr_precision == 'int8' else recognizer
+
+    # warm-up, so the first timed pass does not pay for the allocations
+    detect(images[:1], paths[:1], net, refine_net)
+    detect(images[:1], paths[:1], reduced_net, reduced_refine_net)
+
+    float_detections, t_float_craft = detect(images, paths, net, refine_net)
+    detections, t_craft = detect(images, paths, reduced_net, reduced_refine_net)
+    precision, recall = detection_scores(float_detections, detections)
+
+    # both recognizers read the crops of the float32 detections, so only the recognizer differs
+    crops = [Image.fromarray(cropped) for image, found in zip(images, float_detections) if found is not None
+             for box, cropped in crop_regions(image, found)]
+    float_texts, t_float_ocr = read(crops, config, recognizer)
+    texts, t_ocr = read(crops, config, reduced_recognizer)
+    cer = character_error_rate(float_texts, texts)
+    exact = np.mean([ref == pred for ref, pred in zip(float_texts, texts)]) if crops else 1.0
+
+    print('{} images, {} text regions'.format(len(images), len(crops)))
+    print('CRAFT {}: {:.2f}s (float32 {:.2f}s), precision {:.4f}, recall {:.4f}'.
+          format(args.craft_precision, t_craft, t_float_craft, precision, recall))
+    print('VietOCR {}: {:.2f}s (float32 {:.2f}s), CER {:.4f}, exact texts {:.4f}'.
+          format(args.ocr_precision, t_ocr, t_float_ocr, cer, exact))
+
+    if cer > args.max_cer or min(precision, recall) < args.min_precision:
+        raise SystemExit('The reduced-precision models are below the accuracy thresholds')
+    print('Accuracy within the thresholds')
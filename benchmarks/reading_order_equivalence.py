@@ -0,0 +1,178 @@
+"""
+Check that the NumPy reading-order engine in modules/process_output/ocr_processing.py (sort_ocr_result,
+order_lines) gives the same sorted result as the original (reference) pandas implementation,
+on existing raw OCR results or on synthetic cards.
+
+Compare on the raw results of previous runs (RAW_RESULT_*.csv):
+> python -m benchmarks.reading_order_equivalence --results result/ocr_in_csv
+
+Compare on synthetic cards:
+> python -m benchmarks.reading_order_equivalence --synthetic 200
+"""
+import argparse
+import contextlib
+import glob
+import io
+import os
+import time
+import numpy as np
+import pandas as pd
+from modules.process_output import ocr_processing
+from modules.process_output.ocr_processing import split_img_name, boxes, order_lines
+
+""" reference implementation (original code) """
+
+
+def reference_add_to_data(data, bboxe):
+    pt1_x = []
+    pt1_y = []
+    pt2_x = []
+    pt2_y = []
+    pt3_x = []
+    pt3_y = []
+    pt4_x = []
+    pt4_y = []
+
+    for i in range(len(data)):
+        pt1_x.append(bboxe[i][0][0])
+        pt1_y.append(bboxe[i][0][1])
+        pt2_x.append(bboxe[i][1][0])
+        pt2_y.append(bboxe[i][1][1])
+        pt3_x.append(bboxe[i][2][0])
+        pt3_y.append(bboxe[i][2][1])
+        pt4_x.append(bboxe[i][3][0])
+        pt4_y.append(bboxe[i][3][1])
+
+    data.insert(1, 'pt1_x', pt1_x, True)
+    data.insert(2, 'pt1_y', pt1_y, True)
+    data.insert(3, 'pt2_x', pt2_x, True)
+    data.insert(4, 'pt2_y', pt2_y, True)
+    data.insert(5, 'pt3_x', pt3_x, True)
+    data.insert(6, 'pt3_y', pt3_y, True)
+    data.insert(7, 'pt4_y', pt4_x, True)
+    data.insert(8, 'pt4_y', pt4_y, True)
+    return data
+
+
+def reference_sorting_detail(new_data):
+    sorted_data = new_data.sort_values(by=['pt1_y'], ascending=True)
+    range_pt1_y = [0]
+
+    for i in range(len(sorted_data)):
+        try:
+            if (sorted_data.iloc[i + 1, 2] - 4) > sorted_data.iloc[i, 2]:
+                range_pt1_y.append(i + 1)
+        except IndexError:
+            range_pt1_y.append(i + 1)
+    text = []
+    img_name = []
+    for i in range(len(range_pt1_y)):
+        try:
+            text_1 = []
+            index1 = range_pt1_y[i]
+            index2 = range_pt1_y[i + 1]
+            print(f'Checkpoint1: {i}')
+            for j in range(len(sorted_data[index1:index2])):
+                sort_x = sorted_data[index1:index2].sort_values(by='pt1_x', ascending=True)
+                text_1.append(sort_x.iloc[j, 9])
+                print(f'Checkpoint2: {j}')
+                print(f'Checkpoint3: {sort_x.iloc[j, 9]}')
+
+            text.append(" ".join(text_1))
+            img_name.append(sorted_data.iloc[i, 0])
+        except IndexError:
+            print("Run success.")
+    sorted_data = pd.DataFrame(list(zip(img_name, text)),
+                               columns=['img_name', 'full_text'])
+
+    return sorted_data
+
+
+def reference_sort_ocr_result(raw):
+    bboxe = boxes(split_img_name(raw['text_region_file']))
+    new_data = reference_add_to_data(raw.copy(), bboxe=bboxe)
+    # the reference prints three checkpoint lines per region
+    with contextlib.redirect_stdout(io.StringIO()):
+        return reference_sorting_detail(new_data)
+
+
+""" test data """
+
+
+def load_raw_results(results_path):
+    """
+    :param results_path: path to a folder of RAW_RESULT_*.csv files.
+    :return: list of (name, raw result dataframe).
+    """
+    raw_results = []
+    for raw_path in sorted(glob.glob(os.path.join(results_path, 'RAW_RESULT_*.csv'))):
+        raw = pd.read_csv(raw_path, index_col=0, keep_default_na=False)[['text_region_file', 'predicted_word']]
+        raw_results.append((os.path.basename(raw_path), raw))
+    return raw_results
+
+
+def synthetic_raw_results(num_cards, seed=0):
+    """
+    Cards of 6 to 40 regions laid out in rows, with jittered heights (many ties and near-ties of the tops,
+    so the y-tolerance and the sort order of equal values are exercised).
+    :return: list of (name, raw result dataframe).
+    """
+    rng = np.random.RandomState(seed)
+    raw_results = []
+    for card in range(num_cards):
+        num_regions = rng.randint(6, 41)
+        rows = rng.randint(0, 12, num_regions)
+        y = rows * rng.randint(5, 40) + rng.randint(0, 9, num_regions)
+        x = rng.randint(0, 20, num_regions) * rng.choice([1, 40])
+        w = rng.randint(20, 200, num_regions)
+        h = rng.randint(12, 30, num_regions)
+        names = ['card{}_{}_{}_{}_{}_{}_{}_{}_{}.jpg'.format(card, x[i], y[i], x[i] + w[i], y[i], x[i] + w[i],
+                                                              y[i] + h[i], x[i], y[i] + h[i])
+                 for i in range(num_regions)]
+        words = ['w{}'.format(i) for i in range(num_regions)]
+        raw_results.append(('synthetic card {}'.format(card),
+                            pd.DataFrame({'text_region_file': names, 'predicted_word': words})))
+    return raw_results
+
+
+def compare(raw_results):
+    """
+    :param raw_results: list of (name, raw result dataframe).
+    :return: True if the new ordering matches the reference on every result.
+    """
+    all_equal = True
+    t_ref = t_new = t_lines = 0
+    for name, raw in raw_results:
+        t = time.time()
+        reference = reference_sort_ocr_result(raw)
+        t_ref += time.time() - t
+
+        t = time.time()
+        result = ocr_processing.sort_ocr_result(raw.copy())
+        t_new += time.time() - t
+
+        corners = np.array(boxes(split_img_name(raw['text_region_file'])), dtype=np.float32).reshape(-1, 4, 2)
+        t = time.time()
+        lines = order_lines(corners, list(raw['predicted_word']))
+        t_lines += time.time() - t
+
+        equal = reference.equals(result) and lines == list(reference['full_text'])
+        if not equal:
+            print('{}: MISMATCH'.format(name))
+        all_equal = all_equal and equal
+
+    print('{} results: reference {:.4f}s, sort_ocr_result {:.4f}s, order_lines {:.4f}s'.
+          format(len(raw_results), t_ref, t_new, t_lines))
+    return all_equal
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Reading-order equivalence check")
+    parser.add_argument("--results", default=None, help="Path to a folder of raw OCR results (RAW_RESULT_*.csv)")
+    parser.add_argument("--synthetic", type=int, default=200, help="Number of synthetic cards if --results is not set")
+    args = parser.parse_args()
+
+    raw_results = load_raw_results(args.results) if args.results else synthetic_raw_results(args.synthetic)
+    if not compare(raw_results):
+        raise SystemExit('Reading order does not match the reference implementation')
+    print('All {} results match'.format(len(raw_results)))
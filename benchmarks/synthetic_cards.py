@@ -0,0 +1,211 @@
+"""
+Synthetic extracted-card images for offline benchmarks: the fronts of TEMPLATES (modules/layout/field_zones.py)
+rendered with known texts and text boxes, then rotated and noised.
+
+Write 50 cards and their labels (labels.jsonl: file name, template and the text and box of every line):
+> python -m benchmarks.synthetic_cards --output data/synthetic --count 50
+
+The texts are rendered with --font (a TrueType font with Vietnamese glyphs, e.g. DejaVuSans.ttf). If no such font
+is found, the default bitmap font of Pillow renders the texts without accents.
+"""
+import argparse
+import json
+import os
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from exe.ocr_from_text_regions import remove_accents
+from modules.layout.field_zones import TEMPLATES
+
+# Width x height of a card (ID-1 format, 85.6 x 54 mm)
+CARD_SIZE = (856, 540)
+
+# Fonts with Vietnamese glyphs, looked for in the system font folders
+_FONT_CANDIDATES = ('DejaVuSans.ttf', 'NotoSans-Regular.ttf', 'LiberationSans-Regular.ttf', 'Arial.ttf',
+                    'arial.ttf')
+
+_SURNAMES = ('NGUYỄN', 'TRẦN', 'LÊ', 'PHẠM', 'HOÀNG', 'HUỲNH', 'PHAN', 'VŨ', 'VÕ', 'ĐẶNG', 'BÙI', 'ĐỖ')
+_MIDDLE_NAMES = ('VĂN', 'THỊ', 'HỮU', 'ĐỨC', 'MINH', 'NGỌC', 'THANH', 'QUANG')
+_GIVEN_NAMES = ('AN', 'BÌNH', 'CƯỜNG', 'DŨNG', 'GIANG', 'HIẾU', 'HƯƠNG', 'KHÁNH', 'LINH', 'NAM', 'PHƯƠNG', 'TÚ')
+
+_TITLES = {'cmnd': 'GIẤY CHỨNG MINH NHÂN DÂN', 'cccd': 'CĂN CƯỚC CÔNG DÂN'}
+_HEADER = 'CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM'
+_MOTTO = 'Độc lập - Tự do - Hạnh phúc'
+
+
+def load_font(font_path=None, size=40):
+    """
+    :param font_path: path to a TrueType font, None to look for a font with Vietnamese glyphs.
+    :param size: font size (in pixels).
+    :return: font, True if it has the Vietnamese glyphs (False for the default bitmap font).
+    """
+    if font_path is not None:
+        return ImageFont.truetype(font_path, size), True
+    for name in _FONT_CANDIDATES:
+        try:
+            return ImageFont.truetype(name, size), True
+        except OSError:
+            continue
+    return ImageFont.load_default(), False
+
+
+def card_texts(template, rng):
+    """
+    :param template: name of one of TEMPLATES.
+    :param rng: numpy Generator.
+    :return: dict field name -> list of the text lines of the field.
+    """
+    number_length = 12 if template == 'cccd' else 9
+    number = ''.join(str(digit) for digit in rng.integers(0, 10, number_length))
+    name = ' '.join((rng.choice(_SURNAMES), rng.choice(_MIDDLE_NAMES), rng.choice(_GIVEN_NAMES)))
+    birth = '{:02d}/{:02d}/{}'.format(rng.integers(1, 29), rng.integers(1, 13), rng.integers(1950, 2006))
+    return {'header': [_HEADER, _MOTTO],
+            'title': [_TITLES[template]],
+            'id_number': ['Số: {}'.format(number)],
+            'name': ['Họ và tên: {}'.format(name)],
+            'date_of_birth': ['Ngày sinh: {}'.format(birth)]}
+
+
+def render_line(text, font, height):
+    """
+    :param text: text of the line.
+    :param font: font of load_font().
+    :param height: height (in pixels) of the rendered line.
+    :return: H x W float32 ink mask of the line, in [0, 1].
+    """
+    left, top, right, bottom = font.getbbox(text)
+    mask = Image.new('L', (right - left + 2, bottom - top + 2), 0)
+    ImageDraw.Draw(mask).text((1 - left, 1 - top), text, fill=255, font=font)
+    width = max(1, int(round(mask.width * height / mask.height)))
+    return cv2.resize(np.asarray(mask, dtype=np.float32) / 255, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def render_card(template='cccd', seed=0, font=None, vietnamese=True, max_rotation=3.0, noise=6.0, blur=True):
+    """
+    Render the front of a card: a textured background, a photo placeholder and the text lines of every field
+    placed in the zones of the template.
+    :param template: name of one of TEMPLATES.
+    :param seed: seed of the texts, the colors, the rotation and the noise.
+    :param font: font of load_font() (load_font() if it is None).
+    :param vietnamese: the font has the Vietnamese glyphs, else the texts are rendered without accents.
+    :param max_rotation: maximum rotation of the card (in degrees, either way).
+    :param noise: standard deviation of the Gaussian noise (in gray levels).
+    :param blur: blur the card slightly, as a camera would.
+    :return: card image (RGB), list of (text, 4 x 2 float32 array of the text-line corners).
+    """
+    if template not in TEMPLATES:
+        raise ValueError('template must be one of {}, got {}'.format(tuple(TEMPLATES), template))
+    if font is None:
+        font, vietnamese = load_font()
+    rng = np.random.default_rng(seed)
+    width, height = CARD_SIZE
+
+    # pale background with a smooth color gradient
+    base = rng.uniform(200, 245, 3)
+    gradient = np.linspace(-12, 12, width, dtype=np.float32)[None, :, None]
+    card = np.clip(np.broadcast_to(base, (height, width, 3)) + gradient * rng.uniform(-1, 1, 3), 0, 255)
+    card = card.astype(np.float32)
+
+    # photo placeholder on the left
+    x0, y0, x1, y1 = int(0.03 * width), int(0.35 * height), int(0.22 * width), int(0.8 * height)
+    card[y0:y1, x0:x1] = rng.uniform(90, 160, 3)
+
+    lines = []
+    zones = TEMPLATES[template]['zones']
+    ink = rng.uniform(0, 60, 3)
+    for field, texts in card_texts(template, rng).items():
+        zx0, zy0, zx1, zy1 = zones[field]
+        zone_width = (zx1 - zx0) * width
+        line_height = (zy1 - zy0) * height / len(texts)
+        for index, text in enumerate(texts):
+            if not vietnamese:
+                text = remove_accents(text)
+            text_height = int(min(line_height * 0.6, 0.045 * height))
+            mask = render_line(text, font, text_height)
+            if mask.shape[1] > zone_width * 0.95:
+                mask = cv2.resize(mask, (int(zone_width * 0.95), text_height), interpolation=cv2.INTER_AREA)
+            # the header lines are centered, the other fields are left-aligned after a margin
+            if field == 'header':
+                x = int(zx0 * width + (zone_width - mask.shape[1]) / 2)
+            else:
+                x = int(zx0 * width + 0.02 * width)
+            y = int((zy0 * height) + index * line_height + (line_height - text_height) / 2)
+            region = card[y:y + mask.shape[0], x:x + mask.shape[1]]
+            alpha = mask[:region.shape[0], :region.shape[1], None]
+            card[y:y + mask.shape[0], x:x + mask.shape[1]] = region * (1 - alpha) + ink * alpha
+            box = np.array([[x, y], [x + mask.shape[1], y], [x + mask.shape[1], y + text_height],
+                            [x, y + text_height]], dtype=np.float32)
+            lines.append((text, box))
+
+    # rotate the card and its text boxes around the center
+    angle = rng.uniform(-max_rotation, max_rotation)
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    card = cv2.warpAffine(card, matrix, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    lines = [(text, cv2.transform(box[None], matrix)[0]) for text, box in lines]
+
+    if blur:
+        card = cv2.GaussianBlur(card, (3, 3), 0)
+    card = card + rng.normal(0, noise, card.shape)
+    return np.clip(card, 0, 255).astype(np.uint8), lines
+
+
+def generate_cards(count, seed=0, font_path=None, max_rotation=3.0, noise=6.0):
+    """
+    :param count: number of cards.
+    :param seed: seed of the first card, the next cards use the next seeds.
+    :param font_path: path to a TrueType font, None to look for a font with Vietnamese glyphs.
+    :param max_rotation: maximum rotation of the cards (in degrees, either way).
+    :param noise: standard deviation of the Gaussian noise (in gray levels).
+    :return: generator of (template name, card image (RGB), list of (text, 4 x 2 array of the text-line corners)).
+    """
+    font, vietnamese = load_font(font_path)
+    templates = sorted(TEMPLATES)
+    for index in range(count):
+        template = templates[index % len(templates)]
+        image, lines = render_card(template, seed + index, font, vietnamese, max_rotation, noise)
+        yield template, image, lines
+
+
+def write_cards(output_path, count, seed=0, font_path=None, max_rotation=3.0, noise=6.0, quality=90):
+    """
+    Write synthetic cards as JPEG files, and their labels to labels.jsonl in the same folder.
+    :param output_path: path to the output folder.
+    :param count: number of cards.
+    :param seed: seed of the first card.
+    :param font_path: path to a TrueType font, None to look for a font with Vietnamese glyphs.
+    :param max_rotation: maximum rotation of the cards (in degrees, either way).
+    :param noise: standard deviation of the Gaussian noise (in gray levels).
+    :param quality: JPEG quality of the files.
+    :return: list of the paths to the card images, list of their labels (list of (text, box)).
+    """
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+
+    paths, labels = [], []
+    with open(os.path.join(output_path, 'labels.jsonl'), 'w', encoding='utf-8') as f:
+        for index, (template, image, lines) in enumerate(generate_cards(count, seed, font_path, max_rotation,
+                                                                        noise)):
+            name = 'card_{:05d}.jpg'.format(index)
+            path = os.path.join(output_path, name)
+            cv2.imwrite(path, image[:, :, ::-1], [cv2.IMWRITE_JPEG_QUALITY, quality])
+            record = {'file': name, 'template': template,
+                      'lines': [{'text': text, 'box': box.astype(np.float64).round(1).tolist()} for text, box in lines]}
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            paths.append(path)
+            labels.append(lines)
+    return paths, labels
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Synthetic ID-card images")
+    parser.add_argument("--output", default="data/synthetic", help="Path to the output folder")
+    parser.add_argument("--count", type=int, default=50, help="Number of cards")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first card")
+    parser.add_argument("--font", default=None, help="Path to a TrueType font with Vietnamese glyphs")
+    parser.add_argument("--max-rotation", type=float, default=3.0, help="Maximum rotation (in degrees)")
+    parser.add_argument("--noise", type=float, default=6.0, help="Standard deviation of the noise")
+    args = parser.parse_args()
+
+    card_paths, card_labels = write_cards(args.output, args.count, args.seed, args.font, args.max_rotation,
+                                          args.noise)
+    print('{} cards written to {}'.format(len(card_paths), args.output))
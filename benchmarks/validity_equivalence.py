@@ -0,0 +1,116 @@
+"""
+Check that check_valid_batch() gives the same verdicts as check_valid_predicted() in the fuzzy mode,
+on OCR-like variants of the card titles whose fuzzy score is close to the cutoff, and that both reject
+non-card texts (short words, names, other headers).
+
+> python -m benchmarks.validity_equivalence --variants 2000
+"""
+import argparse
+import time
+import numpy as np
+from rapidfuzz import fuzz
+from rapidfuzz.utils import default_process
+from exe.ocr_from_text_regions import FUZZY_PATTERNS, check_valid_predicted, check_valid_batch, remove_accents
+
+# OCR confusions and separators seen in results
+_NOISE = 'abcdeghiklmnoqrstuvxy0123456789 .,:-/|'
+
+# Near-threshold strings with separators and upper case letters, which only the rapidfuzz processor removes
+_HANDWRITTEN = ("CAN-CUOC-CONG", "c.h.u.n.g m.i.n.h", "CHUNG|MINH|NHA", "can.cuoc.cong.dax", "IDENTITY-CAR",
+                "citizen-identit", "cann cuoc congg dann", "chung, minh, nhan, dax", "CAN CUOC: CONG DA",
+                "identi ty ca rd", "cancuocco", "chungminhnha")
+
+# Texts of other documents and short OCR texts, some of them found inside a card title
+NON_CARDS = ("Minh", "an", "c", "Chúng tôi", "Nhân", "Dân", "cuoc", "NGUYỄN VĂN MINH", "Trần Thị Hương",
+             "CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM", "Độc lập - Tự do - Hạnh phúc", "GIẤY PHÉP LÁI XE",
+             "DRIVER'S LICENSE", "HỘ CHIẾU PASSPORT", "THẺ BẢO HIỂM Y TẾ", "Hóa đơn giá trị gia tăng",
+             "Ngày sinh: 01/01/1990", "Quê quán: Hà Nội", "123456789", "")
+
+
+def ocr_variants(num_variants, seed=0):
+    """
+    :param num_variants: number of strings.
+    :return: list of card titles with 1 to 6 random substitutions, deletions or insertions, between random words.
+    """
+    rng = np.random.RandomState(seed)
+    variants = list(_HANDWRITTEN)
+    for _ in range(num_variants):
+        text = list(FUZZY_PATTERNS[rng.randint(len(FUZZY_PATTERNS))])
+        for _ in range(rng.randint(1, 7)):
+            position = rng.randint(len(text))
+            edit = rng.randint(3)
+            if edit == 0:
+                text[position] = _NOISE[rng.randint(len(_NOISE))]
+            elif edit == 1 and len(text) > 1:
+                del text[position]
+            else:
+                text.insert(position, _NOISE[rng.randint(len(_NOISE))])
+        noise = ''.join(_NOISE[rng.randint(len(_NOISE))] for _ in range(rng.randint(0, 12)))
+        variants.append(noise + ''.join(text) if rng.randint(2) else ''.join(text) + noise)
+    return variants
+
+
+def fuzzy_score(text):
+    """
+    :param text: straighten string.
+    :return: best rapidfuzz partial_ratio of a card title in text, as computed by the validity check
+    (0 if text is shorter than every title).
+    """
+    query = default_process(remove_accents(text).lower()).replace(' ', '')
+    return max([fuzz.partial_ratio(pattern, query) for pattern in FUZZY_PATTERNS if len(query) >= len(pattern)],
+               default=0)
+
+
+def compare(texts, score_cutoff=78, margin=10):
+    """
+    :param texts: list of straighten strings.
+    :param score_cutoff: cutoff of the fuzzy match.
+    :param margin: only the strings scoring within margin of the cutoff are compared.
+    :return: True if check_valid_batch() matches check_valid_predicted() on every compared string.
+    """
+    texts = [text for text in texts if abs(fuzzy_score(text) - score_cutoff) <= margin]
+
+    t = time.time()
+    single = [check_valid_predicted(text, fuzzy=True, score_cutoff=score_cutoff) for text in texts]
+    t_single = time.time() - t
+
+    t = time.time()
+    batch = check_valid_batch(texts, fuzzy=True, score_cutoff=score_cutoff)
+    t_batch = time.time() - t
+
+    mismatches = [(text, a, b) for text, a, b in zip(texts, single, batch) if a != b]
+    for text, a, b in mismatches:
+        print('{!r}: check_valid_predicted {}, check_valid_batch {}: MISMATCH'.format(text, a, b))
+
+    print('{} near-threshold strings ({} valid): check_valid_predicted {:.4f}s, check_valid_batch {:.4f}s'.
+          format(len(texts), sum(single), t_single, t_batch))
+    return not mismatches
+
+
+def check_non_cards(texts, score_cutoff=78):
+    """
+    :param texts: list of texts that are not of an ID card.
+    :param score_cutoff: cutoff of the fuzzy match.
+    :return: True if both check_valid_predicted() and check_valid_batch() reject every text.
+    """
+    batch = check_valid_batch(texts, fuzzy=True, score_cutoff=score_cutoff)
+    accepted = [text for text, valid in zip(texts, batch)
+                if valid or check_valid_predicted(text, fuzzy=True, score_cutoff=score_cutoff)]
+    for text in accepted:
+        print('{!r}: accepted as a card: MISMATCH'.format(text))
+
+    print('{} non-card texts, {} accepted'.format(len(texts), len(accepted)))
+    return not accepted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Fuzzy validity check equivalence")
+    parser.add_argument("--variants", type=int, default=2000, help="Number of random OCR variants of the titles")
+    parser.add_argument("--cutoff", type=int, default=78, help="Fuzzy score cutoff")
+    args = parser.parse_args()
+
+    if not compare(ocr_variants(args.variants), args.cutoff):
+        raise SystemExit('check_valid_batch does not match check_valid_predicted')
+    if not check_non_cards(list(NON_CARDS), args.cutoff):
+        raise SystemExit('Non-card texts are accepted by the fuzzy validity check')
+    print('All verdicts match')
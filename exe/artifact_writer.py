@@ -0,0 +1,74 @@
+import logging
+import queue
+import threading
+from exe.telemetry import inc
+
+logger = logging.getLogger(__name__)
+
+
+class ArtifactWriter:
+    """
+    Background thread encoding and writing the debug artifacts (heatmaps, overlays, polygon files),
+    so the model stages do not wait for image encoding and disk writes.
+    The queue of pending writes is bounded: when the disk cannot keep up, submit() blocks instead of
+    letting the pending images fill the memory.
+    """
+
+    def __init__(self, max_pending=32):
+        """
+        :param max_pending: maximum number of writes waiting for the thread.
+        """
+        self._queue = queue.Queue(max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                self._queue.task_done()
+                break
+            function, args = task
+            try:
+                function(*args)
+            except Exception as e:
+                logger.error('Cannot write artifact: %s', e)
+                inc('failures_total', stage='artifact')
+            self._queue.task_done()
+
+    def is_alive(self):
+        """
+        :return: True if the thread is running (it is not after close(), nor in a forked child process).
+        """
+        return self._thread.is_alive()
+
+    def submit(self, function, *args):
+        """
+        Run function(*args) in the writer thread.
+        :param function: function writing an artifact.
+        :param args: arguments of the function, they must not be modified afterwards.
+        """
+        if not self._thread.is_alive():
+            raise RuntimeError('ArtifactWriter is closed')
+        self._queue.put((function, args))
+
+    def flush(self):
+        """
+        Wait for the pending writes.
+        """
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        """
+        Wait for the pending writes, then stop the thread.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
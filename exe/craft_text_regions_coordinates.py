@@ -1,12 +1,23 @@
+import logging
 import urllib.request
 import os
-import time
 import torch
 import torch.backends.cudnn as cudnn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 import cv2
+import numpy as np
 from models.craft import test, imgproc, file_utils
+from models.craft.detections import Detections
 from models.craft.craft import CRAFT
 from models.craft.refinenet import RefineNet
+from exe.telemetry import span, inc
+
+logger = logging.getLogger(__name__)
+
+# none: no debug artifact, the heatmaps are not even rendered
+# minimal: the detected polygons only (res_*.txt)
+# full: the polygons, the score/link heatmap (*_masked.jpg) and the polygons drawn on the image (res_*.jpg)
+ARTIFACT_LEVELS = ('none', 'minimal', 'full')
 
 
 def craft_constants():
@@ -32,99 +43,288 @@ def craft_constants():
             show_time, refine, trained_model, pretrained_weight_url, refiner_model, refiner_weight_url)
 
 
-def get_text_regions_coordinates(image_path, result_path='result/craft_text_regions'):
+def fold_batchnorm(module):
     """
-    :param image_path: path to extracted-card image.
-    :param result_path: path to result folder of this function.
-    :return: A string contains all bounding box coordinates for text regions in the extracted-card.
+    Fold every BatchNorm2d that follows a Conv2d (in an nn.Sequential) into the convolution, in place.
+    The BatchNorm2d is replaced by an nn.Identity, so the layer indices stay the same.
+    :param module: module in eval mode.
+    :return: module.
     """
-    try:
-        image_name = os.path.basename(image_path)
+    for child in module.children():
+        fold_batchnorm(child)
+    if isinstance(module, torch.nn.Sequential):
+        names = list(module._modules)
+        for name, next_name in zip(names, names[1:]):
+            conv, bn = module._modules[name], module._modules[next_name]
+            if isinstance(conv, torch.nn.Conv2d) and isinstance(bn, torch.nn.BatchNorm2d):
+                module._modules[name] = fuse_conv_bn_eval(conv, bn)
+                module._modules[next_name] = torch.nn.Identity()
+    return module
 
-        if not os.path.isdir(result_path):
-            os.makedirs(result_path)
 
-        # get constants
-        (text_threshold, low_text, link_threshold,
-         cuda, canvas_size, mag_ratio, poly,
-         show_time, refine, trained_model, pretrained_weight_url, refiner_model, refiner_weight_url) = craft_constants()
+def optimize_for_inference(module):
+    """
+    Prepare a loaded model for CPU inference, once: fold its BatchNorm layers into the convolutions, store its
+    weights in channels_last memory format and drop their gradients. The outputs are the same up to float rounding.
+    :param module: loaded model.
+    :return: module.
+    """
+    module.eval()
+    fold_batchnorm(module)
+    module.to(memory_format=torch.channels_last)
+    module.requires_grad_(False)
+    return module
+
+
+def load_craft_models(weights_path='weights/craft', optimize=True):
+    """
+    Build CRAFT (and the link refiner if enabled) and load their pre-trained weights.
+    Call this once per process and pass the returned models to get_text_regions_coordinates.
+    :param weights_path: path to the folder contains the pre-trained weight files.
+    :param optimize: prepare the models for inference (see optimize_for_inference()).
+    :return: CRAFT net, RefineNet (None if the refiner is disabled).
+    """
+    # get constants
+    (text_threshold, low_text, link_threshold,
+     cuda, canvas_size, mag_ratio, poly,
+     show_time, refine, trained_model, pretrained_weight_url, refiner_model, refiner_weight_url) = craft_constants()
+
+    # load net and initialize
+    net = CRAFT()
+
+    if not os.path.isdir(weights_path):
+        os.makedirs(weights_path)
+
+    # Load pre-trained weight file
+    pretrained_model_path = os.path.join(weights_path, trained_model)
+    if not os.path.exists(pretrained_model_path):
+        logger.info('Downloading pre-trained weight file...')
+        urllib.request.urlretrieve(pretrained_weight_url, pretrained_model_path)
+    else:
+        logger.debug('Pre-trained model existed at %s', pretrained_model_path)
 
-        # load net and initialize
-        net = CRAFT()
+    logger.debug('Loading weights from checkpoint (%s)', trained_model)
+    # if cuda:
+    #     net.load_state_dict(test.copyStateDict(torch.load(pretrained_model_path)))
+    #     net = net.cuda()
+    #     net = torch.nn.DataParallel(net)
+    #     cudnn.benchmark = False
+    # else:
+    #     net.load_state_dict(test.copyStateDict(torch.load(pretrained_model_path, map_location='cpu')))
 
-        weights_path = 'weights/craft'
+    net.load_state_dict(test.copyStateDict(torch.load(pretrained_model_path, map_location='cpu')))
 
-        if not os.path.isdir(weights_path):
-            os.makedirs(weights_path)
+    net.eval()
 
-        # Load pre-trained weight file
-        pretrained_model_path = os.path.join(weights_path, trained_model)
-        if not os.path.exists(pretrained_model_path):
-            print('Downloading pre-trained weight file...')
-            urllib.request.urlretrieve(pretrained_weight_url, pretrained_model_path)
-        else:
-            print('Pre-trained model existed at {}'.format(pretrained_model_path))
+    # Load refiner model weight file
 
-        print('Loading weights from checkpoint (' + trained_model + ')')
+    refiner_model_path = os.path.join(weights_path, refiner_model)
+    if not os.path.exists(refiner_model_path):
+        logger.info('Downloading refiner model file...')
+        urllib.request.urlretrieve(refiner_weight_url, refiner_model_path)
+    else:
+        logger.debug('Refiner model existed at %s', refiner_model_path)
+
+    # Link Refiner
+    refine_net = None
+    if refine:
+        refine_net = RefineNet()
+        logger.debug('Loading weights of refiner from checkpoint (%s)', refiner_model)
         # if cuda:
-        #     net.load_state_dict(test.copyStateDict(torch.load(pretrained_model_path)))
-        #     net = net.cuda()
-        #     net = torch.nn.DataParallel(net)
-        #     cudnn.benchmark = False
+        #     refine_net.load_state_dict(test.copyStateDict(torch.load(refiner_model_path)))
+        #     refine_net = refine_net.cuda()
+        #     refine_net = torch.nn.DataParallel(refine_net)
         # else:
-        #     net.load_state_dict(test.copyStateDict(torch.load(pretrained_model_path, map_location='cpu')))
+        #     refine_net.load_state_dict(test.copyStateDict(torch.load(refiner_model_path, map_location='cpu')))
+
+        refine_net.load_state_dict(test.copyStateDict(torch.load(refiner_model_path, map_location='cpu')))
 
-        net.load_state_dict(test.copyStateDict(torch.load(pretrained_model_path, map_location='cpu')))
+        refine_net.eval()
 
-        net.eval()
+    if optimize:
+        optimize_for_inference(net)
+        if refine_net is not None:
+            optimize_for_inference(refine_net)
 
-        # Load refiner model weight file
+    return net, refine_net
 
-        refiner_model_path = os.path.join(weights_path, refiner_model)
-        if not os.path.exists(refiner_model_path):
-            print('Downloading refiner model file...')
-            urllib.request.urlretrieve(refiner_weight_url, refiner_model_path)
-        else:
-            print('Refiner model existed at {}'.format(refiner_model_path))
 
-        # Link Refiner
-        refine_net = None
-        if refine:
-            refine_net = RefineNet()
-            print('Loading weights of refiner from checkpoint (' + refiner_model + ')')
-            # if cuda:
-            #     refine_net.load_state_dict(test.copyStateDict(torch.load(refiner_model_path)))
-            #     refine_net = refine_net.cuda()
-            #     refine_net = torch.nn.DataParallel(refine_net)
-            # else:
-            #     refine_net.load_state_dict(test.copyStateDict(torch.load(refiner_model_path, map_location='cpu')))
+def save_detection_result(image, image_path, polys, score_text, result_path='result/craft_text_regions',
+                          artifact_level='full'):
+    """
+    Write the score/link heatmap and the detected text regions drawn on the image.
+    :param image: extracted-card image (RGB).
+    :param image_path: path to extracted-card image, used to name the result files.
+    :param polys: detected text-region polygons.
+    :param score_text: rendered score/link heatmap.
+    :param result_path: path to result folder of this function.
+    :param artifact_level: 'minimal' only writes the polygons, 'full' also writes the heatmap and the overlay.
+    """
+    image_name = os.path.basename(image_path)
 
-            refine_net.load_state_dict(test.copyStateDict(torch.load(refiner_model_path, map_location='cpu')))
+    if not os.path.isdir(result_path):
+        os.makedirs(result_path)
 
-            refine_net.eval()
+    if artifact_level == 'minimal':
+        file_utils.saveBoxes(image_path, polys, dirname=result_path)
+        return
+
+    output_masked_path = os.path.join(result_path, os.path.splitext(image_name)[0] + '_masked.jpg')
+    cv2.imwrite(output_masked_path, score_text)
+    file_utils.saveResult(image_path, image[:, :, ::-1], polys, dirname=result_path)
+
+
+def write_detection_result(image, image_path, polys, score_text, result_path, artifact_level, writer):
+    """
+    save_detection_result(), in the writer thread if there is one.
+    :param writer: ArtifactWriter (or None to write in the calling thread).
+    """
+    if result_path is None or artifact_level == 'none':
+        return
+    if writer is None:
+        save_detection_result(image, image_path, polys, score_text, result_path, artifact_level)
+    else:
+        writer.submit(save_detection_result, image, image_path, polys, score_text, result_path, artifact_level)
+
+
+def detect_text_regions(image, image_path, net, refine_net, result_path='result/craft_text_regions',
+                        artifact_level='full', writer=None):
+    """
+    :param image: extracted-card image (RGB), as loaded by imgproc.loadImage.
+    :param image_path: path to extracted-card image, used to name the result files.
+    :param net: loaded CRAFT net.
+    :param refine_net: loaded RefineNet (or None).
+    :param result_path: path to result folder of this function. Nothing is written if it is None.
+    :param artifact_level: debug artifacts to write, one of ARTIFACT_LEVELS.
+    :param writer: ArtifactWriter writing the artifacts in the background (None to write them in this thread).
+    :return: Detections (boxes and scores) of all text regions in the extracted-card.
+    """
+    try:
+        # get constants
+        (text_threshold, low_text, link_threshold,
+         cuda, canvas_size, mag_ratio, poly,
+         show_time, refine, trained_model, pretrained_weight_url, refiner_model, refiner_weight_url) = craft_constants()
+
+        # an exported detector (see exe/detector_backends.py) runs the refiner inside the net
+        if refine_net is not None or getattr(net, 'refined', False):
             poly = True
 
-        t = time.time()
+        render = result_path is not None and artifact_level == 'full'
+        with span('detect'):
+            bboxes, polys, score_text, det_scores = test.test_net(net, image, text_threshold, link_threshold,
+                                                                  low_text, cuda, poly, canvas_size, mag_ratio,
+                                                                  show_time, refine_net, render)
+        detections = Detections(bboxes, det_scores)
 
-        image = imgproc.loadImage(image_path)
+        write_detection_result(image, image_path, polys, score_text, result_path, artifact_level, writer)
+
+        return detections
+    except Exception as e:
+        logger.error('Cannot detect text regions(s) from %s: %s', image_path, e)
+        inc('failures_total', stage='detect')
+        return None
+
+
+def detect_text_regions_batch(images, image_paths, net, refine_net, result_path='result/craft_text_regions',
+                              canvas_step=32, batch_size=4, artifact_level='full', writer=None, canvas_size=None):
+    """
+    detect_text_regions for many images, running CRAFT on batches of images of the same canvas shape.
+    :param images: list of extracted-card images (RGB).
+    :param image_paths: list of paths to the extracted-card images, used to name the result files.
+    :param net: loaded CRAFT net.
+    :param refine_net: loaded RefineNet (or None).
+    :param result_path: path to result folder of this function. Nothing is written if it is None.
+    :param canvas_step: images are grouped by their resized size rounded up to a multiple of canvas_step.
+    :param batch_size: maximum number of images per CRAFT forward pass.
+    :param artifact_level: debug artifacts to write, one of ARTIFACT_LEVELS.
+    :param writer: ArtifactWriter writing the artifacts in the background (None to write them in this thread).
+    :param canvas_size: maximum size of the resized images (the canvas_size of craft_constants() if it is None).
+    :return: list of Detections, in the same order as images (all None if the detection failed).
+    """
+    if not images:
+        return []
+    try:
+        # get constants
+        (text_threshold, low_text, link_threshold,
+         cuda, default_canvas_size, mag_ratio, poly,
+         show_time, refine, trained_model, pretrained_weight_url, refiner_model, refiner_weight_url) = craft_constants()
+        if canvas_size is None:
+            canvas_size = default_canvas_size
+
+        # an exported detector (see exe/detector_backends.py) runs the refiner inside the net
+        if refine_net is not None or getattr(net, 'refined', False):
+            poly = True
 
-        bboxes, polys, score_text, det_scores = test.test_net(net, image, text_threshold, link_threshold, low_text, cuda,
-                                                              poly, canvas_size, mag_ratio, show_time, refine_net)
-        bbox_score = {}
+        render = result_path is not None and artifact_level == 'full'
+        with span('detect'):
+            results = test.test_net_batch(net, images, text_threshold, link_threshold, low_text, cuda, poly,
+                                          canvas_size, mag_ratio, show_time, refine_net, canvas_step, batch_size,
+                                          render)
 
-        for box_num in range(len(bboxes)):
-            key = str(det_scores[box_num])
-            item = bboxes[box_num]
-            bbox_score[key] = item
+        all_detections = []
+        for image, image_path, (bboxes, polys, score_text, det_scores) in zip(images, image_paths, results):
+            all_detections.append(Detections(bboxes, det_scores))
+            write_detection_result(image, image_path, polys, score_text, result_path, artifact_level, writer)
 
-        output_masked_path = os.path.join(result_path, os.path.splitext(image_name)[0] + '_masked.jpg')
-        cv2.imwrite(output_masked_path, score_text)
-        file_utils.saveResult(image_path, image[:, :, ::-1], polys, dirname=result_path)
+        return all_detections
+    except Exception as e:
+        logger.error('Cannot detect text regions(s) from %s: %s', ', '.join(image_paths), e)
+        inc('failures_total', len(images), stage='detect')
+        return [None] * len(images)
+
+
+def effective_canvas(image_shape, canvas_size, mag_ratio):
+    """
+    :param image_shape: shape of the extracted-card image.
+    :param canvas_size: maximum size of the resized image.
+    :param mag_ratio: magnification of the image before it is capped to canvas_size.
+    :return: size (longest side, in pixels) of the image once resized for CRAFT, see resize_aspect_ratio().
+    """
+    return min(mag_ratio * max(image_shape[:2]), canvas_size)
+
+
+def detection_quality(detections, image_shape, canvas_size, mag_ratio, min_boxes=6, min_text_height=12,
+                      min_score=0.8):
+    """
+    Quality signals of a detection, telling if a larger canvas may find more (or better) text regions.
+    :param detections: Detections of the image (None if the detection failed).
+    :param image_shape: shape of the extracted-card image.
+    :param canvas_size: maximum size of the resized image the detection ran at.
+    :param mag_ratio: magnification of the image before it is capped to canvas_size.
+    :param min_boxes: minimum number of text regions of a card.
+    :param min_text_height: minimum median height (in pixels of the resized image) of the text regions.
+    :param min_score: minimum mean detection score of the text regions.
+    :return: reason to try a larger canvas, None if the detection looks good.
+    """
+    if detections is None:
+        return 'detection failed'
+    if len(detections) < min_boxes:
+        return 'too few boxes ({})'.format(len(detections))
+    ratio = effective_canvas(image_shape, canvas_size, mag_ratio) / max(image_shape[:2])
+    heights = detections.boxes[:, :, 1].max(axis=1) - detections.boxes[:, :, 1].min(axis=1)
+    if np.median(heights) * ratio < min_text_height:
+        return 'small text ({:.1f} px)'.format(np.median(heights) * ratio)
+    if detections.scores.mean() < min_score:
+        return 'low scores ({:.2f})'.format(detections.scores.mean())
+    return None
 
-        print("elapsed time : {}s".format(time.time() - t))
 
-        return str(bbox_score)
+def get_text_regions_coordinates(image_path, result_path='result/craft_text_regions', net=None, refine_net=None):
+    """
+    :param image_path: path to extracted-card image.
+    :param result_path: path to result folder of this function.
+    :param net: loaded CRAFT net. The models are loaded by load_craft_models() if it is not given.
+    :param refine_net: loaded RefineNet (or None), used together with net.
+    :return: Detections (boxes and scores) of all text regions in the extracted-card.
+    """
+    try:
+        if net is None:
+            net, refine_net = load_craft_models()
+
+        image = imgproc.loadImage(image_path)
     except Exception as e:
-        print('Cannot detect text regions(s) from {}'.format(image_path))
-        print(e)
+        logger.error('Cannot detect text regions(s) from %s: %s', image_path, e)
+        inc('failures_total', stage='decode')
         return None
+
+    return detect_text_regions(image, image_path, net, refine_net, result_path)
@@ -1,6 +1,10 @@
+import logging
 import os
 import numpy as np
 import cv2
+from exe.telemetry import span
+
+logger = logging.getLogger(__name__)
 
 
 def crop(pts, image):
@@ -23,10 +27,80 @@ def crop(pts, image):
     return dst2
 
 
-def generate_words(extracted_img_path, score_bbox, result_path='result/cropped_text_regions'):
+def region_file_name(image_name_no_ext, box):
+    """
+    :param image_name_no_ext: image name (without extension).
+    :param box: 4 x 2 array of the text-region corners.
+    :return: file name of the cropped text region, which carries its coordinates.
+    """
+    return image_name_no_ext + '_{}_{}_{}_{}_{}_{}_{}_{}.jpg'.format(*box.ravel())
+
+
+def crop_region(image, box):
+    """
+    :param image: extracted-card image.
+    :param box: 4 x 2 array of the text-region corners.
+    :return: Cropped text region image, None if the region cannot be cropped.
+    """
+    pts = box.astype(np.int32)
+
+    if np.all(pts) > 0:
+        try:
+            return crop(pts, image)
+        except Exception:
+            return None
+    return None
+
+
+def crop_regions(image, detections):
+    """
+    Crop all text regions in memory.
+    :param image: extracted-card image.
+    :param detections: Detections of text regions from CRAFT model execution.
+    :return: list of (box, cropped text region image), box is the 4 x 2 array of the text-region corners.
+    """
+    regions = []
+    with span('crop'):
+        for box, score in detections:
+            cropped = crop_region(image, box)
+            if cropped is not None:
+                regions.append((box, cropped))
+
+    return regions
+
+
+def save_regions(regions, image_name_no_ext, result_path='result/cropped_text_regions', rgb=False):
+    """
+    Write cropped text regions to image files.
+    :param regions: list of (box, cropped text region image) from crop_regions.
+    :param image_name_no_ext: image name (without extension).
+    :param result_path: path to result folder of this function.
+    :param rgb: True if the cropped images are in RGB order (cv2 writes BGR).
+    :return: path to result folder of the input image.
+    """
+    result_folder = os.path.join(result_path, image_name_no_ext)
+
+    for box, word in regions:
+        try:
+            if not os.path.isdir(result_folder):
+                os.makedirs(result_folder)
+
+            file_name = os.path.join(result_folder, region_file_name(image_name_no_ext, box))
+            if rgb:
+                word = cv2.cvtColor(word, cv2.COLOR_RGB2BGR)
+            cv2.imwrite(file_name, word)
+            logger.debug('Image saved to %s', file_name)
+
+        except Exception:
+            continue
+
+    return result_folder
+
+
+def generate_words(extracted_img_path, detections, result_path='result/cropped_text_regions'):
     """
     :param extracted_img_path: path to the extracted-card image.
-    :param score_bbox: a string of text-region coordinates from CRAFT model execution.
+    :param detections: Detections of text regions from CRAFT model execution.
     :param result_path: path to result folder of this function.
     :return: path to result folder of the input image, image name (without extension)
     """
@@ -37,43 +111,14 @@ def generate_words(extracted_img_path, score_bbox, result_path='result/cropped_t
         if not os.path.isdir(result_path):
             os.makedirs(result_path)
         image_name_no_ext = os.path.splitext(image_name)[0]
-        result_folder = os.path.join(result_path, image_name_no_ext)
-
-        score_bbox = score_bbox.split('),')
-        num_bboxes = len(score_bbox)
-
-        for num in range(num_bboxes):
-            bbox_coords = score_bbox[num].split(':')[-1].split(',\n')
-            if bbox_coords != ['{}']:
-                l_t = float(bbox_coords[0].strip(' array([').strip(']').split(',')[0])
-                t_l = float(bbox_coords[0].strip(' array([').strip(']').split(',')[1])
-                r_t = float(bbox_coords[1].strip(' [').strip(']').split(',')[0])
-                t_r = float(bbox_coords[1].strip(' [').strip(']').split(',')[1])
-                r_b = float(bbox_coords[2].strip(' [').strip(']').split(',')[0])
-                b_r = float(bbox_coords[2].strip(' [').strip(']').split(',')[1])
-                l_b = float(bbox_coords[3].strip(' [').strip(']').split(',')[0])
-                b_l = float(bbox_coords[3].strip(' [').strip(']').split(',')[1].strip(']'))
-                pts = np.array([[int(l_t), int(t_l)], [int(r_t), int(t_r)], [int(r_b), int(b_r)], [int(l_b), int(b_l)]])
-
-                if np.all(pts) > 0:
-                    try:
-                        word = crop(pts, image)
-                        if not os.path.isdir(result_folder):
-                            os.makedirs(result_folder)
-
-                        file_name = os.path.join(result_folder,
-                                                 image_name_no_ext + '_{}_{}_{}_{}_{}_{}_{}_{}.jpg'.
-                                                 format(l_t, t_l, r_t, t_r, r_b, b_r, l_b, b_l))
-                        cv2.imwrite(file_name, word)
-                        print('Image saved to ' + file_name)
-
-                    except Exception:
-                        continue
+
+        result_folder = save_regions(crop_regions(image, detections), image_name_no_ext, result_path)
+
         if os.path.isdir(result_folder):
             return result_folder, image_name_no_ext
         else:
-            print('Cannot crop text regions from {}'.format(extracted_img_path))
+            logger.error('Cannot crop text regions from %s', extracted_img_path)
             return None, None
     except Exception:
-        print('Cannot crop text regions from {}'.format(extracted_img_path))
+        logger.error('Cannot crop text regions from %s', extracted_img_path)
         return None, None
@@ -0,0 +1,223 @@
+"""
+Detector backends running CRAFT and the refiner as a single exported graph instead of eager PyTorch modules.
+
+Export the detector of weights/craft (the pipeline also exports it on first use):
+> python -m exe.detector_backends --format onnx
+> python -m exe.detector_backends --format torchscript
+"""
+import argparse
+import importlib.util
+import inspect
+import logging
+import os
+import torch
+from exe.craft_text_regions_coordinates import load_craft_models
+from exe.precision import state_fingerprint
+from exe.telemetry import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# torch: eager CRAFT and RefineNet
+# torchscript: frozen TorchScript graph of CRAFT and the refiner
+# onnxruntime: ONNX graph of CRAFT and the refiner, run by ONNX Runtime (pip install onnxruntime)
+DETECTOR_BACKENDS = ('torch', 'torchscript', 'onnxruntime')
+
+_EXTENSIONS = {'torchscript': '.pt', 'onnxruntime': '.onnx'}
+
+
+class RefinedCraft(torch.nn.Module):
+    """
+    CRAFT followed by the refiner, as one graph: the output is the CRAFT score map (N x H x W x 2) whose link
+    channel is replaced by the refined link, the scores test_net() reads.
+    """
+
+    def __init__(self, net, refine_net=None):
+        """
+        :param net: CRAFT net.
+        :param refine_net: RefineNet, None if the refiner is disabled.
+        """
+        super().__init__()
+        self.net = net
+        self.refine_net = refine_net
+
+    def forward(self, x):
+        y, feature = self.net(x)
+        if self.refine_net is None:
+            return y
+        y_refiner = self.refine_net(y, feature)
+        return torch.cat([y[..., :1], y_refiner[..., :1]], dim=-1)
+
+
+class TorchScriptDetector:
+    """
+    Frozen TorchScript graph of RefinedCraft, called as a CRAFT net by test_net() (with no refine_net).
+    """
+
+    def __init__(self, path, refined=True):
+        """
+        :param path: path to the TorchScript file from export_torchscript().
+        :param refined: the graph holds the refiner.
+        """
+        self.path = path
+        self.refined = refined
+        self.module = torch.jit.load(path, map_location='cpu')
+
+    def __call__(self, x):
+        return self.module(x), None
+
+    def share_memory(self):
+        self.module.share_memory()
+
+
+class OnnxDetector:
+    """
+    ONNX Runtime session of RefinedCraft, called as a CRAFT net by test_net() (with no refine_net).
+    The session is created on first use in every process, as ONNX Runtime sessions do not survive a fork.
+    """
+
+    def __init__(self, path, refined=True):
+        """
+        :param path: path to the ONNX file from export_onnx().
+        :param refined: the graph holds the refiner.
+        """
+        self.path = path
+        self.refined = refined
+        self._session = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_session'] = None
+        return state
+
+    def session(self):
+        """
+        :return: the ONNX Runtime session of this process.
+        """
+        if self._session is None or self._pid != os.getpid():
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = torch.get_num_threads()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self._session = onnxruntime.InferenceSession(self.path, options, providers=['CPUExecutionProvider'])
+            self._pid = os.getpid()
+        return self._session
+
+    def __call__(self, x):
+        y = self.session().run(None, {'image': x.cpu().numpy()})[0]
+        return torch.from_numpy(y), None
+
+    def share_memory(self):
+        pass
+
+
+def export_torchscript(net, refine_net, path):
+    """
+    Trace CRAFT and the refiner into one frozen TorchScript graph. The height and width stay dynamic.
+    :param net: CRAFT net (float32).
+    :param refine_net: RefineNet (float32), None if the refiner is disabled.
+    :param path: path to the output file.
+    :return: path.
+    """
+    model = RefinedCraft(net, refine_net).eval()
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, torch.zeros(1, 3, 320, 480)))
+    _save(path, lambda temp_path: torch.jit.save(traced, temp_path))
+    return path
+
+
+def export_onnx(net, refine_net, path, opset_version=17):
+    """
+    Export CRAFT and the refiner as one ONNX graph with dynamic batch, height and width axes.
+    :param net: CRAFT net (float32).
+    :param refine_net: RefineNet (float32), None if the refiner is disabled.
+    :param path: path to the output file.
+    :param opset_version: ONNX opset of the graph.
+    :return: path.
+    """
+    model = RefinedCraft(net, refine_net).eval()
+    dynamic_axes = {'image': {0: 'batch', 2: 'height', 3: 'width'}, 'score': {0: 'batch', 1: 'height', 2: 'width'}}
+    options = dict(input_names=['image'], output_names=['score'], dynamic_axes=dynamic_axes,
+                   opset_version=opset_version)
+    # newer torch versions export with the dynamo exporter by default, the older ones have no such keyword
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        options['dynamo'] = False
+    _save(path, lambda temp_path: torch.onnx.export(model, (torch.zeros(1, 3, 320, 480),), temp_path, **options))
+    return path
+
+
+def _save(path, write):
+    """
+    :param path: path to the output file.
+    :param write: function writing the file at the path it is given.
+    """
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    # write then rename, so a crash never leaves a half-written file
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    write(temp_path)
+    os.replace(temp_path, path)
+    logger.info('Detector exported at %s', path)
+
+
+def exported_path(net, refine_net, backend, export_path='weights/craft/exported'):
+    """
+    :param net: CRAFT net (float32).
+    :param refine_net: RefineNet (float32), None if the refiner is disabled.
+    :param backend: 'torchscript' or 'onnxruntime'.
+    :param export_path: path to the folder of the exported graphs.
+    :return: path to the exported graph of the models for backend, named after their weights.
+    """
+    name = 'craft_{}{}'.format(state_fingerprint(net, refine_net)[:16], _EXTENSIONS[backend])
+    return os.path.join(export_path, name)
+
+
+def load_detector(net, refine_net, backend='torch', export_path='weights/craft/exported'):
+    """
+    :param net: CRAFT net (float32).
+    :param refine_net: RefineNet (float32), None if the refiner is disabled.
+    :param backend: one of DETECTOR_BACKENDS. The graph is exported to export_path on first use.
+    :param export_path: path to the folder of the exported graphs.
+    :return: CRAFT net, RefineNet to pass to test_net(). For the exported backends, the net runs the whole graph
+    and the RefineNet is None. If ONNX Runtime is not installed, the eager models are returned.
+    """
+    if backend not in DETECTOR_BACKENDS:
+        raise ValueError('backend must be one of {}, got {}'.format(DETECTOR_BACKENDS, backend))
+    if backend == 'torch':
+        return net, refine_net
+
+    path = exported_path(net, refine_net, backend, export_path)
+    try:
+        if backend == 'onnxruntime':
+            # fails before the export if ONNX Runtime is not installed
+            if importlib.util.find_spec('onnxruntime') is None:
+                raise ImportError('onnxruntime is not installed (pip install onnxruntime)')
+            if not os.path.exists(path):
+                export_onnx(net, refine_net, path)
+            return OnnxDetector(path, refine_net is not None), None
+        if not os.path.exists(path):
+            export_torchscript(net, refine_net, path)
+        return TorchScriptDetector(path, refine_net is not None), None
+    except ImportError as e:
+        logger.warning('Cannot use the %s detector backend, running the eager models: %s', backend, e)
+        return net, refine_net
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Export CRAFT and the refiner as a single graph")
+    parser.add_argument("--weights", default="weights/craft", help="Path to the CRAFT weight files")
+    parser.add_argument("--format", choices=["onnx", "torchscript"], default="onnx")
+    parser.add_argument("--output", default=None,
+                        help="Path to the output file (the file the pipeline looks for if it is not set)")
+    args = parser.parse_args()
+    configure_logging()
+
+    craft_net, craft_refine_net = load_craft_models(args.weights)
+    backend_name = 'onnxruntime' if args.format == 'onnx' else 'torchscript'
+    output_path = args.output or exported_path(craft_net, craft_refine_net, backend_name,
+                                               os.path.join(args.weights, 'exported'))
+    if args.format == 'onnx':
+        export_onnx(craft_net, craft_refine_net, output_path)
+    else:
+        export_torchscript(craft_net, craft_refine_net, output_path)
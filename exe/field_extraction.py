@@ -0,0 +1,102 @@
+import os
+import pandas as pd
+from PIL import Image
+from exe.crop_text_regions import crop_region
+from exe.ocr_from_text_regions import remove_accents, read_texts
+from modules.process_output.ocr_processing import order_lines
+from modules.layout.field_zones import (TEMPLATES, ANCHOR_FIELDS, assign_fields, classify_template, strip_label,
+                                        parse_id_number, parse_date)
+
+FIELDS = ('id_number', 'name', 'date_of_birth')
+
+
+def _read(image, boxes, indices, texts, config, detector, batch_size, bucket_width, memo):
+    """
+    OCR the text regions of indices not read yet, adding their texts to texts.
+    """
+    todo = [index for index in indices if index not in texts]
+    crops = [crop_region(image, boxes[index]) for index in todo]
+    read = [(index, cropped) for index, cropped in zip(todo, crops) if cropped is not None]
+    predictions = read_texts([Image.fromarray(cropped) for _, cropped in read], config, detector,
+                             batch_size, bucket_width, memo)
+    for (index, _), text in zip(read, predictions):
+        texts[index] = text
+    # regions that cannot be cropped read as empty
+    for index in todo:
+        texts.setdefault(index, '')
+
+
+def extract_fields(image, detections, config, detector, batch_size=16, bucket_width=10, memo=None,
+                   templates=None, accept=None):
+    """
+    OCR only the text regions of the fields we need, using the layout of the known card templates.
+    The header and title regions of every template are read first: the title tells the template
+    (CMND or CCCD front), then only the regions in the field zones of that template are read.
+    :param image: extracted-card image (RGB).
+    :param detections: Detections of the image.
+    :param config: Customized config for the VietOCR Predictor.
+    :param detector: an already built VietOCR Predictor.
+    :param batch_size: maximum number of text regions per VietOCR forward pass.
+    :param bucket_width: width (in pixels) of the buckets that group text regions into batches.
+    :param memo: CropMemo of the text regions already read, None to read every region.
+    :param templates: dict of the card layouts (TEMPLATES if it is not given).
+    :param accept: function telling from the header and title text if the image is a card worth reading,
+    e.g. check_valid_predicted(). The fields of a rejected image are not read. None reads every image.
+    :return: dict of the fields (template, header, title, id_number, name, date_of_birth), None if the image
+    is rejected, list of the field texts (header, title, then the fields) and number of regions read.
+    """
+    if templates is None:
+        templates = TEMPLATES
+    boxes = detections.boxes
+    assignments = {name: assign_fields(boxes, image.shape, template) for name, template in templates.items()}
+
+    texts = {}
+    anchors = sorted({int(index) for fields in assignments.values() for field in ANCHOR_FIELDS
+                      for index in fields.get(field, [])})
+    _read(image, boxes, anchors, texts, config, detector, batch_size, bucket_width, memo)
+    if accept is not None:
+        anchor_lines = order_lines(boxes[anchors], [texts[index] for index in anchors])
+        if not accept(' '.join(anchor_lines)):
+            return None, [line for line in anchor_lines if line], len(texts)
+
+    # the template is told by the title, else it is the one whose zones hold the most regions
+    anchor_text = remove_accents(' '.join(texts[index] for index in anchors)).lower()
+    name = classify_template(anchor_text)
+    if name is None:
+        name = max(assignments, key=lambda key: sum(len(indices) for indices in assignments[key].values()))
+    fields = assignments[name]
+
+    _read(image, boxes, [int(index) for field in FIELDS for index in fields.get(field, [])], texts, config,
+          detector, batch_size, bucket_width, memo)
+
+    field_texts = {field: ' '.join(texts[int(index)] for index in indices if texts[int(index)])
+                   for field, indices in fields.items()}
+
+    def value(field):
+        text = field_texts.get(field, '')
+        return strip_label(text, remove_accents(text).lower())
+
+    result = {'template': name,
+              'header': field_texts.get('header', ''),
+              'title': field_texts.get('title', ''),
+              'id_number': parse_id_number(value('id_number')),
+              'name': value('name'),
+              'date_of_birth': parse_date(value('date_of_birth'))}
+    lines = [field_texts[field] for field in fields if field_texts[field]]
+
+    return result, lines, len(texts)
+
+
+def save_fields(fields, img_name_no_ext, result_path='result/ocr_in_csv'):
+    """
+    :param fields: dict of the fields from extract_fields().
+    :param img_name_no_ext: Original image's name without extension.
+    :param result_path: Path to folder contains result file (csv).
+    :return: Path to the CSV file (one row per field).
+    """
+    if not os.path.isdir(result_path):
+        os.makedirs(result_path)
+    output_path = os.path.join(result_path, 'FIELDS_RESULT_' + img_name_no_ext + '.csv')
+    pd.DataFrame(list(fields.items()), columns=['field', 'value']).to_csv(output_path)
+
+    return output_path
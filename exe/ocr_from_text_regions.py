@@ -1,93 +1,264 @@
+import logging
 import os
+import re
+import numpy as np
 import pandas as pd
-from models.vietocr.utils import init_config, pred_text
-from modules.process_output.ocr_processing import sort_ocr_result
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
+from PIL import Image
+from exe.crop_text_regions import region_file_name
+from exe.telemetry import span, inc
+from models.vietocr.utils import init_config, pred_text_batch
+from modules.process_output.ocr_processing import sort_ocr_result, order_lines, top_lines
 
+_ACCENTED = u'ÀÁÂÃÈÉÊÌÍÒÓÔÕÙÚÝàáâãèéêìíòóôõùúýĂăĐđĨĩŨũƠơƯưẠạẢảẤấẦầẨẩẪẫẬậẮắẰằẲẳẴẵẶặẸẹẺẻẼẽẾếỀềỂểỄễỆệỈỉỊịỌọỎỏỐốỒồỔổỖỗỘộỚớỜờỞởỠỡỢợỤụỦủỨứỪừỬửỮữỰựỲỳỴỵỶỷỸỹ'
+_UNACCENTED = u'AAAAEEEIIOOOOUUYaaaaeeeiioooouuyAaDdIiUuOoUuAaAaAaAaAaAaAaAaAaAaAaAaEeEeEeEeEeEeEeEeIiIiOoOoOoOoOoOoOoOoOoOoOoOoUuUuUuUuUuUuUuYyYyYyYy'
+_ACCENTS_TABLE = str.maketrans(_ACCENTED, _UNACCENTED)
 
-def vietocr_all(text_regions_path, img_name_no_ext, result_path='result/ocr_in_csv'):
+# Substrings of the accents-removed, lower-case straighten string of a valid ID card,
+# including OCR variants of "can cuoc cong dan" seen in results
+VALID_PATTERNS = ("chung minh nhan dan", "can cuoc cong dan", "can cuoc cong", "can cuoc", "cancuocongidan",
+                  "identity card", "canguociconidan", "canicuocicongidan", "cong dan", "chung minh nhan",
+                  "chung minh", "citizen")
+_VALID_REGEX = re.compile('|'.join(re.escape(pattern) for pattern in VALID_PATTERNS))
+
+# Card titles (without spaces) the fuzzy mode looks for in the straighten string
+FUZZY_PATTERNS = ("chungminhnhandan", "cancuoccongdan", "identitycard", "citizenidentity")
+_FUZZY_LENGTHS = np.array([len(pattern) for pattern in FUZZY_PATTERNS])
+
+logger = logging.getLogger(__name__)
+
+
+def read_texts(imgs, config, detector=None, batch_size=16, bucket_width=10, memo=None):
+    """
+    pred_text_batch(), timed as the 'ocr' stage and counted in ocr_regions_total.
+    :param imgs: list of PIL images of text regions.
+    :return: list of predicted texts, in the same order as imgs.
+    """
+    inc('ocr_regions_total', len(imgs))
+    with span('ocr'):
+        return pred_text_batch(imgs, config, detector, batch_size, bucket_width, memo)
+
+
+def vietocr_all(text_regions_path, img_name_no_ext, result_path='result/ocr_in_csv', config=None, detector=None,
+                batch_size=16, bucket_width=10):
     """
     Use VietOCR to read text from text-region image.
     :param text_regions_path: Path to folder contains cropped text-region images.
     :param img_name_no_ext: Original image's name without extension.
     :param result_path: Path to folder contains result file (csv).
+    :param config: Customized config for the VietOCR Predictor (init_config() if it is not given).
+    :param detector: an already built VietOCR Predictor, reused for every text region.
+    :param batch_size: maximum number of text regions per VietOCR forward pass.
+    :param bucket_width: width (in pixels) of the buckets that group text regions into batches.
     :return: Paths to CSV files (raw result and sorted result) with 2 columns: text-region image file's name and predicted text.
     """
     try:
         # Step 1: Apply VietOCR model to read all cropped text regions and save into a simple dataframe.
         region_files = os.listdir(text_regions_path)
 
-        if not os.path.isdir(result_path):
-            os.makedirs(result_path)
-
         region_file_names = []
-        predictions = []
+        region_images = []
 
-        config = init_config()
+        if config is None:
+            config = init_config()
 
         for region in region_files:
             region_file_names.append(region)
             region_path = os.path.join(text_regions_path, region)
-            predicted_text = pred_text(region_path, config)
-            predictions.append(predicted_text)
+            region_images.append(Image.open(region_path))
 
-        result = pd.DataFrame(columns=['text_region_file', 'predicted_word'])
-        result['text_region_file'] = region_file_names
-        result['predicted_word'] = predictions
-        raw_output_path = os.path.join(result_path, 'RAW_RESULT_' + img_name_no_ext + '.csv')
-        result.to_csv(raw_output_path)
+        predictions = read_texts(region_images, config, detector, batch_size, bucket_width)
 
-        # Step 2: Sort the OCR result to have the top-down order of the result strings.
-        sorted_result = sort_ocr_result(result)
-        sorted_output_path = os.path.join(result_path, 'SORTED_RESULT_' + img_name_no_ext + '.csv')
-        sorted_result.to_csv(sorted_output_path)
+        raw_output_path, sorted_output_path, sorted_result = save_ocr_result(region_file_names, predictions,
+                                                                             img_name_no_ext, result_path)
         straighten = ' '.join(sorted_result['full_text'])
 
         return raw_output_path, sorted_output_path, straighten
     except Exception:
-        print('Cannot apply VietOCR model for image from {}'.format(text_regions_path))
+        logger.error('Cannot apply VietOCR model for image from %s', text_regions_path)
+        inc('failures_total', stage='ocr')
         return None, None, None
 
 
-def check_valid_predicted(straighten: str):
+def vietocr_regions(regions, img_name_no_ext, result_path='result/ocr_in_csv', config=None, detector=None,
+                    batch_size=16, bucket_width=10, memo=None, known=None):
+    """
+    Use VietOCR to read text from in-memory cropped text regions, without intermediate image files.
+    :param regions: list of (box, cropped text region image in RGB order) from crop_regions.
+    :param img_name_no_ext: Original image's name without extension.
+    :param result_path: Path to folder contains result file (csv). No CSV file is written if it is None.
+    :param config: Customized config for the VietOCR Predictor (init_config() if it is not given).
+    :param detector: an already built VietOCR Predictor, reused for every text region.
+    :param batch_size: maximum number of text regions per VietOCR forward pass.
+    :param bucket_width: width (in pixels) of the buckets that group text regions into batches.
+    :param memo: CropMemo of the text regions already read (printed labels), None to read every region.
+    :param known: dict region index -> text of the regions already read (e.g. by the cascade), not read again.
+    :return: Paths to CSV files (raw result and sorted result), straighten string, list of sorted lines.
+    """
+    try:
+        if config is None:
+            config = init_config()
+        if known is None:
+            known = {}
+
+        todo = [index for index in range(len(regions)) if index not in known]
+        read = read_texts([Image.fromarray(regions[index][1]) for index in todo], config, detector,
+                          batch_size, bucket_width, memo)
+        predictions = [known.get(index) for index in range(len(regions))]
+        for index, text in zip(todo, read):
+            predictions[index] = text
+        bbox_arrays = [box for box, word in regions]
+        with span('sort'):
+            lines = order_lines(bbox_arrays, predictions)
+
+        raw_output_path = sorted_output_path = None
+        if result_path is not None:
+            region_file_names = [region_file_name(img_name_no_ext, box) for box, word in regions]
+            raw_output_path, sorted_output_path, _ = save_ocr_result(region_file_names, predictions, img_name_no_ext,
+                                                                     result_path, bbox_arrays)
+
+        return raw_output_path, sorted_output_path, ' '.join(lines), lines
+    except Exception:
+        logger.error('Cannot apply VietOCR model for image %s', img_name_no_ext)
+        inc('failures_total', stage='ocr')
+        return None, None, None, []
+
+
+def vietocr_top_lines(regions, num_lines, config=None, detector=None, batch_size=16, bucket_width=10, memo=None,
+                      img_name_no_ext=None):
+    """
+    Use VietOCR to read only the top-most lines of a card (header and title), for an early validity check.
+    :param regions: list of (box, cropped text region image in RGB order) from crop_regions.
+    :param num_lines: number of lines to read.
+    :param config: Customized config for the VietOCR Predictor (init_config() if it is not given).
+    :param detector: an already built VietOCR Predictor, reused for every text region.
+    :param batch_size: maximum number of text regions per VietOCR forward pass.
+    :param bucket_width: width (in pixels) of the buckets that group text regions into batches.
+    :param memo: CropMemo of the text regions already read (printed labels), None to read every region.
+    :param img_name_no_ext: Original image's name without extension, for the error messages.
+    :return: dict region index -> text of the regions read (see vietocr_regions()), list of the top lines.
+    If VietOCR fails, no region is read and there is no line, so the image is rejected.
+    """
+    try:
+        if config is None:
+            config = init_config()
+        lines = top_lines([box for box, word in regions], num_lines)
+        indices = [int(index) for line in lines for index in line]
+
+        predictions = read_texts([Image.fromarray(regions[index][1]) for index in indices], config, detector,
+                                 batch_size, bucket_width, memo)
+        known = dict(zip(indices, predictions))
+
+        return known, [' '.join(known[int(index)] for index in line) for line in lines]
+    except Exception:
+        logger.error('Cannot apply VietOCR model to the top lines of image %s', img_name_no_ext)
+        inc('failures_total', stage='ocr')
+        return {}, []
+
+
+def save_ocr_result(region_file_names, predictions, img_name_no_ext, result_path='result/ocr_in_csv', bbox_arrays=None):
+    """
+    Sort the OCR result top-down and save both raw and sorted results.
+    :param region_file_names: text-region image file's names (carrying the region coordinates).
+    :param predictions: predicted text of every text region.
+    :param img_name_no_ext: Original image's name without extension.
+    :param result_path: Path to folder contains result file (csv). No CSV file is written if it is None.
+    :param bbox_arrays: 4 x 2 arrays of the text-region corners. They are read from region_file_names if not given.
+    :return: Paths to CSV files (raw result and sorted result, None if not written), sorted result dataframe.
+    """
+    result = pd.DataFrame(columns=['text_region_file', 'predicted_word'])
+    result['text_region_file'] = region_file_names
+    result['predicted_word'] = predictions
+
+    raw_output_path = sorted_output_path = None
+    if result_path is not None:
+        if not os.path.isdir(result_path):
+            os.makedirs(result_path)
+        raw_output_path = os.path.join(result_path, 'RAW_RESULT_' + img_name_no_ext + '.csv')
+        result.to_csv(raw_output_path)
+
+    # Sort the OCR result to have the top-down order of the result strings.
+    sorted_result = sort_ocr_result(result, bbox_arrays)
+    if result_path is not None:
+        sorted_output_path = os.path.join(result_path, 'SORTED_RESULT_' + img_name_no_ext + '.csv')
+        sorted_result.to_csv(sorted_output_path)
+
+    return raw_output_path, sorted_output_path, sorted_result
+
+
+def remove_accents(input_str):
+    """
+    Remove accents from the input string of tone language (Vietnamese).
+    :param input_str: Original string.
+    :return: Accents-removed string.
+    """
+    return input_str.translate(_ACCENTS_TABLE)
+
+
+def _normalize(straighten):
+    """
+    :param straighten: Straighten string by VietOCR.
+    :return: Accents-removed, lower-case string, None if straighten is not a string (e.g. an empty CSV cell).
+    """
+    if not isinstance(straighten, str):
+        return None
+    return remove_accents(straighten).lower()
+
+
+def _fuzzy_query(normalized):
+    """
+    :param normalized: string from _normalize().
+    :return: the string without spaces and separators, as compared to FUZZY_PATTERNS.
+    """
+    return default_process(normalized).replace(' ', '')
+
+
+def check_valid_predicted(straighten: str, fuzzy=False, score_cutoff=78):
     """
     Check if the predicted string is of a valid ID card or not.
     :param straighten: Straighten string by VietOCR.
+    :param fuzzy: also accept strings holding a close variant of a card title (see FUZZY_PATTERNS), for OCR
+    variants no pattern of VALID_PATTERNS covers. Only strings at least as long as the title are compared,
+    so a short text found inside a title (e.g. "minh") is not a match.
+    :param score_cutoff: minimum rapidfuzz partial_ratio (0-100) of a fuzzy match.
     :return: True (Valid) or False (Invalid)
     """
+    straighten_noaccents = _normalize(straighten)
+    if straighten_noaccents is None:
+        return False
+    if _VALID_REGEX.search(straighten_noaccents):
+        return True
+    if fuzzy:
+        query = _fuzzy_query(straighten_noaccents)
+        return any(len(query) >= len(pattern) and fuzz.partial_ratio(pattern, query, score_cutoff=score_cutoff)
+                   for pattern in FUZZY_PATTERNS)
+    return False
+
+
+def check_valid_batch(straightens, fuzzy=False, score_cutoff=78, workers=1):
+    """
+    check_valid_predicted() for many strings, e.g. to check the results of previous runs again.
+    :param straightens: iterable of straighten strings (a list, a pandas Series...).
+    :param fuzzy: also accept strings close to a card title (see check_valid_predicted()).
+    :param score_cutoff: minimum rapidfuzz partial_ratio (0-100) of a fuzzy match.
+    :param workers: number of threads computing the fuzzy scores (-1 for all cores).
+    :return: list of True (Valid) or False (Invalid), in the same order as straightens.
+    """
+    normalized = [_normalize(straighten) for straighten in straightens]
+    valid = [text is not None and _VALID_REGEX.search(text) is not None for text in normalized]
+
+    if fuzzy:
+        todo = [index for index, (text, is_valid) in enumerate(zip(normalized, valid))
+                if text is not None and not is_valid]
+        if todo:
+            queries = [_fuzzy_query(normalized[index]) for index in todo]
+            # one scorer call for all the remaining strings and all the patterns
+            scores = process.cdist(FUZZY_PATTERNS, queries, scorer=fuzz.partial_ratio, score_cutoff=score_cutoff,
+                                   workers=workers).T
+            # as in check_valid_predicted(), the patterns longer than a string are not compared to it
+            longer = np.array([len(query) for query in queries])[:, None] >= _FUZZY_LENGTHS[None, :]
+            for index, matched in zip(todo, ((scores > 0) & longer).any(axis=1)):
+                valid[index] = bool(matched)
 
-    def remove_accents(input_str):
-        """
-        Remove accents from the input string of tone language (Vietnamese).
-        :param input_str: Original string.
-        :return: Accents-removed string.
-        """
-        s1 = u'ÀÁÂÃÈÉÊÌÍÒÓÔÕÙÚÝàáâãèéêìíòóôõùúýĂăĐđĨĩŨũƠơƯưẠạẢảẤấẦầẨẩẪẫẬậẮắẰằẲẳẴẵẶặẸẹẺẻẼẽẾếỀềỂểỄễỆệỈỉỊịỌọỎỏỐốỒồỔổỖỗỘộỚớỜờỞởỠỡỢợỤụỦủỨứỪừỬửỮữỰựỲỳỴỵỶỷỸỹ'
-        s0 = u'AAAAEEEIIOOOOUUYaaaaeeeiioooouuyAaDdIiUuOoUuAaAaAaAaAaAaAaAaAaAaAaAaEeEeEeEeEeEeEeEeIiIiOoOoOoOoOoOoOoOoOoOoOoOoUuUuUuUuUuUuUuYyYyYyYy'
-        try:
-            s = ''
-            for c in input_str:
-                if c in s1:
-                    s += s0[s1.index(c)]
-                else:
-                    s += c
-            return s
-        except Exception as e:
-            print(e)
-            return ' '
-
-    straighten_noaccents = remove_accents(straighten).lower()
-
-    result = "chung minh nhan dan" in straighten_noaccents \
-             or "can cuoc cong dan" in straighten_noaccents \
-             or "can cuoc cong" in straighten_noaccents \
-             or "can cuoc" in straighten_noaccents \
-             or "cancuocongidan" in straighten_noaccents \
-             or "identity card" in straighten_noaccents \
-             or "canguociconidan" in straighten_noaccents \
-             or "canicuocicongidan" in straighten_noaccents \
-             or "cong dan" in straighten_noaccents \
-             or "chung minh nhan" in straighten_noaccents \
-             or "chung minh" in straighten_noaccents \
-             or "citizen" in straighten_noaccents
-
-    return result
+    return valid
@@ -0,0 +1,62 @@
+import multiprocessing
+import os
+import torch
+from exe.telemetry import METRICS
+
+# Pipeline of the current worker process
+_worker_pipeline = None
+
+
+def _init_worker(pipeline, num_threads):
+    """
+    Set up a worker process: keep the (inherited or unpickled) pipeline and limit the torch intra-op threads.
+    :param pipeline: the Pipeline of the parent process.
+    :param num_threads: number of torch intra-op threads of this worker.
+    """
+    global _worker_pipeline
+    torch.set_num_threads(num_threads)
+    _worker_pipeline = pipeline
+    # a forked worker inherits the metrics of the parent, which already counts them
+    METRICS.reset()
+
+
+def _process_batch(image_paths):
+    """
+    :param image_paths: list of paths to extracted-card images.
+    :return: list of Result, in the same order as image_paths, metrics recorded since the previous batch
+    (see Metrics.drain()).
+    """
+    results = _worker_pipeline.process_batch(image_paths)
+    # the pool may stop the worker once the results are sent, the artifacts must be written before
+    _worker_pipeline.flush()
+    return results, METRICS.drain()
+
+
+def process_parallel(pipeline, image_paths, workers, batch_size=4):
+    """
+    Spread images over a pool of worker processes, all using the models of an already loaded pipeline.
+    Where fork is available, the workers inherit the loaded models and their weights (moved to shared memory)
+    are shared by all workers instead of being copied. Otherwise, every worker gets its own copy of the pipeline.
+    The torch intra-op threads are divided across the workers, so they do not oversubscribe the cores.
+    The metrics of the workers (see exe/telemetry.py) are added to the metrics of this process with every batch.
+    :param pipeline: loaded Pipeline.
+    :param image_paths: list of paths to extracted-card images.
+    :param workers: number of worker processes.
+    :param batch_size: number of images a worker processes per task (see Pipeline.process_batch).
+    :return: generator of Result, in the same order as image_paths.
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context('spawn')
+    pipeline.share_memory()
+
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    batches = [image_paths[start:start + batch_size] for start in range(0, len(image_paths), batch_size)]
+
+    with context.Pool(workers, initializer=_init_worker, initargs=(pipeline, num_threads)) as pool:
+        # imap keeps the input order, whatever worker finishes first
+        for results, metrics in pool.imap(_process_batch, batches):
+            METRICS.merge(metrics)
+            for result in results:
+                yield result
@@ -0,0 +1,504 @@
+import logging
+import os
+from collections import namedtuple
+from functools import partial
+from exe.artifact_writer import ArtifactWriter
+from exe.craft_text_regions_coordinates import (ARTIFACT_LEVELS, craft_constants, load_craft_models,
+                                                detect_text_regions, detect_text_regions_batch, effective_canvas,
+                                                detection_quality)
+from exe.crop_text_regions import crop_regions, save_regions
+from exe.detector_backends import load_detector
+from exe.field_extraction import extract_fields, save_fields
+from exe.ocr_from_text_regions import vietocr_regions, vietocr_top_lines, check_valid_predicted
+from exe.precision import OCR_PRECISIONS, quantize_recognizer, convert_craft
+from exe.result_cache import ResultCache, pipeline_fingerprint
+from exe.telemetry import REGION_BUCKETS, span, inc, observe
+from models.craft import imgproc
+from models.craft.detections import Detections
+from models.vietocr.utils import init_config, get_predictor, evict_predictor
+from models.vietocr.crop_memo import CropMemo
+
+logger = logging.getLogger(__name__)
+
+# fields: dict of the structured fields in field mode (see extract_fields()), None otherwise
+# stage: with the cascade, the stage the image was decided at (see CASCADE_STAGES), None otherwise
+# canvas: in the adaptive canvas mode, the canvas size the text regions were detected at, None otherwise
+Result = namedtuple('Result', ['image_path', 'output_path', 'straighten', 'is_valid', 'lines', 'detections',
+                               'fields', 'stage', 'canvas'], defaults=(None, None, None))
+
+# Stages of the cascade: images without text regions are rejected before OCR ('detection'), images whose
+# top lines hold no card title are rejected before the full OCR ('header'), the others are fully read ('full')
+CASCADE_STAGES = ('detection', 'header', 'full')
+
+
+class Pipeline:
+    """
+    Long-lived extraction session.
+    CRAFT, RefineNet and the VietOCR Predictor are loaded once when the session is created,
+    then reused by every call to process().
+    Cropped text regions go from the cropping stage straight into VietOCR in memory,
+    writing them to image files is only a debug option.
+    """
+
+    def __init__(self, weights_path='weights/craft', ocr_batch_size=16, ocr_bucket_width=10, save_crops=False,
+                 result_path='result', detection_batch_size=4, canvas_step=32, cache_path=None,
+                 cache_size=512 * 1024 * 1024, ocr_memo_size=0, artifact_level='full', fuzzy_valid=False,
+                 fields=False, cascade_lines=0, ocr_precision='float32', craft_precision='float32',
+                 calibration_images=None, detector_backend='torch', optimize_craft=True, canvas_tiers=None,
+                 escalate_invalid=True):
+        """
+        :param weights_path: path to the folder contains the CRAFT pre-trained weight files.
+        :param ocr_batch_size: maximum number of text regions per VietOCR forward pass.
+        :param ocr_bucket_width: width (in pixels) of the buckets that group text regions into VietOCR batches.
+        :param save_crops: also write the cropped text regions to image files (for debugging).
+        :param result_path: path to the root result folder. Nothing is written if it is None.
+        :param detection_batch_size: maximum number of images per CRAFT forward pass in process_batch().
+        :param canvas_step: in process_batch(), images are grouped by their resized size rounded up to
+        a multiple of canvas_step. A larger step gives fewer, bigger batches but more padding.
+        :param cache_path: path to the folder of the result cache (see ResultCache). No cache is used if it is None.
+        :param cache_size: maximum size (in bytes) of the result cache.
+        :param ocr_memo_size: maximum number of text regions memorized by the CropMemo in front of VietOCR,
+        so printed labels repeated on every card are read only until they are known. 0 (default) disables the memo.
+        :param artifact_level: CRAFT debug artifacts to write, 'none', 'minimal' (polygons) or 'full' (polygons,
+        heatmap and overlay). They are encoded and written by a background thread.
+        :param fuzzy_valid: also accept straighten strings close to a card title in the validity check
+        (see check_valid_predicted()).
+        :param fields: field mode, only the regions of the known card fields (ID number, name, date of birth,
+        header and title) are read by VietOCR and the Results carry them as structured fields.
+        :param cascade_lines: cascade mode, only the cascade_lines top-most lines are read first and images whose
+        top lines fail the validity check are rejected without reading the other lines (in field mode, the header
+        and title zones are the top lines). 0 (default) reads every line of every image.
+        :param ocr_precision: 'float32' or 'int8' (dynamic quantization of the recurrent and linear layers of VietOCR).
+        :param craft_precision: 'float32', 'bf16' or 'int8' (static quantization of CRAFT and the refiner, see
+        quantize_craft()). The int8 models are saved in weights_path/quantized after their calibration.
+        :param calibration_images: list of paths to the images calibrating the int8 CRAFT, only needed if there
+        is no saved int8 CRAFT yet.
+        :param detector_backend: 'torch' (eager CRAFT and RefineNet), 'torchscript' or 'onnxruntime' (CRAFT and the
+        refiner exported as a single graph to weights_path/exported on first use, see exe/detector_backends.py).
+        The exported backends run the float32 models only.
+        :param optimize_craft: fold the BatchNorm layers of CRAFT and the refiner into their convolutions and
+        store their weights in channels_last format when they are loaded (see optimize_for_inference()).
+        :param canvas_tiers: adaptive canvas mode, increasing canvas sizes (e.g. (640, 960, 1280)). Images are
+        detected at the smallest canvas first, and at the next one only if the detection looks poor
+        (see detection_quality()). None (default) detects every image at the canvas size of craft_constants().
+        :param escalate_invalid: in the adaptive canvas mode, also detect an image again at the next canvas
+        if its result fails the validity check.
+        """
+        if artifact_level not in ARTIFACT_LEVELS:
+            raise ValueError('artifact_level must be one of {}, got {}'.format(ARTIFACT_LEVELS, artifact_level))
+        if ocr_precision not in OCR_PRECISIONS:
+            raise ValueError('ocr_precision must be one of {}, got {}'.format(OCR_PRECISIONS, ocr_precision))
+        if detector_backend != 'torch' and craft_precision != 'float32':
+            raise ValueError('The {} detector backend runs float32 models only'.format(detector_backend))
+        self.ocr_batch_size = ocr_batch_size
+        self.detection_batch_size = detection_batch_size
+        self.canvas_step = canvas_step
+        self.ocr_bucket_width = ocr_bucket_width
+        self.save_crops = save_crops
+        self.result_path = result_path
+        self.artifact_level = artifact_level
+        self.fuzzy_valid = fuzzy_valid
+        self.ocr_memo_size = ocr_memo_size
+        self.fields = fields
+        self.cascade_lines = cascade_lines
+        self.ocr_precision = ocr_precision
+        self.craft_precision = craft_precision
+        self.detector_backend = detector_backend
+        self.optimize_craft = optimize_craft
+        self.canvas_tiers = sorted(canvas_tiers) if canvas_tiers else None
+        self.escalate_invalid = escalate_invalid
+        self._artifact_writer = None
+        self.net, self.refine_net = load_craft_models(weights_path, optimize_craft)
+        if craft_precision != 'float32':
+            images = None
+            if calibration_images:
+                images = [image for image in map(self._load_image, calibration_images) if image is not None]
+            self.net, self.refine_net = convert_craft(self.net, self.refine_net, craft_precision, images,
+                                                      os.path.join(weights_path, 'quantized'))
+        self.net, self.refine_net = load_detector(self.net, self.refine_net, detector_backend,
+                                                  os.path.join(weights_path, 'exported'))
+        self.ocr_config = init_config()
+        self.recognizer = self._build_recognizer(self.ocr_config)
+        self.ocr_memo = CropMemo(ocr_memo_size) if ocr_memo_size > 0 else None
+        self.cache = None
+        if cache_path is not None:
+            self.cache = ResultCache(cache_path, cache_size, self._fingerprint(self.ocr_config))
+
+    def _build_recognizer(self, config):
+        """
+        :param config: Customized config for the VietOCR Predictor.
+        :return: the VietOCR Predictor of config, in the precision of this session.
+        """
+        recognizer = get_predictor(config)
+        if self.ocr_precision == 'int8':
+            recognizer = quantize_recognizer(recognizer)
+        return recognizer
+
+    def _fingerprint(self, config):
+        """
+        :param config: Customized config for the VietOCR Predictor.
+        :return: fingerprint of the results of this session (see pipeline_fingerprint()).
+        """
+        return pipeline_fingerprint(config, fields=self.fields, cascade_lines=self.cascade_lines,
+                                    fuzzy_valid=self.fuzzy_valid, ocr_memo_size=self.ocr_memo_size,
+                                    ocr_precision=self.ocr_precision, craft_precision=self.craft_precision,
+                                    detector_backend=self.detector_backend, optimize_craft=self.optimize_craft,
+                                    canvas_tiers=self.canvas_tiers, escalate_invalid=self.escalate_invalid)
+
+    def set_ocr_config(self, config):
+        """
+        Swap the VietOCR recognizer of this session, dropping the cached Predictor of the previous config.
+        :param config: Customized config for the VietOCR Predictor.
+        """
+        evict_predictor(self.ocr_config)
+        self.ocr_config = config
+        self.recognizer = self._build_recognizer(config)
+        if self.ocr_memo is not None:
+            self.ocr_memo.clear()
+        if self.cache is not None:
+            self.cache.fingerprint = self._fingerprint(config).encode('utf-8')
+
+    def share_memory(self):
+        """
+        Move the model weights to shared memory, so that worker processes use them without copies.
+        """
+        self.net.share_memory()
+        if self.refine_net is not None:
+            self.refine_net.share_memory()
+        self.recognizer.model.share_memory()
+
+    def __getstate__(self):
+        # the writer thread cannot be pickled, every process starts its own
+        state = self.__dict__.copy()
+        state['_artifact_writer'] = None
+        return state
+
+    def _writer(self):
+        """
+        :return: the ArtifactWriter of this process, None if no artifact is written.
+        """
+        if self.result_path is None or self.artifact_level == 'none':
+            return None
+        # a forked child process inherits the writer but not its thread
+        if self._artifact_writer is None or not self._artifact_writer.is_alive():
+            self._artifact_writer = ArtifactWriter()
+        return self._artifact_writer
+
+    def flush(self):
+        """
+        Wait until the pending debug artifacts are written.
+        """
+        if self._artifact_writer is not None:
+            self._artifact_writer.flush()
+
+    def close(self):
+        """
+        Write the pending debug artifacts and stop the writer thread.
+        """
+        if self._artifact_writer is not None:
+            self._artifact_writer.close()
+            self._artifact_writer = None
+
+    def _detect_batch(self, images, image_paths, first_tier=0):
+        """
+        :param images: list of extracted-card images (RGB).
+        :param image_paths: list of paths (or names) of the images.
+        :param first_tier: in the adaptive canvas mode, index of the first canvas tier to try.
+        :return: list of Detections (None if the detection failed), in the same order as images.
+        """
+        if self.canvas_tiers is None:
+            return detect_text_regions_batch(images, image_paths, self.net, self.refine_net,
+                                             self._result_folder('craft_text_regions'), self.canvas_step,
+                                             self.detection_batch_size, self.artifact_level, self._writer())
+
+        mag_ratio = craft_constants()[5]
+        all_detections = [None] * len(images)
+        todo = list(range(len(images)))
+        for tier in range(first_tier, len(self.canvas_tiers)):
+            canvas_size = self.canvas_tiers[tier]
+            # the artifacts of a larger canvas overwrite the ones of the smaller canvas
+            found = detect_text_regions_batch([images[index] for index in todo], [image_paths[index] for index in todo],
+                                              self.net, self.refine_net, self._result_folder('craft_text_regions'),
+                                              self.canvas_step, self.detection_batch_size, self.artifact_level,
+                                              self._writer(), canvas_size)
+            escalated = []
+            for index, detections in zip(todo, found):
+                next_tier = self._next_tier(images[index].shape, canvas_size)
+                reason = None
+                if next_tier is not None:
+                    reason = detection_quality(detections, images[index].shape, canvas_size, mag_ratio)
+                if reason is None:
+                    if detections is not None:
+                        detections.canvas_size = canvas_size
+                    all_detections[index] = detections
+                else:
+                    logger.info('Canvas %s for %s: %s, trying canvas %s', canvas_size, image_paths[index], reason,
+                                 self.canvas_tiers[next_tier])
+                    inc('canvas_escalations_total', canvas=canvas_size)
+                    escalated.append(index)
+            todo = escalated
+            if not todo:
+                break
+
+        return all_detections
+
+    def _next_tier(self, image_shape, canvas_size):
+        """
+        :param image_shape: shape of the extracted-card image.
+        :param canvas_size: canvas size the image was detected at.
+        :return: index of the next canvas tier that resizes the image larger, None if there is none.
+        """
+        if self.canvas_tiers is None or canvas_size is None:
+            return None
+        mag_ratio = craft_constants()[5]
+        size = effective_canvas(image_shape, canvas_size, mag_ratio)
+        for tier, larger_canvas_size in enumerate(self.canvas_tiers):
+            if larger_canvas_size > canvas_size and effective_canvas(image_shape, larger_canvas_size, mag_ratio) > size:
+                return tier
+        return None
+
+    def _result_folder(self, name):
+        """
+        :param name: name of the sub folder.
+        :return: path to the sub folder of the root result folder, None if results are not written.
+        """
+        if self.result_path is None:
+            return None
+        return os.path.join(self.result_path, name)
+
+    def _load_image(self, image_path):
+        """
+        :param image_path: path to extracted-card image.
+        :return: the image (RGB), None if it cannot be read.
+        """
+        try:
+            with span('decode'):
+                return imgproc.loadImage(image_path)
+        except Exception as e:
+            logger.error('Cannot read image from %s: %s', image_path, e)
+            inc('failures_total', stage='decode')
+            return None
+
+    def lookup_cached(self, data, image_path):
+        """
+        Look an image up in the result cache.
+        :param data: bytes of the image file.
+        :param image_path: path (or name) of the image.
+        :return: cache key (None if there is no cache), cached Result (None on a miss).
+        On a hit, the Result has no output_path: the result CSV files are not written again.
+        """
+        if self.cache is None or data is None:
+            return None, None
+        key = self.cache.key(data)
+        entry = self.cache.get(key)
+        inc('cache_lookups_total', result='miss' if entry is None else 'hit')
+        if entry is None:
+            return key, None
+        return key, Result(image_path, None, entry['straighten'], entry['is_valid'], entry['lines'],
+                           entry['detections'], entry['fields'], entry['stage'], entry['canvas'])
+
+    def _lookup_path(self, image_path):
+        """
+        lookup_cached() for an image file.
+        :param image_path: path to extracted-card image.
+        :return: cache key (None if there is no cache), cached Result (None on a miss).
+        """
+        if self.cache is None:
+            return None, None
+        try:
+            with open(image_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None, None
+        return self.lookup_cached(data, image_path)
+
+    def _store(self, key, result):
+        """
+        :param key: cache key from lookup_cached(), nothing is stored if it is None.
+        :param result: Result of the image.
+        """
+        if key is not None:
+            self.cache.put(key, result.straighten, result.lines, result.is_valid, result.detections, result.fields,
+                           result.stage, result.canvas)
+
+    def _recognize(self, image, image_path, detections):
+        """
+        Run cropping, OCR and validity checking for a single image with detected text regions.
+        In the adaptive canvas mode, an image failing the validity check is detected again at the next canvas.
+        :param image: extracted-card image (RGB).
+        :param image_path: path to extracted-card image.
+        :param detections: Detections of the image (None if the detection failed).
+        :return: Result of the image.
+        """
+        result = self._recognize_once(image, image_path, detections)
+        escalate = self.canvas_tiers is not None and self.escalate_invalid
+        while not result.is_valid and escalate and detections is not None:
+            next_tier = self._next_tier(image.shape, detections.canvas_size)
+            if next_tier is None:
+                break
+            logger.info('Canvas %s for %s: invalid result, trying canvas %s', detections.canvas_size, image_path,
+                         self.canvas_tiers[next_tier])
+            inc('canvas_escalations_total', canvas=detections.canvas_size)
+            detections = self._detect_batch([image], [image_path], next_tier)[0]
+            result = self._recognize_once(image, image_path, detections)
+        if detections is not None and detections.canvas_size is not None:
+            result = result._replace(canvas=detections.canvas_size)
+            logger.info('Canvas %s for %s', detections.canvas_size, image_path)
+            inc('canvas_selected_total', canvas=detections.canvas_size)
+        # once per image, for the detections of the final canvas
+        observe('regions_per_image', len(result.detections), REGION_BUCKETS)
+        inc('images_total', valid='true' if result.is_valid else 'false')
+        if result.stage in ('detection', 'header') and not result.is_valid:
+            inc('cascade_rejections_total', stage=result.stage)
+        return result
+
+    def _recognize_once(self, image, image_path, detections):
+        """
+        Run cropping, OCR and validity checking for a single image with detected text regions.
+        :param image: extracted-card image (RGB).
+        :param image_path: path to extracted-card image.
+        :param detections: Detections of the image (None if the detection failed).
+        :return: Result of the image.
+        """
+        img_name_no_ext = os.path.splitext(os.path.basename(image_path))[0]
+
+        if detections is None:
+            detections = Detections()
+        if self.cascade_lines and not len(detections):
+            return Result(image_path, None, '', False, [], detections, None, 'detection')
+        if self.fields:
+            return self._recognize_fields(image, image_path, detections)
+        regions = crop_regions(image, detections)
+        if self.save_crops and self.result_path is not None:
+            save_regions(regions, img_name_no_ext, self._result_folder('cropped_text_regions'), rgb=True)
+
+        known = stage = None
+        if self.cascade_lines:
+            # the regions read here are not read again by the full OCR
+            known, top = vietocr_top_lines(regions, self.cascade_lines, self.ocr_config, self.recognizer,
+                                           self.ocr_batch_size, self.ocr_bucket_width, self.ocr_memo,
+                                           img_name_no_ext)
+            if not check_valid_predicted(' '.join(top), self.fuzzy_valid):
+                return Result(image_path, None, ' '.join(top), False, top, detections, None, 'header')
+            stage = 'full'
+
+        raw_output_path, sorted_output_path, straighten, lines = vietocr_regions(
+            regions, img_name_no_ext, self._result_folder('ocr_in_csv'), config=self.ocr_config,
+            detector=self.recognizer, batch_size=self.ocr_batch_size, bucket_width=self.ocr_bucket_width,
+            memo=self.ocr_memo, known=known)
+        if not straighten:
+            straighten = ''
+        is_valid = check_valid_predicted(straighten, self.fuzzy_valid)
+
+        return Result(image_path, sorted_output_path, straighten, is_valid, lines, detections, None, stage)
+
+    def _recognize_fields(self, image, image_path, detections):
+        """
+        _recognize() in field mode: only the regions of the card fields are read.
+        :param image: extracted-card image (RGB).
+        :param image_path: path to extracted-card image.
+        :param detections: Detections of the image.
+        :return: Result of the image, with its fields.
+        """
+        img_name_no_ext = os.path.splitext(os.path.basename(image_path))[0]
+        # with the cascade, the fields of an image whose header and title fail the validity check are not read
+        accept = partial(check_valid_predicted, fuzzy=self.fuzzy_valid) if self.cascade_lines else None
+        try:
+            with span('fields'):
+                fields, lines, num_read = extract_fields(image, detections, self.ocr_config, self.recognizer,
+                                                         self.ocr_batch_size, self.ocr_bucket_width, self.ocr_memo,
+                                                         accept=accept)
+        except Exception as e:
+            logger.error('Cannot extract fields from %s: %s', image_path, e)
+            inc('failures_total', stage='fields')
+            return Result(image_path, None, '', False, [], detections, {})
+        if fields is None:
+            return Result(image_path, None, ' '.join(lines), False, lines, detections, None, 'header')
+
+        output_path = None
+        if self.result_path is not None:
+            output_path = save_fields(fields, img_name_no_ext, self._result_folder('ocr_in_csv'))
+        straighten = ' '.join(lines)
+        is_valid = check_valid_predicted(straighten, self.fuzzy_valid)
+
+        return Result(image_path, output_path, straighten, is_valid, lines, detections, fields,
+                      'full' if self.cascade_lines else None)
+
+    def process(self, image_path):
+        """
+        Run detection, cropping, OCR and validity checking for a single image.
+        :param image_path: path to extracted-card image.
+        :return: Result(image_path, output_path, straighten, is_valid, lines, detections),
+        output_path is the sorted result CSV, lines are the sorted OCR lines and detections are the CRAFT text regions.
+        """
+        key, cached = self._lookup_path(image_path)
+        if cached is not None:
+            return cached
+
+        image = self._load_image(image_path)
+        if image is None:
+            return Result(image_path, None, '', False, [], Detections())
+
+        if self.canvas_tiers is not None:
+            detections = self._detect_batch([image], [image_path])[0]
+        else:
+            detections = detect_text_regions(image, image_path, self.net, self.refine_net,
+                                             self._result_folder('craft_text_regions'), self.artifact_level,
+                                             self._writer())
+
+        result = self._recognize(image, image_path, detections)
+        self._store(key, result)
+        return result
+
+    def process_batch(self, image_paths):
+        """
+        process() for many images, running CRAFT on batches of images of the same canvas shape.
+        :param image_paths: list of paths to extracted-card images.
+        :return: list of Result, in the same order as image_paths.
+        """
+        lookups = [self._lookup_path(image_path) for image_path in image_paths]
+        misses = [index for index, (key, cached) in enumerate(lookups) if cached is None]
+
+        results = [cached for key, cached in lookups]
+        miss_results = self.process_images([self._load_image(image_paths[index]) for index in misses],
+                                           [image_paths[index] for index in misses],
+                                           [lookups[index][0] for index in misses])
+        for index, result in zip(misses, miss_results):
+            results[index] = result
+
+        return results
+
+    def process_images(self, images, image_paths, cache_keys=None):
+        """
+        process_batch() for images already in memory.
+        :param images: list of extracted-card images (RGB), None for an image that could not be read.
+        :param image_paths: list of paths (or names) of the images, used to name their results.
+        :param cache_keys: list of cache keys from lookup_cached(), the results are stored in the cache under these keys.
+        :return: list of Result, in the same order as images.
+        """
+        loaded = [index for index, image in enumerate(images) if image is not None]
+
+        all_detections = self._detect_batch([images[index] for index in loaded],
+                                            [image_paths[index] for index in loaded])
+
+        results = [Result(image_path, None, '', False, [], Detections()) for image_path in image_paths]
+        for index, detections in zip(loaded, all_detections):
+            results[index] = self._recognize(images[index], image_paths[index], detections)
+            if cache_keys is not None:
+                self._store(cache_keys[index], results[index])
+
+        return results
+
+    def extract(self, image_paths, queue_size=4, decode_threads=2, max_in_flight=16):
+        """
+        Stream many images through the session, reading, detection and recognition running concurrently.
+        See exe.streaming.extract().
+        :param image_paths: iterable of paths to extracted-card images.
+        :param queue_size: capacity of every queue between two stages.
+        :param decode_threads: number of threads reading images from disk.
+        :param max_in_flight: maximum number of images read but not yielded yet.
+        :return: generator of Result, in the same order as image_paths.
+        """
+        # imported here, exe.streaming imports this module
+        from exe.streaming import extract
+        return extract(self, image_paths, queue_size, decode_threads, max_in_flight)
@@ -0,0 +1,162 @@
+import copy
+import hashlib
+import logging
+import os
+import cv2
+import torch
+from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from exe.craft_text_regions_coordinates import craft_constants
+from models.craft import imgproc
+
+logger = logging.getLogger(__name__)
+
+# float32: the original models
+# int8 (VietOCR): dynamic quantization of the GRU/LSTM and Linear layers, the VGG backbone stays in float32
+# bf16 (CRAFT): weights and activations in bfloat16
+# int8 (CRAFT): static quantization of CRAFT and the refiner, calibrated on sample images
+OCR_PRECISIONS = ('float32', 'int8')
+CRAFT_PRECISIONS = ('float32', 'bf16', 'int8')
+
+
+class BFloat16Module(torch.nn.Module):
+    """
+    Run a float32 module in bfloat16: its weights are cast once, its inputs are cast on every call and its
+    outputs are cast back to float32, so the callers see no change of dtype.
+    """
+
+    def __init__(self, module):
+        """
+        :param module: float32 module (left unchanged, a copy is cast).
+        """
+        super().__init__()
+        self.module = copy.deepcopy(module).to(torch.bfloat16)
+
+    def forward(self, *inputs):
+        outputs = self.module(*[x.to(torch.bfloat16) for x in inputs])
+        if isinstance(outputs, tuple):
+            return tuple(output.float() for output in outputs)
+        return outputs.float()
+
+
+def state_fingerprint(*modules):
+    """
+    :param modules: float32 modules (None are skipped).
+    :return: sha256 of their weights, of the torch version and of the quantization engine, naming the files
+    of their quantized versions.
+    """
+    digest = hashlib.sha256('{} {}'.format(torch.__version__, torch.backends.quantized.engine).encode('utf-8'))
+    for module in modules:
+        if module is None:
+            continue
+        for name, tensor in module.state_dict().items():
+            digest.update(name.encode('utf-8'))
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def quantize_recognizer(detector):
+    """
+    :param detector: VietOCR Predictor (left unchanged, it may be shared through get_predictor()).
+    :return: a copy of the Predictor whose GRU/LSTM and Linear layers run in dynamic int8.
+    """
+    quantized = copy.copy(detector)
+    quantized.model = quantize_dynamic(detector.model, {torch.nn.GRU, torch.nn.LSTM, torch.nn.Linear},
+                                       dtype=torch.qint8)
+    return quantized
+
+
+def calibration_input(image):
+    """
+    :param image: extracted-card image (RGB).
+    :return: CRAFT input tensor of the image, prepared as test_net() does.
+    """
+    (text_threshold, low_text, link_threshold,
+     cuda, canvas_size, mag_ratio, poly,
+     show_time, refine, trained_model, pretrained_weight_url, refiner_model, refiner_weight_url) = craft_constants()
+
+    img_resized, target_ratio, size_heatmap = imgproc.resize_aspect_ratio(image, canvas_size,
+                                                                          interpolation=cv2.INTER_LINEAR,
+                                                                          mag_ratio=mag_ratio)
+    x = imgproc.normalizeMeanVariance(img_resized)
+    return torch.from_numpy(x).permute(2, 0, 1).unsqueeze(0)
+
+
+def quantize_craft(net, refine_net, images=None, cache_path='weights/craft/quantized'):
+    """
+    Static int8 quantization of CRAFT and the refiner (FX graph mode). Calibration runs the models over images,
+    then the quantized weights are written to cache_path, so later sessions load them without calibrating.
+    The file is named after the float weights (see state_fingerprint()): remove it to calibrate again.
+    :param net: CRAFT net (float32, left unchanged).
+    :param refine_net: RefineNet (float32, left unchanged), None if the refiner is disabled.
+    :param images: list of extracted-card images (RGB) for the calibration, only used if there is no cached file.
+    :param cache_path: path to the folder of the quantized weight files. Nothing is cached if it is None.
+    :return: quantized CRAFT net, quantized RefineNet (None if refine_net is None).
+    """
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    # the graphs are traced on a small input, the quantized models accept any input size
+    x = torch.zeros(1, 3, 64, 64)
+    with torch.no_grad():
+        y, feature = net(x)
+    prepared_net = prepare_fx(copy.deepcopy(net), qconfig_mapping, (x,))
+    prepared_refine_net = None
+    if refine_net is not None:
+        prepared_refine_net = prepare_fx(copy.deepcopy(refine_net), qconfig_mapping, (y, feature))
+
+    quantized_path = None
+    if cache_path is not None:
+        quantized_path = os.path.join(cache_path, 'craft_int8_{}.pth'.format(state_fingerprint(net, refine_net)[:16]))
+
+    if quantized_path is not None and os.path.exists(quantized_path):
+        logger.info('Loading quantized CRAFT from %s', quantized_path)
+        state = torch.load(quantized_path, map_location='cpu', weights_only=True)
+        quantized_net = convert_fx(prepared_net)
+        quantized_net.load_state_dict(state['net'])
+        quantized_refine_net = None
+        if prepared_refine_net is not None:
+            quantized_refine_net = convert_fx(prepared_refine_net)
+            quantized_refine_net.load_state_dict(state['refine_net'])
+        return quantized_net, quantized_refine_net
+
+    if not images:
+        raise ValueError('Calibration images are required to quantize CRAFT to int8')
+    logger.info('Calibrating quantized CRAFT on %d images', len(images))
+    with torch.no_grad():
+        for image in images:
+            y, feature = prepared_net(calibration_input(image))
+            if prepared_refine_net is not None:
+                prepared_refine_net(y, feature)
+
+    quantized_net = convert_fx(prepared_net)
+    quantized_refine_net = convert_fx(prepared_refine_net) if prepared_refine_net is not None else None
+
+    if quantized_path is not None:
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+        state = {'net': quantized_net.state_dict(),
+                 'refine_net': quantized_refine_net.state_dict() if quantized_refine_net is not None else None}
+        # write then rename, so a crash never leaves a half-written file
+        temp_path = '{}.{}.tmp'.format(quantized_path, os.getpid())
+        torch.save(state, temp_path)
+        os.replace(temp_path, quantized_path)
+        logger.info('Quantized CRAFT saved at %s', quantized_path)
+
+    return quantized_net, quantized_refine_net
+
+
+def convert_craft(net, refine_net, precision='float32', images=None, cache_path='weights/craft/quantized'):
+    """
+    :param net: CRAFT net (float32).
+    :param refine_net: RefineNet (float32), None if the refiner is disabled.
+    :param precision: one of CRAFT_PRECISIONS.
+    :param images: list of extracted-card images (RGB) calibrating the int8 models (see quantize_craft()).
+    :param cache_path: path to the folder of the quantized weight files.
+    :return: CRAFT net, RefineNet (None if refine_net is None) running in precision.
+    """
+    if precision not in CRAFT_PRECISIONS:
+        raise ValueError('precision must be one of {}, got {}'.format(CRAFT_PRECISIONS, precision))
+    if precision == 'bf16':
+        return BFloat16Module(net), BFloat16Module(refine_net) if refine_net is not None else None
+    if precision == 'int8':
+        return quantize_craft(net, refine_net, images, cache_path)
+    return net, refine_net
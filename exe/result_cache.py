@@ -0,0 +1,179 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from exe.craft_text_regions_coordinates import craft_constants
+from models.craft.detections import Detections
+from models.vietocr.utils import config_key
+
+# Bumped when the layout of the cache entries changes
+_CACHE_VERSION = 3
+
+
+def pipeline_fingerprint(ocr_config, **settings):
+    """
+    :param ocr_config: config of the VietOCR Predictor.
+    :param settings: the other pipeline settings a result depends on (field mode, cascade, precisions...).
+    :return: A string identifying the models and settings a result depends on: the CRAFT constants
+    (thresholds, canvas size, weight files), the VietOCR config and the pipeline settings.
+    """
+    return json.dumps([_CACHE_VERSION, list(craft_constants()), config_key(ocr_config), settings], sort_keys=True)
+
+
+class ResultCache:
+    """
+    Content-addressed on-disk cache of the pipeline results.
+    An entry is keyed by the sha256 of the image file bytes and of the pipeline fingerprint, so the same image
+    processed with other models or thresholds is a miss. Entries are single JSON files holding the detections,
+    the sorted OCR lines, the straighten string, the validity verdict, the fields (in field mode), the
+    cascade stage and the canvas size (in the adaptive canvas mode).
+    When the cache grows over max_size bytes, the least recently used entries are removed.
+    """
+
+    def __init__(self, path='result/cache', max_size=512 * 1024 * 1024, fingerprint=''):
+        """
+        :param path: path to the cache folder.
+        :param max_size: maximum total size (in bytes) of the cache entries.
+        :param fingerprint: pipeline fingerprint, see pipeline_fingerprint().
+        """
+        self.path = path
+        self.max_size = max_size
+        self.fingerprint = fingerprint.encode('utf-8')
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # key -> (size, last use time), rebuilt from the entry files so the cache survives restarts
+        self._entries = {}
+        for entry in os.scandir(path):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                self._entries[entry.name[:-5]] = (stat.st_size, stat.st_mtime)
+        self._size = sum(size for size, _ in self._entries.values())
+
+    def __getstate__(self):
+        # the lock cannot be pickled (spawned worker processes), every copy gets its own
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def key(self, data):
+        """
+        :param data: bytes of an image file.
+        :return: the cache key of the image.
+        """
+        return hashlib.sha256(self.fingerprint + b'\0' + data).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key):
+        """
+        :param key: cache key from key().
+        :return: dict of the cached result (straighten, lines, is_valid, detections, fields, stage, canvas),
+        None on a miss.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            try:
+                with open(self._entry_path(key), encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                # removed or broken behind our back
+                self._forget(key)
+                self.misses += 1
+                return None
+            now = time.time()
+            self._entries[key] = (self._entries[key][0], now)
+            try:
+                os.utime(self._entry_path(key), (now, now))
+            except OSError:
+                # evicted by another process since it was read
+                pass
+            self.hits += 1
+
+        return {'straighten': entry['straighten'],
+                'lines': entry['lines'],
+                'is_valid': entry['is_valid'],
+                'detections': Detections.from_bytes(base64.b64decode(entry['detections'])),
+                'fields': entry.get('fields'),
+                'stage': entry.get('stage'),
+                'canvas': entry.get('canvas')}
+
+    def put(self, key, straighten, lines, is_valid, detections, fields=None, stage=None, canvas=None):
+        """
+        Store a result, then evict the least recently used entries if the cache is over its size.
+        :param key: cache key from key().
+        :param straighten: straighten string.
+        :param lines: sorted OCR lines.
+        :param is_valid: validity verdict.
+        :param detections: Detections of the image.
+        :param fields: dict of the structured fields (field mode only).
+        :param stage: cascade stage the image was decided at (cascade only).
+        :param canvas: canvas size the image was detected at (adaptive canvas only).
+        """
+        data = json.dumps({'straighten': straighten,
+                           'lines': list(lines),
+                           'is_valid': bool(is_valid),
+                           'detections': base64.b64encode(detections.to_bytes()).decode('ascii'),
+                           'fields': fields,
+                           'stage': stage,
+                           'canvas': canvas},
+                          ensure_ascii=False).encode('utf-8')
+        entry_path = self._entry_path(key)
+        # unique per process and thread, as worker processes may store the same image at the same time
+        temp_path = '{}.{}.{}.tmp'.format(entry_path, os.getpid(), threading.get_ident())
+        # write then rename, so a crash never leaves a half-written entry
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, entry_path)
+
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = (len(data), time.time())
+            self._size += len(data)
+            if self._size > self.max_size:
+                for old_key, _ in sorted(self._entries.items(), key=lambda item: item[1][1]):
+                    if self._size <= self.max_size:
+                        break
+                    self._forget(old_key)
+                    try:
+                        os.remove(self._entry_path(old_key))
+                    except OSError:
+                        pass
+
+    def _forget(self, key):
+        size, _ = self._entries.pop(key, (0, 0))
+        self._size -= size
+
+    def stats(self):
+        """
+        :return: dict of the hit and miss counters, the number of entries and their total size (in bytes).
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'size': self._size}
+
+    def clear(self):
+        """
+        Remove every entry and reset the counters.
+        """
+        with self._lock:
+            for key in self._entries:
+                try:
+                    os.remove(self._entry_path(key))
+                except OSError:
+                    pass
+            self._entries = {}
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
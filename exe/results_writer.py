@@ -0,0 +1,104 @@
+import csv
+import json
+import logging
+import os
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ['files_path', 'strings', 'is_valid']
+
+
+class ResultsWriter:
+    """
+    Append-only sink for the per-image results of a folder run.
+    Every image adds one record (a CSV row or a JSON line, which also holds the fields, the cascade stage and the
+    canvas) to a single file, so memory and I/O stay constant per image whatever the number of images.
+    The file is flushed to disk every flush_every records and when the writer is closed, so a crash loses at most
+    the records written since the last flush.
+    """
+
+    def __init__(self, path, flush_every=100, parquet=False):
+        """
+        :param path: path to the output file, its extension (.csv or .jsonl) chooses the format.
+        :param flush_every: number of records between two flushes to disk.
+        :param parquet: also convert the results to a Parquet file (next to path) when the writer is closed.
+        """
+        self.path = path
+        self.format = 'jsonl' if os.path.splitext(path)[1].lower() in ('.jsonl', '.json') else 'csv'
+        self.flush_every = max(1, flush_every)
+        self.parquet = parquet
+        self.count = 0
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._file = open(path, 'w', newline='', encoding='utf-8')
+        if self.format == 'csv':
+            self._csv = csv.writer(self._file)
+            # same layout as a DataFrame.to_csv() with its index
+            self._csv.writerow([''] + COLUMNS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, result):
+        """
+        Append the record of an image.
+        :param result: Result of the image.
+        """
+        record = [result.image_path, result.straighten, bool(result.is_valid)]
+        if self.format == 'csv':
+            self._csv.writerow([self.count] + record)
+        else:
+            record = dict(zip(COLUMNS, record))
+            if result.fields is not None:
+                record['fields'] = result.fields
+            if result.stage is not None:
+                record['stage'] = result.stage
+            if result.canvas is not None:
+                record['canvas'] = result.canvas
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered records to disk.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """
+        Flush and close the file, then write the Parquet file if asked.
+        :return: path to the Parquet file, None if it is not written.
+        """
+        if self._file.closed:
+            return None
+        self.flush()
+        self._file.close()
+        if self.parquet:
+            return self.to_parquet()
+        return None
+
+    def to_parquet(self):
+        """
+        Convert the written results to a Parquet file next to the results file.
+        :return: path to the Parquet file, None if it cannot be written.
+        """
+        parquet_path = os.path.splitext(self.path)[0] + '.parquet'
+        try:
+            if self.format == 'csv':
+                results = pd.read_csv(self.path, index_col=0, keep_default_na=False)
+            else:
+                results = pd.read_json(self.path, lines=True)
+            results.to_parquet(parquet_path)
+            return parquet_path
+        except ImportError as e:
+            logger.error('Cannot write Parquet file, pyarrow (or fastparquet) is required: %s', e)
+            return None
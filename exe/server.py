@@ -0,0 +1,355 @@
+import asyncio
+import io
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import urlsplit, parse_qs
+from exe.telemetry import METRICS, inc
+from models.craft import imgproc
+
+logger = logging.getLogger(__name__)
+
+_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 411: 'Length Required',
+            413: 'Payload Too Large', 431: 'Request Header Fields Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class _HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def decode_image(data):
+    """
+    :param data: bytes of an encoded image file.
+    :return: the image (RGB), None if it cannot be decoded.
+    """
+    try:
+        return imgproc.loadImage(io.BytesIO(data))
+    except Exception as e:
+        logger.error('Cannot decode uploaded image: %s', e)
+        inc('failures_total', stage='decode')
+        return None
+
+
+def parse_upload(content_type, body, default_name='upload'):
+    """
+    Get the uploaded image from a request body, either the raw image bytes or the first file of a
+    multipart/form-data body.
+    :param content_type: value of the Content-Type header.
+    :param body: bytes of the request body.
+    :param default_name: image name used when the upload does not carry a file name.
+    :return: image name, image bytes.
+    """
+    if not content_type.lower().startswith('multipart/form-data'):
+        return default_name, body
+
+    message = BytesParser(policy=HTTP).parsebytes(b'Content-Type: ' + content_type.encode('latin-1')
+                                                  + b'\r\n\r\n' + body)
+    for part in message.iter_parts():
+        data = part.get_payload(decode=True)
+        if data:
+            return part.get_filename() or default_name, data
+    raise _HTTPError(400, 'No file in the multipart body')
+
+
+def result_to_dict(result):
+    """
+    :param result: Result of an image.
+    :return: JSON-serializable dict of the result.
+    """
+    payload = {'name': result.image_path,
+               'straighten': result.straighten,
+               'lines': list(result.lines),
+               'is_valid': bool(result.is_valid),
+               'num_regions': len(result.detections)}
+    if result.fields is not None:
+        payload['fields'] = result.fields
+    if result.stage is not None:
+        payload['stage'] = result.stage
+    if result.canvas is not None:
+        payload['canvas'] = result.canvas
+    return payload
+
+
+class ExtractionServer:
+    """
+    Asyncio HTTP server keeping a pipeline warm.
+    Concurrent uploads are gathered into micro-batches: the first waiting upload opens a window of batch_window
+    seconds, and every upload arriving within the window (up to max_batch_size) runs in the same CRAFT and VietOCR
+    forward passes. The models run in a single background thread, so the event loop keeps accepting uploads
+    while a batch is being processed.
+
+    POST /extract: body is the image file (raw, or multipart/form-data), an optional ?name= names the image.
+    Returns {"name", "straighten", "lines", "is_valid", "num_regions"} as JSON, "fields" in field mode,
+    "stage" with the cascade and "canvas" in the adaptive canvas mode.
+    GET /health: returns {"status": "ok"}, with the counters of the result cache if the pipeline has one.
+    GET /metrics: returns the metrics of exe/telemetry.py in the Prometheus text format (as JSON with ?format=json).
+    """
+
+    def __init__(self, pipeline, host='127.0.0.1', port=8000, batch_window=0.01, max_batch_size=8,
+                 max_pending=64, max_body_size=20 * 1024 * 1024, keep_alive_timeout=15, max_headers=100):
+        """
+        :param pipeline: loaded Pipeline.
+        :param host: address to listen on.
+        :param port: port to listen on (0 picks a free port).
+        :param batch_window: seconds to wait for more uploads once the first upload of a batch arrived.
+        :param max_batch_size: maximum number of images per batch.
+        :param max_pending: maximum number of uploads waiting for a batch, further uploads get a 503.
+        :param max_body_size: maximum size (in bytes) of a request body.
+        :param keep_alive_timeout: seconds an idle connection is kept open.
+        :param max_headers: maximum number of header lines of a request. A longer line than the stream limit
+        of asyncio (64 KiB) or more lines get a 431.
+        """
+        self.pipeline = pipeline
+        self.host = host
+        self.port = port
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.max_pending = max_pending
+        self.max_body_size = max_body_size
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_headers = max_headers
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        self._batcher = None
+        self._server = None
+
+    async def start(self):
+        """
+        Start listening and batching.
+        :return: (host, port) the server listens on.
+        """
+        self._pending = asyncio.Queue(self.max_pending)
+        self._batcher = asyncio.ensure_future(self._run_batches())
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        """
+        Stop listening and batching.
+        """
+        self._server.close()
+        await self._server.wait_closed()
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+
+    async def serve_forever(self):
+        """
+        Start the server and serve until cancelled.
+        """
+        host, port = await self.start()
+        logger.info('Serving on http://%s:%s', host, port)
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def extract(self, name, data):
+        """
+        Queue an uploaded image for the next batch.
+        :param name: image name.
+        :param data: bytes of the image file.
+        :return: Result of the image.
+        """
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._pending.put_nowait((name, data, future))
+        except asyncio.QueueFull:
+            raise _HTTPError(503, 'Too many pending images')
+        return await future
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._pending.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._pending.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await loop.run_in_executor(self._executor, self._process,
+                                                     [(name, data) for name, data, _ in batch])
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _process(self, uploads):
+        """
+        :param uploads: list of (image name, image bytes).
+        :return: list of Result, None for an image that cannot be decoded.
+        """
+        start = time.time()
+        lookups = [self.pipeline.lookup_cached(data, name) for name, data in uploads]
+        results = [cached for _, cached in lookups]
+        misses = [index for index, (_, cached) in enumerate(lookups) if cached is None]
+
+        images = [decode_image(uploads[index][1]) for index in misses]
+        miss_results = self.pipeline.process_images(images, [uploads[index][0] for index in misses],
+                                                    [lookups[index][0] for index in misses])
+        for index, image, result in zip(misses, images, miss_results):
+            results[index] = result if image is not None else None
+
+        logger.debug('Batch of %d images processed in %.3f seconds', len(uploads), time.time() - start)
+        return results
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keep_alive_timeout)
+                except (asyncio.TimeoutError, ValueError):
+                    # idle, or a request line over the stream limit
+                    break
+                if not request_line.strip():
+                    break
+                keep_alive = await self._handle_request(request_line, reader, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, request_line, reader, writer):
+        """
+        Read one request and write its response.
+        :return: True if the connection is kept open.
+        """
+        keep_alive = False
+        path = None
+        try:
+            try:
+                method, target, version = request_line.decode('latin-1').split()
+            except ValueError:
+                raise _HTTPError(400, 'Malformed request line')
+            path = urlsplit(target).path
+
+            headers = {}
+            num_headers = 0
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # over the stream limit, the rest of the line cannot be skipped reliably
+                    keep_alive = False
+                    raise _HTTPError(431, 'Header line too long')
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                num_headers += 1
+                if num_headers > self.max_headers:
+                    keep_alive = False
+                    raise _HTTPError(431, 'More than {} headers'.format(self.max_headers))
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            connection = headers.get('connection', '').lower()
+            keep_alive = connection == 'keep-alive' or (version == 'HTTP/1.1' and connection != 'close')
+
+            body = b''
+            if 'content-length' in headers:
+                try:
+                    length = int(headers['content-length'])
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    # the body cannot be skipped, so the next request on this connection cannot be found
+                    keep_alive = False
+                    raise _HTTPError(400, 'Invalid Content-Length')
+                if length > self.max_body_size:
+                    keep_alive = False
+                    raise _HTTPError(413, 'Body larger than {} bytes'.format(self.max_body_size))
+                body = await reader.readexactly(length)
+            elif 'transfer-encoding' in headers:
+                keep_alive = False
+                raise _HTTPError(411, 'Content-Length is required')
+
+            status, payload = await self._route(method, target, headers, body)
+        except _HTTPError as e:
+            status, payload = e.status, {'error': str(e)}
+        except asyncio.IncompleteReadError:
+            raise
+        except Exception as e:
+            status, payload = 500, {'error': str(e)}
+
+        # only the known paths are labels, so unknown paths cannot grow the number of series
+        inc('http_requests_total', path=path if path in ('/extract', '/health', '/metrics') else 'other',
+            status=status)
+        content_type = 'application/json; charset=utf-8'
+        if isinstance(payload, str):
+            data = payload.encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.
+                     format(status, _reasons.get(status, ''), content_type, len(data),
+                            'keep-alive' if keep_alive else 'close').encode('latin-1') + data)
+        return keep_alive
+
+    async def _route(self, method, target, headers, body):
+        """
+        :return: HTTP status, JSON-serializable payload (or text payload, sent as text/plain).
+        """
+        url = urlsplit(target)
+        if url.path == '/metrics':
+            if method != 'GET':
+                raise _HTTPError(405, 'Use GET')
+            if parse_qs(url.query).get('format', ['prometheus'])[0] == 'json':
+                return 200, METRICS.snapshot()
+            return 200, METRICS.to_prometheus()
+
+        if url.path == '/health':
+            if method != 'GET':
+                raise _HTTPError(405, 'Use GET')
+            payload = {'status': 'ok'}
+            if self.pipeline.cache is not None:
+                payload['cache'] = self.pipeline.cache.stats()
+            return 200, payload
+
+        if url.path == '/extract':
+            if method != 'POST':
+                raise _HTTPError(405, 'Use POST')
+            if not body:
+                raise _HTTPError(400, 'Empty body')
+            default_name = parse_qs(url.query).get('name', ['upload'])[0]
+            name, data = parse_upload(headers.get('content-type', ''), body, default_name)
+            result = await self.extract(os.path.basename(name), data)
+            if result is None:
+                raise _HTTPError(400, 'Cannot decode image')
+            return 200, result_to_dict(result)
+
+        raise _HTTPError(404, 'Unknown path {}'.format(url.path))
+
+
+def serve(pipeline, host='127.0.0.1', port=8000, batch_window=0.01, max_batch_size=8):
+    """
+    Run the HTTP server until interrupted. See ExtractionServer.
+    :param pipeline: loaded Pipeline.
+    :param host: address to listen on.
+    :param port: port to listen on.
+    :param batch_window: seconds to wait for more uploads once the first upload of a batch arrived.
+    :param max_batch_size: maximum number of images per batch.
+    """
+    server = ExtractionServer(pipeline, host, port, batch_window, max_batch_size)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
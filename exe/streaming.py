@@ -0,0 +1,217 @@
+import queue
+import threading
+from exe.pipeline import Result
+from models.craft.detections import Detections
+
+# Marks the end of the stream in a stage queue
+_END = object()
+
+
+class _Stream:
+    """
+    State shared by the stage threads of one extract() call.
+    """
+
+    def __init__(self, max_in_flight):
+        """
+        :param max_in_flight: maximum number of images between reading and being yielded.
+        """
+        self.stop = threading.Event()
+        self.slots = threading.Semaphore(max_in_flight)
+        self.error = None
+
+    def put(self, stage_queue, item):
+        """
+        Put an item into a bounded queue, giving up if the stream is stopped.
+        :param stage_queue: queue of the next stage.
+        :param item: item to put.
+        :return: False if the stream is stopped.
+        """
+        while not self.stop.is_set():
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, stage_queue):
+        """
+        Get an item from a queue, giving up if the stream is stopped.
+        :param stage_queue: queue of the current stage.
+        :return: the item, _END if the stream is stopped.
+        """
+        while not self.stop.is_set():
+            try:
+                return stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END
+
+    def fail(self, error):
+        """
+        Stop the stream because a stage failed, the error is raised again by extract().
+        :param error: the exception of the failed stage.
+        """
+        if self.error is None:
+            self.error = error
+        self.stop.set()
+
+
+def _read(stream, image_paths, path_queue, decode_threads):
+    """
+    Feed the image paths to the decode threads, never letting more than max_in_flight images into the stream.
+    """
+    try:
+        for index, image_path in enumerate(image_paths):
+            # wait for a free slot, released when a result is yielded
+            while not stream.slots.acquire(timeout=0.1):
+                if stream.stop.is_set():
+                    return
+            if not stream.put(path_queue, (index, image_path)):
+                return
+        for _ in range(decode_threads):
+            stream.put(path_queue, _END)
+    except Exception as e:
+        # e.g. raised by a generator of image paths
+        stream.fail(e)
+
+
+def _decode(stream, pipeline, path_queue, image_queue, finished):
+    """
+    Read images from disk, unless their result is in the cache.
+    The last decode thread to finish ends the stream of the detection stage.
+    """
+    try:
+        while True:
+            item = stream.get(path_queue)
+            if item is _END:
+                break
+            index, image_path = item
+            key, cached = pipeline._lookup_path(image_path)
+            image = pipeline._load_image(image_path) if cached is None else None
+            if not stream.put(image_queue, (index, image_path, image, key, cached)):
+                return
+    except Exception as e:
+        stream.fail(e)
+        return
+
+    with finished['lock']:
+        finished['count'] += 1
+        last = finished['count'] == finished['total']
+    if last:
+        stream.put(image_queue, _END)
+
+
+def _detect(stream, pipeline, image_queue, detection_queue):
+    """
+    Run CRAFT on the decoded images, batching the images that are already waiting in the queue.
+    Cached and unreadable images are passed through.
+    """
+    try:
+        end = False
+        while not end:
+            item = stream.get(image_queue)
+            if item is _END:
+                break
+            batch = [item]
+            while len(batch) < pipeline.detection_batch_size:
+                try:
+                    item = image_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _END:
+                    end = True
+                    break
+                batch.append(item)
+
+            loaded = [(index, image_path, image) for index, image_path, image, _, _ in batch if image is not None]
+            all_detections = pipeline._detect_batch([image for _, _, image in loaded],
+                                                    [image_path for _, image_path, _ in loaded])
+            detections_of = {index: detections for (index, _, _), detections in zip(loaded, all_detections)}
+
+            for index, image_path, image, key, cached in batch:
+                item = (index, image_path, image, detections_of.get(index), key, cached)
+                if not stream.put(detection_queue, item):
+                    return
+        stream.put(detection_queue, _END)
+    except Exception as e:
+        stream.fail(e)
+
+
+def _recognize(stream, pipeline, detection_queue, result_queue):
+    """
+    Run cropping, OCR, sorting and validity checking on the detected images.
+    """
+    try:
+        while True:
+            item = stream.get(detection_queue)
+            if item is _END:
+                break
+            index, image_path, image, detections, key, cached = item
+            if cached is not None:
+                result = cached
+            elif image is None:
+                result = Result(image_path, None, '', False, [], Detections())
+            else:
+                result = pipeline._recognize(image, image_path, detections)
+                pipeline._store(key, result)
+            if not stream.put(result_queue, (index, result)):
+                return
+        stream.put(result_queue, _END)
+    except Exception as e:
+        stream.fail(e)
+
+
+def extract(pipeline, image_paths, queue_size=4, decode_threads=2, max_in_flight=16):
+    """
+    Stream images through the pipeline, with the stages running concurrently in their own threads:
+    decode threads read the next images while CRAFT detects text regions on the previous ones
+    and VietOCR reads the regions of the ones before. The stages are connected by bounded queues
+    and at most max_in_flight images are in the stream at once, so memory stays bounded
+    whatever the number of images.
+    :param pipeline: loaded Pipeline.
+    :param image_paths: iterable of paths to extracted-card images, it is consumed lazily.
+    :param queue_size: capacity of every queue between two stages.
+    :param decode_threads: number of threads reading images from disk.
+    :param max_in_flight: maximum number of images read but not yielded yet.
+    :return: generator of Result, in the same order as image_paths.
+    """
+    stream = _Stream(max_in_flight)
+    path_queue = queue.Queue(queue_size)
+    image_queue = queue.Queue(queue_size)
+    detection_queue = queue.Queue(queue_size)
+    result_queue = queue.Queue(queue_size)
+    finished = {'lock': threading.Lock(), 'count': 0, 'total': decode_threads}
+
+    threads = [threading.Thread(target=_read, args=(stream, image_paths, path_queue, decode_threads))]
+    threads += [threading.Thread(target=_decode, args=(stream, pipeline, path_queue, image_queue, finished))
+                for _ in range(decode_threads)]
+    threads.append(threading.Thread(target=_detect, args=(stream, pipeline, image_queue, detection_queue)))
+    threads.append(threading.Thread(target=_recognize, args=(stream, pipeline, detection_queue, result_queue)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # results come out of order when decode threads overtake each other, they are held until their turn
+    pending = {}
+    next_index = 0
+    try:
+        while True:
+            item = stream.get(result_queue)
+            if item is _END:
+                break
+            index, result = item
+            pending[index] = result
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+                stream.slots.release()
+    finally:
+        # also reached when the caller stops iterating early
+        stream.stop.set()
+        for thread in threads:
+            thread.join()
+
+    if stream.error is not None:
+        raise stream.error
@@ -0,0 +1,285 @@
+"""
+Instrumentation of the pipeline: timing spans of the stages, counters and histograms, exported as Prometheus text
+or JSON. Every module records into the METRICS registry of its process, worker processes send theirs back to the
+parent (see exe/parallel.py).
+
+> python run_this_main.py --folder data --metrics result/metrics.prom
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the exported metric names
+NAMESPACE = 'idcard'
+
+# Upper bounds (in seconds) of the buckets of the stage durations
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Upper bounds of the buckets of the number of text regions of an image
+REGION_BUCKETS = (0, 5, 10, 15, 20, 25, 30, 40, 60, 100)
+
+# Help texts of the exported metrics
+DESCRIPTIONS = {
+    'stage_seconds': 'Duration of a pipeline stage call (decode, detect, crop, ocr, sort, fields).',
+    'regions_per_image': 'Number of text regions detected in an image.',
+    'images_total': 'Images recognized, by validity.',
+    'ocr_regions_total': 'Text regions sent to VietOCR.',
+    'cache_lookups_total': 'Result cache lookups, by result (hit or miss).',
+    'failures_total': 'Failed stage calls, by stage.',
+    'cascade_rejections_total': 'Images rejected by the cascade, by stage.',
+    'canvas_selected_total': 'Images detected at a canvas size, in the adaptive canvas mode.',
+    'canvas_escalations_total': 'Detections retried at a larger canvas, by the canvas size they left.',
+    'http_requests_total': 'HTTP requests of the server, by path and status.',
+}
+
+# Log levels of the --log-level option
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+# Loggers of this project (the loggers of its modules are named after them)
+_LOGGERS = ('exe', 'benchmarks', 'run_this_main')
+
+
+def _label_key(labels):
+    """
+    :param labels: dict of the labels of a series.
+    :return: hashable key of the series, the labels sorted by name.
+    """
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters and histograms, with labels.
+    A histogram keeps the count of every bucket, its sum and its count. The counts are made cumulative on export,
+    as Prometheus expects.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        """
+        :param name: counter name (ending in _total).
+        :param value: increment.
+        :param labels: labels of the series.
+        """
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        """
+        :param name: histogram name.
+        :param value: observed value.
+        :param buckets: increasing upper bounds of the buckets, fixed by the first observation of the histogram.
+        :param labels: labels of the series.
+        """
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = {'buckets': list(buckets), 'counts': [0] * (len(buckets) + 1),
+                                           'sum': 0.0, 'count': 0}
+            histogram['counts'][bisect.bisect_left(histogram['buckets'], value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """
+        Time the body of a with statement into the stage_seconds histogram, failures included.
+        :param stage: stage name.
+        :param labels: other labels of the series.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe('stage_seconds', elapsed, stage=stage, **labels)
+            logger.debug('%s: %.4fs', stage, elapsed)
+
+    def snapshot(self):
+        """
+        :return: JSON-serializable dict of every series: {'counters': {name: [{'labels', 'value'}]},
+        'histograms': {name: [{'labels', 'buckets', 'counts', 'sum', 'count'}]}}.
+        """
+        with self._lock:
+            return {'counters': {name: [{'labels': dict(key), 'value': value} for key, value in series.items()]
+                                 for name, series in self._counters.items()},
+                    'histograms': {name: [dict(histogram, labels=dict(key), buckets=list(histogram['buckets']),
+                                               counts=list(histogram['counts']))
+                                          for key, histogram in series.items()]
+                                   for name, series in self._histograms.items()}}
+
+    def merge(self, snapshot):
+        """
+        Add the series of a snapshot (e.g. of a worker process) to this registry.
+        :param snapshot: dict from snapshot().
+        """
+        with self._lock:
+            for name, entries in snapshot['counters'].items():
+                series = self._counters.setdefault(name, {})
+                for entry in entries:
+                    key = _label_key(entry['labels'])
+                    series[key] = series.get(key, 0) + entry['value']
+            for name, entries in snapshot['histograms'].items():
+                series = self._histograms.setdefault(name, {})
+                for entry in entries:
+                    key = _label_key(entry['labels'])
+                    histogram = series.get(key)
+                    if histogram is None:
+                        series[key] = {'buckets': list(entry['buckets']), 'counts': list(entry['counts']),
+                                       'sum': entry['sum'], 'count': entry['count']}
+                        continue
+                    if histogram['buckets'] != entry['buckets']:
+                        raise ValueError('Cannot merge the {} histograms, their buckets differ'.format(name))
+                    histogram['counts'] = [a + b for a, b in zip(histogram['counts'], entry['counts'])]
+                    histogram['sum'] += entry['sum']
+                    histogram['count'] += entry['count']
+
+    def reset(self):
+        """
+        Drop every series.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def drain(self):
+        """
+        :return: snapshot() of the registry, which is then reset (both at once).
+        """
+        with self._lock:
+            counters, histograms = self._counters, self._histograms
+            self._counters, self._histograms = {}, {}
+        drained = Metrics()
+        drained._counters, drained._histograms = counters, histograms
+        return drained.snapshot()
+
+    def to_prometheus(self, namespace=NAMESPACE):
+        """
+        :param namespace: prefix of the metric names.
+        :return: every series in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, entries in sorted(snapshot['counters'].items()):
+            full_name = '{}_{}'.format(namespace, name)
+            lines += _header(full_name, name, 'counter')
+            for entry in entries:
+                lines.append('{}{} {}'.format(full_name, _format_labels(entry['labels']),
+                                              _format_value(entry['value'])))
+        for name, entries in sorted(snapshot['histograms'].items()):
+            full_name = '{}_{}'.format(namespace, name)
+            lines += _header(full_name, name, 'histogram')
+            for entry in entries:
+                cumulative = 0
+                for bound, count in zip(entry['buckets'] + ['+Inf'], entry['counts']):
+                    cumulative += count
+                    labels = dict(entry['labels'], le=bound if bound == '+Inf' else _format_value(bound))
+                    lines.append('{}_bucket{} {}'.format(full_name, _format_labels(labels), cumulative))
+                lines.append('{}_sum{} {}'.format(full_name, _format_labels(entry['labels']),
+                                                  _format_value(entry['sum'])))
+                lines.append('{}_count{} {}'.format(full_name, _format_labels(entry['labels']), entry['count']))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        """
+        :return: snapshot() as a JSON string.
+        """
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def write(self, path):
+        """
+        Write every series to a file, as JSON if its extension is .json, in the Prometheus text format otherwise
+        (e.g. .prom for the textfile collector of the node exporter).
+        :param path: path to the output file.
+        """
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        text = self.to_json() if path.lower().endswith('.json') else self.to_prometheus()
+        # write then rename, so a scraper never reads a half-written file
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temp_path, path)
+
+
+def _header(full_name, name, metric_type):
+    """
+    :return: HELP and TYPE lines of a metric.
+    """
+    lines = []
+    if name in DESCRIPTIONS:
+        lines.append('# HELP {} {}'.format(full_name, DESCRIPTIONS[name]))
+    lines.append('# TYPE {} {}'.format(full_name, metric_type))
+    return lines
+
+
+def _format_labels(labels):
+    """
+    :param labels: dict of the labels of a series.
+    :return: {name="value",...} part of a series line, empty if there is no label.
+    """
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in sorted(labels.items()))
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    """
+    :return: value as a Prometheus sample value.
+    """
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Registry of this process
+METRICS = Metrics()
+
+
+def span(stage, **labels):
+    """
+    METRICS.span(): time the body of a with statement as a call of stage.
+    """
+    return METRICS.span(stage, **labels)
+
+
+def inc(name, value=1, **labels):
+    """
+    METRICS.inc(): increment a counter.
+    """
+    METRICS.inc(name, value, **labels)
+
+
+def observe(name, value, buckets=DURATION_BUCKETS, **labels):
+    """
+    METRICS.observe(): add a value to a histogram.
+    """
+    METRICS.observe(name, value, buckets, **labels)
+
+
+def configure_logging(level='INFO'):
+    """
+    Send the log records to the standard error, as plain messages. DEBUG only applies to the loggers of this
+    project, the libraries stay at INFO.
+    :param level: one of LOG_LEVELS.
+    """
+    if level not in LOG_LEVELS:
+        raise ValueError('level must be one of {}, got {}'.format(LOG_LEVELS, level))
+    logging.basicConfig(level=max(getattr(logging, level), logging.INFO), format='%(message)s')
+    for name in _LOGGERS:
+        logging.getLogger(name).setLevel(getattr(logging, level))
@@ -9,6 +9,8 @@ MIT License
 import numpy as np
 import cv2
 import math
+from concurrent.futures import ThreadPoolExecutor
+from scipy import ndimage
 
 """ auxilary functions """
 
@@ -22,10 +24,49 @@ def warpCoord(Minv, pt):
 """ end of auxilary functions """
 
 
-def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text):
-    # prepare data
-    linkmap = linkmap.copy()
-    textmap = textmap.copy()
+def _component_box(k, stats, labels, link_area, img_h, img_w):
+    # all the work of a component is done inside its dilation window
+    size = stats[k, cv2.CC_STAT_AREA]
+    x, y = stats[k, cv2.CC_STAT_LEFT], stats[k, cv2.CC_STAT_TOP]
+    w, h = stats[k, cv2.CC_STAT_WIDTH], stats[k, cv2.CC_STAT_HEIGHT]
+    niter = int(math.sqrt(size * min(w, h) / (w * h)) * 2)
+    sx, ex, sy, ey = x - niter, x + w + niter + 1, y - niter, y + h + niter + 1
+    # boundary check
+    if sx < 0: sx = 0
+    if sy < 0: sy = 0
+    if ex >= img_w: ex = img_w
+    if ey >= img_h: ey = img_h
+
+    # make segmentation map
+    segmap = np.zeros((ey - sy, ex - sx), dtype=np.uint8)
+    segmap[labels[sy:ey, sx:ex] == k] = 255
+    segmap[link_area[sy:ey, sx:ex]] = 0  # remove link area
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1 + niter, 1 + niter))
+    segmap = cv2.dilate(segmap, kernel)
+
+    # make box
+    ys, xs = np.where(segmap != 0)
+    np_contours = np.stack((xs + sx, ys + sy), axis=1)
+    rectangle = cv2.minAreaRect(np_contours)
+    box = cv2.boxPoints(rectangle)
+
+    # align diamond-shape
+    w, h = np.linalg.norm(box[0] - box[1]), np.linalg.norm(box[1] - box[2])
+    box_ratio = max(w, h) / (min(w, h) + 1e-5)
+    if abs(1 - box_ratio) <= 0.1:
+        l, r = np_contours[:, 0].min(), np_contours[:, 0].max()
+        t, b = np_contours[:, 1].min(), np_contours[:, 1].max()
+        box = np.array([[l, t], [r, t], [r, b], [l, b]], dtype=np.float32)
+
+    # make clock-wise order
+    startidx = box.sum(axis=1).argmin()
+    box = np.roll(box, 4 - startidx, 0)
+    box = np.array(box)
+
+    return box
+
+
+def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text, workers=1):
     img_h, img_w = textmap.shape
 
     """ labeling method """
@@ -35,59 +76,42 @@ def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text)
     text_score_comb = np.clip(text_score + link_score, 0, 1)
     nLabels, labels, stats, centroids = cv2.connectedComponentsWithStats(text_score_comb.astype(np.uint8),
                                                                          connectivity=4)
-
-    det = []
-    det_scores = []
-    mapper = []
-    for k in range(1, nLabels):
-        # size filtering
-        size = stats[k, cv2.CC_STAT_AREA]
-        if size < 10: continue
-
-        # thresholding
-        if np.max(textmap[labels == k]) < text_threshold: continue
-
-        # make segmentation map
-        segmap = np.zeros(textmap.shape, dtype=np.uint8)
-        segmap[labels == k] = 255
-        segmap[np.logical_and(link_score == 1, text_score == 0)] = 0  # remove link area
-        x, y = stats[k, cv2.CC_STAT_LEFT], stats[k, cv2.CC_STAT_TOP]
-        w, h = stats[k, cv2.CC_STAT_WIDTH], stats[k, cv2.CC_STAT_HEIGHT]
-        niter = int(math.sqrt(size * min(w, h) / (w * h)) * 2)
-        sx, ex, sy, ey = x - niter, x + w + niter + 1, y - niter, y + h + niter + 1
-        # boundary check
-        if sx < 0: sx = 0
-        if sy < 0: sy = 0
-        if ex >= img_w: ex = img_w
-        if ey >= img_h: ey = img_h
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1 + niter, 1 + niter))
-        segmap[sy:ey, sx:ex] = cv2.dilate(segmap[sy:ey, sx:ex], kernel)
-
-        # make box
-        np_contours = np.roll(np.array(np.where(segmap != 0)), 1, axis=0).transpose().reshape(-1, 2)
-        rectangle = cv2.minAreaRect(np_contours)
-        box = cv2.boxPoints(rectangle)
-
-        # align diamond-shape
-        w, h = np.linalg.norm(box[0] - box[1]), np.linalg.norm(box[1] - box[2])
-        box_ratio = max(w, h) / (min(w, h) + 1e-5)
-        if abs(1 - box_ratio) <= 0.1:
-            l, r = min(np_contours[:, 0]), max(np_contours[:, 0])
-            t, b = min(np_contours[:, 1]), max(np_contours[:, 1])
-            box = np.array([[l, t], [r, t], [r, b], [l, b]], dtype=np.float32)
-
-        # make clock-wise order
-        startidx = box.sum(axis=1).argmin()
-        box = np.roll(box, 4 - startidx, 0)
-        box = np.array(box)
-
-        det.append(box)
-        mapper.append(k)
-        det_scores.append(np.max(textmap[labels == k]))
+    # max text score of every label, in one pass over the labeled pixels
+    foreground = labels > 0
+    max_scores = np.zeros(nLabels, dtype=textmap.dtype)
+    if nLabels > 1:
+        max_scores[1:] = ndimage.maximum(textmap[foreground], labels[foreground], index=np.arange(1, nLabels))
+    link_area = np.logical_and(link_score == 1, text_score == 0)
+
+    # size filtering and thresholding
+    mapper = [k for k in range(1, nLabels)
+              if stats[k, cv2.CC_STAT_AREA] >= 10 and max_scores[k] >= text_threshold]
+
+    if workers > 1 and len(mapper) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            det = list(pool.map(lambda k: _component_box(k, stats, labels, link_area, img_h, img_w), mapper))
+    else:
+        det = [_component_box(k, stats, labels, link_area, img_h, img_w) for k in mapper]
+    det_scores = [max_scores[k] for k in mapper]
 
     return det, labels, mapper, det_scores
 
 
+def _line_hits(mask, line_img, p):
+    # draw the line on the (all zero) buffer, test it against mask inside the line's bounding window,
+    # then clear the window so the buffer can be reused
+    x1, y1, x2, y2 = int(p[0]), int(p[1]), int(p[2]), int(p[3])
+    cv2.line(line_img, (x1, y1), (x2, y2), 1, thickness=1)
+    h, w = mask.shape
+    sx, ex = max(min(x1, x2) - 1, 0), min(max(x1, x2) + 2, w)
+    sy, ey = max(min(y1, y2) - 1, 0), min(max(y1, y2) + 2, h)
+    if sx >= ex or sy >= ey:
+        return False
+    hits = np.any(np.logical_and(mask[sy:ey, sx:ex], line_img[sy:ey, sx:ex]))
+    line_img[sy:ey, sx:ex] = 0
+    return hits
+
+
 def getPoly_core(boxes, labels, mapper, linkmap):
     # configs
     num_cp = 5
@@ -115,20 +139,15 @@ def getPoly_core(boxes, labels, mapper, linkmap):
             continue
 
         # binarization for selected label
-        cur_label = mapper[k]
-        word_label[word_label != cur_label] = 0
-        word_label[word_label > 0] = 1
+        word_label = word_label == mapper[k]
 
         """ Polygon generation """
-        # find top/bottom contours
-        cp = []
-        max_len = -1
-        for i in range(w):
-            region = np.where(word_label[:, i] != 0)[0]
-            if len(region) < 2: continue
-            cp.append((i, region[0], region[-1]))
-            length = region[-1] - region[0] + 1
-            if length > max_len: max_len = length
+        # find top/bottom contours of every column with at least 2 label pixels
+        columns = np.flatnonzero(np.count_nonzero(word_label, axis=0) >= 2)
+        top = word_label.argmax(axis=0)[columns]
+        bottom = h - 1 - word_label[::-1].argmax(axis=0)[columns]
+        cp = list(zip(columns.tolist(), top.tolist(), bottom.tolist()))
+        max_len = int((bottom - top).max()) + 1 if len(columns) > 0 else -1
 
         # pass if max_len is similar to h
         if h * max_len_ratio < max_len:
@@ -197,22 +216,19 @@ def getPoly_core(boxes, labels, mapper, linkmap):
         isSppFound, isEppFound = False, False
         grad_s = (pp[1][1] - pp[0][1]) / (pp[1][0] - pp[0][0]) + (pp[2][1] - pp[1][1]) / (pp[2][0] - pp[1][0])
         grad_e = (pp[-2][1] - pp[-1][1]) / (pp[-2][0] - pp[-1][0]) + (pp[-3][1] - pp[-2][1]) / (pp[-3][0] - pp[-2][0])
+        line_img = np.zeros(word_label.shape, dtype=np.uint8)
         for r in np.arange(0.5, max_r, step_r):
             dx = 2 * half_char_h * r
             if not isSppFound:
-                line_img = np.zeros(word_label.shape, dtype=np.uint8)
                 dy = grad_s * dx
                 p = np.array(new_pp[0]) - np.array([dx, dy, dx, dy])
-                cv2.line(line_img, (int(p[0]), int(p[1])), (int(p[2]), int(p[3])), 1, thickness=1)
-                if np.sum(np.logical_and(word_label, line_img)) == 0 or r + 2 * step_r >= max_r:
+                if not _line_hits(word_label, line_img, p) or r + 2 * step_r >= max_r:
                     spp = p
                     isSppFound = True
             if not isEppFound:
-                line_img = np.zeros(word_label.shape, dtype=np.uint8)
                 dy = grad_e * dx
                 p = np.array(new_pp[-1]) + np.array([dx, dy, dx, dy])
-                cv2.line(line_img, (int(p[0]), int(p[1])), (int(p[2]), int(p[3])), 1, thickness=1)
-                if np.sum(np.logical_and(word_label, line_img)) == 0 or r + 2 * step_r >= max_r:
+                if not _line_hits(word_label, line_img, p) or r + 2 * step_r >= max_r:
                     epp = p
                     isEppFound = True
             if isSppFound and isEppFound:
@@ -240,8 +256,9 @@ def getPoly_core(boxes, labels, mapper, linkmap):
     return polys
 
 
-def getDetBoxes(textmap, linkmap, text_threshold, link_threshold, low_text, poly=False):
-    boxes, labels, mapper, det_scores = getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text)
+def getDetBoxes(textmap, linkmap, text_threshold, link_threshold, low_text, poly=False, workers=1):
+    boxes, labels, mapper, det_scores = getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text,
+                                                         workers)
 
     if poly:
         polys = getPoly_core(boxes, labels, mapper, linkmap)
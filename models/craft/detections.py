@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import struct
+import numpy as np
+
+
+class Detections:
+    """
+    Text regions detected by CRAFT.
+    boxes: N x 4 x 2 float32 array, the 4 corners (x, y) of every text region in clockwise order from top-left.
+    scores: N float32 array, the detection score of every text region.
+    canvas_size: canvas the regions were detected at, in the adaptive canvas mode (None otherwise).
+    It is not serialized.
+    """
+
+    _header = struct.Struct('<4sI')
+    _magic = b'CRDT'
+
+    def __init__(self, boxes=None, scores=None):
+        if boxes is None:
+            boxes = []
+        if scores is None:
+            scores = []
+        self.boxes = np.array(boxes, dtype=np.float32).reshape(-1, 4, 2)
+        self.scores = np.array(scores, dtype=np.float32).reshape(-1)
+        self.canvas_size = None
+        if len(self.boxes) != len(self.scores):
+            raise ValueError('Got {} boxes but {} scores'.format(len(self.boxes), len(self.scores)))
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __iter__(self):
+        return zip(self.boxes, self.scores)
+
+    def __repr__(self):
+        return 'Detections({} boxes)'.format(len(self))
+
+    def to_bytes(self):
+        """
+        :return: Binary serialization: header (magic, number of boxes), boxes and scores as little-endian float32.
+        """
+        return (self._header.pack(self._magic, len(self))
+                + self.boxes.astype('<f4').tobytes()
+                + self.scores.astype('<f4').tobytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :param data: bytes from to_bytes().
+        :return: Detections.
+        """
+        magic, num_boxes = cls._header.unpack_from(data)
+        if magic != cls._magic:
+            raise ValueError('Not a serialized Detections')
+        offset = cls._header.size
+        boxes = np.frombuffer(data, dtype='<f4', count=num_boxes * 8, offset=offset)
+        scores = np.frombuffer(data, dtype='<f4', count=num_boxes, offset=offset + boxes.nbytes)
+        return cls(boxes, scores)
+
+    def save(self, path):
+        """
+        :param path: path to the output file.
+        """
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: path to a file written by save().
+        :return: Detections.
+        """
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
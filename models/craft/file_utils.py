@@ -32,6 +32,27 @@ def list_files(in_path):
     return img_files, mask_files, gt_files
 
 
+def saveBoxes(img_file, boxes, dirname):
+    """ save the text detection polygons only, without drawing them on the image
+        Args:
+            img_file (str): image file name
+            boxes (array): array of result file
+                Shape: [num_detections, 4] for BB output / [num_detections, 4] for QUAD output
+        Return:
+            None
+        """
+    filename, file_ext = os.path.splitext(os.path.basename(img_file))
+    res_file = os.path.join(dirname, "res_" + filename + '.txt')
+
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    with open(res_file, 'w') as f:
+        for box in boxes:
+            poly = np.array(box).astype(np.int32).reshape((-1))
+            f.write(','.join([str(p) for p in poly]) + '\r\n')
+
+
 def saveResult(img_file, img, boxes, dirname, verticals=None, texts=None):
     """ save text detection result one by one
         Args:
@@ -6,6 +6,7 @@ MIT License
 """
 
 # -*- coding: utf-8 -*-
+import math
 import time
 import torch
 from torch.autograd import Variable
@@ -13,7 +14,7 @@ import cv2
 import numpy as np
 from models.craft import craft_utils
 from models.craft import imgproc
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 
 
 def copyStateDict(state_dict):
@@ -28,8 +29,22 @@ def copyStateDict(state_dict):
     return new_state_dict
 
 
+def postprocess(score_text, score_link, ratio_w, ratio_h, text_threshold, link_threshold, low_text, poly):
+    # Post-processing
+    boxes, polys, det_scores = craft_utils.getDetBoxes(score_text, score_link, text_threshold, link_threshold, low_text,
+                                                       poly)
+
+    # coordinate adjustment
+    boxes = craft_utils.adjustResultCoordinates(boxes, ratio_w, ratio_h)
+    polys = craft_utils.adjustResultCoordinates(polys, ratio_w, ratio_h)
+    for k in range(len(polys)):
+        if polys[k] is None: polys[k] = boxes[k]
+
+    return boxes, polys, det_scores
+
+
 def test_net(net, image, text_threshold, link_threshold, low_text, cuda, poly, canvas_size, mag_ratio, show_time,
-             refine_net=None):
+             refine_net=None, render=True):
     t0 = time.time()
 
     # resize
@@ -46,7 +61,7 @@ def test_net(net, image, text_threshold, link_threshold, low_text, cuda, poly, c
         x = x.cuda()
 
     # forward pass
-    with torch.no_grad():
+    with torch.inference_mode():
         y, feature = net(x)
 
     # make score and link map
@@ -55,31 +70,105 @@ def test_net(net, image, text_threshold, link_threshold, low_text, cuda, poly, c
 
     # refine link
     if refine_net is not None:
-        with torch.no_grad():
+        with torch.inference_mode():
             y_refiner = refine_net(y, feature)
         score_link = y_refiner[0, :, :, 0].cpu().data.numpy()
 
     t0 = time.time() - t0
     t1 = time.time()
 
-    # Post-processing
-    boxes, polys, det_scores = craft_utils.getDetBoxes(score_text, score_link, text_threshold, link_threshold, low_text,
-                                                       poly)
-
-    # coordinate adjustment
-    boxes = craft_utils.adjustResultCoordinates(boxes, ratio_w, ratio_h)
-    polys = craft_utils.adjustResultCoordinates(polys, ratio_w, ratio_h)
-    for k in range(len(polys)):
-        if polys[k] is None: polys[k] = boxes[k]
+    boxes, polys, det_scores = postprocess(score_text, score_link, ratio_w, ratio_h, text_threshold, link_threshold,
+                                           low_text, poly)
 
     t1 = time.time() - t1
 
     # render results (optional)
-    render_img = score_text.copy()
-    render_img = np.hstack((render_img, score_link))
-    ret_score_text = imgproc.cvt2HeatmapImg(render_img)
+    ret_score_text = None
+    if render:
+        render_img = score_text.copy()
+        render_img = np.hstack((render_img, score_link))
+        ret_score_text = imgproc.cvt2HeatmapImg(render_img)
 
     if show_time:
         print("\ninfer/postproc time : {:.3f}/{:.3f}".format(t0, t1))
 
     return boxes, polys, ret_score_text, det_scores
+
+
+def test_net_batch(net, images, text_threshold, link_threshold, low_text, cuda, poly, canvas_size, mag_ratio,
+                   show_time, refine_net=None, canvas_step=32, batch_size=4, render=True):
+    """
+    test_net for many images: resized images are grouped by canvas shape (their size rounded up to canvas_step),
+    padded to the canvas of their group, and every group runs through CRAFT (and the refiner) in batches.
+    With the default canvas_step, the canvas of an image is the one test_net uses, so the results are the same.
+    The score/link heatmaps are only rendered if render is True, ret_score_text is None otherwise.
+    :return: list of (boxes, polys, ret_score_text, det_scores) per image, in the same order as images.
+    """
+    t0 = time.time()
+
+    # resize
+    resized = [imgproc.resize_aspect_ratio(image, canvas_size, interpolation=cv2.INTER_LINEAR, mag_ratio=mag_ratio)
+               for image in images]
+
+    # group images by canvas shape
+    groups = defaultdict(list)
+    for index, (img_resized, target_ratio, size_heatmap) in enumerate(resized):
+        canvas_h = int(math.ceil(img_resized.shape[0] / canvas_step) * canvas_step)
+        canvas_w = int(math.ceil(img_resized.shape[1] / canvas_step) * canvas_step)
+        groups[(canvas_h, canvas_w)].append(index)
+
+    score_maps = [None] * len(images)
+    for (canvas_h, canvas_w), indices in groups.items():
+        for start in range(0, len(indices), batch_size):
+            batch_indices = indices[start:start + batch_size]
+
+            # preprocessing, padding every image to the canvas of its group
+            x = np.zeros((len(batch_indices), canvas_h, canvas_w, 3), dtype=np.float32)
+            for b, index in enumerate(batch_indices):
+                img_resized = resized[index][0]
+                x[b, :img_resized.shape[0], :img_resized.shape[1], :] = img_resized
+            x = imgproc.normalizeMeanVariance(x)
+            x = torch.from_numpy(x).permute(0, 3, 1, 2)  # [b, h, w, c] to [b, c, h, w]
+            if cuda:
+                x = x.cuda()
+
+            # forward pass
+            with torch.inference_mode():
+                y, feature = net(x)
+                y_link = y[:, :, :, 1]
+                if refine_net is not None:
+                    y_link = refine_net(y, feature)[:, :, :, 0]
+            y_text = y[:, :, :, 0].cpu().data.numpy()
+            y_link = y_link.cpu().data.numpy()
+
+            # split the score and link maps back per image
+            for b, index in enumerate(batch_indices):
+                img_resized = resized[index][0]
+                map_h, map_w = img_resized.shape[0] // 2, img_resized.shape[1] // 2
+                score_maps[index] = (np.ascontiguousarray(y_text[b, :map_h, :map_w]),
+                                     np.ascontiguousarray(y_link[b, :map_h, :map_w]))
+
+    t0 = time.time() - t0
+    t1 = time.time()
+
+    results = []
+    for (img_resized, target_ratio, size_heatmap), (score_text, score_link) in zip(resized, score_maps):
+        ratio_h = ratio_w = 1 / target_ratio
+        boxes, polys, det_scores = postprocess(score_text, score_link, ratio_w, ratio_h, text_threshold,
+                                               link_threshold, low_text, poly)
+
+        # render results (optional)
+        ret_score_text = None
+        if render:
+            render_img = np.hstack((score_text, score_link))
+            ret_score_text = imgproc.cvt2HeatmapImg(render_img)
+
+        results.append((boxes, polys, ret_score_text, det_scores))
+
+    t1 = time.time() - t1
+
+    if show_time:
+        print("\ninfer/postproc time of {} images in {} canvas shapes : {:.3f}/{:.3f}".format(len(images), len(groups),
+                                                                                             t0, t1))
+
+    return results
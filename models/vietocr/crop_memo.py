@@ -0,0 +1,147 @@
+import threading
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+
+def difference_hash(img, hash_height=16, column_width=4, margin=0.15):
+    """
+    Perceptual (difference) hash of a normalized text region.
+    The region is contrast-stretched, cut to the bounding box of its ink and shrunk to hash_height rows,
+    then every bit tells whether a cell is brighter than its right neighbour by more than margin.
+    The margin keeps the flat background at 0, so background noise does not flip bits.
+    :param img: normalized text region, C x H x W float array in [0, 1] (the VietOCR model input).
+    :param hash_height: number of rows of the hash grid.
+    :param column_width: width (in pixels of the normalized region) of a column of the hash grid.
+    :param margin: minimum brightness difference (after contrast stretching) for a bit to be set.
+    :return: the hash as a Python int, and its number of bits.
+    """
+    gray = np.asarray(img, dtype=np.float32).mean(axis=0)
+    # percentiles rather than min/max, so a few noisy pixels do not decide the contrast
+    low, high = np.percentile(gray, (1, 99))
+    gray = np.clip((gray - low) / max(high - low, 1e-6), 0, 1)
+    columns = max(1, gray.shape[1] // column_width)
+
+    # hash the bounding box of the ink only, so the margins left around the text do not shift the grid
+    ink = gray < 0.5
+    ink_rows = np.flatnonzero(np.count_nonzero(ink, axis=1) >= 2)
+    ink_columns = np.flatnonzero(np.count_nonzero(ink, axis=0) >= 2)
+    if len(ink_rows) and len(ink_columns):
+        gray = gray[ink_rows[0]:ink_rows[-1] + 1, ink_columns[0]:ink_columns[-1] + 1]
+
+    small = cv2.resize(gray, (columns + 1, hash_height), interpolation=cv2.INTER_AREA)
+    bits = (small[:, :-1] - small[:, 1:]) > margin
+
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big'), bits.size
+
+
+class CropMemo:
+    """
+    Recognition memo placed in front of the VietOCR predictor, for the printed labels every card carries
+    ("CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM", "Họ và tên", "Ngày sinh"...).
+    Entries are keyed by the perceptual hash of the normalized region and grouped by the normalized width.
+    A region matches an entry of the same width whose hash differs by at most max_distance of the bits.
+    A perceptual hash cannot tell a one-character difference from the jitter of two photos of the same label,
+    so an entry only answers once it has been confirmed: min_count regions matched it and VietOCR read the same
+    text for all of them. Text holding digits (numbers, dates) is never memorized.
+    The memo holds at most capacity entries, the least recently used are dropped first.
+    """
+
+    def __init__(self, capacity=512, max_distance=0.08, min_count=3, hash_height=16, column_width=4):
+        """
+        :param capacity: maximum number of entries.
+        :param max_distance: maximum fraction of differing hash bits for two regions to match.
+        :param min_count: number of identical readings before an entry answers lookups.
+        :param hash_height: number of rows of the hash grid (see difference_hash()).
+        :param column_width: width of a column of the hash grid (see difference_hash()).
+        """
+        self.capacity = capacity
+        self.max_distance = max_distance
+        self.min_count = min_count
+        self.hash_height = hash_height
+        self.column_width = column_width
+        self.hits = 0
+        self.misses = 0
+        # (width, hash) -> [text, count], in least recently used order
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the lock cannot be pickled (spawned worker processes), every copy gets its own
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def hash(self, img):
+        """
+        :param img: normalized text region, C x H x W array (the VietOCR model input).
+        :return: memo key of the region.
+        """
+        value, num_bits = difference_hash(img, self.hash_height, self.column_width)
+        return img.shape[-1], value, num_bits
+
+    def _nearest(self, key):
+        width, value, num_bits = key
+        best, best_distance = None, int(self.max_distance * num_bits)
+        for entry_key in self._entries:
+            if entry_key[0] != width:
+                continue
+            distance = bin(entry_key[1] ^ value).count('1')
+            if distance <= best_distance:
+                best, best_distance = entry_key, distance
+        return best
+
+    def get(self, key):
+        """
+        :param key: memo key from hash().
+        :return: the memorized text, None if no confirmed entry matches.
+        """
+        with self._lock:
+            entry_key = self._nearest(key)
+            if entry_key is not None and self._entries[entry_key][1] >= self.min_count:
+                self._entries.move_to_end(entry_key)
+                self.hits += 1
+                return self._entries[entry_key][0]
+            self.misses += 1
+            return None
+
+    def add(self, key, text):
+        """
+        Record the text VietOCR read for a region.
+        :param key: memo key from hash().
+        :param text: predicted text of the region.
+        """
+        if any(char.isdigit() for char in text):
+            return
+        with self._lock:
+            entry_key = self._nearest(key)
+            if entry_key is not None and self._entries[entry_key][0] == text:
+                self._entries[entry_key][1] += 1
+                self._entries.move_to_end(entry_key)
+                return
+            if entry_key is not None:
+                # a near region read differently: the entry is not reliable
+                del self._entries[entry_key]
+            self._entries[key[:2]] = [text, 1]
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        :return: dict of the hit and miss counters and the number of entries.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+    def clear(self):
+        """
+        Drop every entry and reset the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
@@ -1,28 +1,141 @@
+import copy
+import json
+import math
+from collections import defaultdict
+import torch
+import torch.nn.functional as F
 from vietocr.tool.predictor import Predictor
 from vietocr.tool.config import Cfg
+from vietocr.tool.translate import process_input, translate
 from PIL import Image
 
+# Built VietOCR Predictors, keyed by their serialized config
+_predictors = {}
 
-def init_config():
+# Downloaded VietOCR configs, keyed by config name
+_base_configs = {}
+
+
+def init_config(name='vgg_seq2seq'):
     """
+    :param name: name of the VietOCR pre-defined config.
     :return: Customized config for the VietOCR Predictor.
     """
     # config = Cfg.load_config_from_name('vgg_transformer')
-    config = Cfg.load_config_from_name('vgg_seq2seq')
+    if name not in _base_configs:
+        _base_configs[name] = Cfg.load_config_from_name(name)
+    config = Cfg(copy.deepcopy(dict(_base_configs[name])))
     config['device'] = 'cpu'
     config['cnn']['pretrained'] = False
 
     return config
 
 
-def pred_text(img_path, config):
+def config_key(config):
+    """
+    :param config: Customized config for the VietOCR Predictor.
+    :return: A string identifying the config, used as the Predictor cache key.
+    """
+    return json.dumps(config, sort_keys=True, default=str)
+
+
+def get_predictor(config):
+    """
+    Return the cached VietOCR Predictor for config, building it (and loading its weights) on first use.
+    :param config: Customized config for the VietOCR Predictor.
+    :return: VietOCR Predictor.
+    """
+    key = config_key(config)
+    detector = _predictors.get(key)
+    if detector is None:
+        detector = Predictor(config)
+        _predictors[key] = detector
+
+    return detector
+
+
+def evict_predictor(config=None):
+    """
+    Drop a cached Predictor, so the next get_predictor() call rebuilds it.
+    :param config: config of the Predictor to drop. All cached Predictors are dropped if it is not given.
+    """
+    if config is None:
+        _predictors.clear()
+    else:
+        _predictors.pop(config_key(config), None)
+
+
+def pred_text(img_path, config, detector=None):
     """
     Read text from a cropped text region by VietOCR.
     :param config: Customized config for the VietOCR Predictor.
     :param img_path: path to a single text-region image.
+    :param detector: an already built VietOCR Predictor. The cached Predictor for config is used if it is not given.
     """
-    detector = Predictor(config)
+    if detector is None:
+        detector = get_predictor(config)
     img = Image.open(img_path)
     text = detector.predict(img)
 
     return text
+
+
+def pred_text_batch(imgs, config, detector=None, batch_size=16, bucket_width=10, memo=None):
+    """
+    Read text from many cropped text regions by VietOCR, one forward/decode pass per batch.
+    Regions are grouped by their normalized width (the width after resizing to the model's input height),
+    so a batch only holds regions of similar width and little padding is needed.
+    :param imgs: list of PIL images of text regions.
+    :param config: Customized config for the VietOCR Predictor.
+    :param detector: an already built VietOCR Predictor. The cached Predictor for config is used if it is not given.
+    :param batch_size: maximum number of regions per forward pass.
+    :param bucket_width: width (in pixels) of a bucket. The Predictor rounds widths to 10 pixels,
+    so the default groups regions of the exact same width and adds no padding.
+    :param memo: CropMemo of the regions already read. Regions it knows skip VietOCR, the others are added to it.
+    :return: list of predicted texts, in the same order as imgs.
+    """
+    if detector is None:
+        detector = get_predictor(config)
+
+    dataset = config['dataset']
+    inputs = [process_input(img, dataset['image_height'], dataset['image_min_width'], dataset['image_max_width'])
+              for img in imgs]
+
+    texts = [''] * len(inputs)
+    todo = list(range(len(inputs)))
+    if memo is not None:
+        keys = [memo.hash(img[0].numpy()) for img in inputs]
+        todo = []
+        for index, key in enumerate(keys):
+            text = memo.get(key)
+            if text is None:
+                todo.append(index)
+            else:
+                texts[index] = text
+
+    # Beam search decodes one image at a time
+    if config['predictor']['beamsearch']:
+        for index in todo:
+            texts[index] = detector.predict(imgs[index])
+    else:
+        buckets = defaultdict(list)
+        for index in todo:
+            buckets[math.ceil(inputs[index].shape[-1] / bucket_width)].append(index)
+
+        for bucket in sorted(buckets):
+            indices = buckets[bucket]
+            for start in range(0, len(indices), batch_size):
+                batch_indices = indices[start:start + batch_size]
+                width = max(inputs[index].shape[-1] for index in batch_indices)
+                # pad on the right with white, the background of the cropped regions
+                batch = torch.cat([F.pad(inputs[index], (0, width - inputs[index].shape[-1]), value=1.0)
+                                   for index in batch_indices], 0).to(detector.device)
+                sentences, _ = translate(batch, detector.model)
+                for index, text in zip(batch_indices, detector.vocab.batch_decode(sentences.tolist())):
+                    texts[index] = text
+
+    if memo is not None:
+        for index in todo:
+            memo.add(keys[index], texts[index])
+
+    return texts
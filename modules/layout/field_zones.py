@@ -0,0 +1,161 @@
+import re
+import numpy as np
+from modules.process_output.ocr_processing import reading_order
+
+# Layouts of the known card fronts, in coordinates normalized by the card width and height.
+# header: the national title line "CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM" (center x, center y, width),
+# used as anchor.
+# zones: field name -> (x0, y0, x1, y1), a text region belongs to the field holding its center.
+# title_patterns: substrings of the accents-removed, lower-case title telling the template.
+TEMPLATES = {
+    'cmnd': {
+        'header': (0.665, 0.07, 0.57),
+        'zones': {'header': (0.3, 0.0, 1.0, 0.13),
+                  'title': (0.3, 0.13, 1.0, 0.3),
+                  'id_number': (0.3, 0.3, 1.0, 0.42),
+                  'name': (0.3, 0.42, 1.0, 0.6),
+                  'date_of_birth': (0.3, 0.6, 1.0, 0.7)},
+        'title_patterns': ('chung minh', 'minh nhan dan'),
+    },
+    'cccd': {
+        'header': (0.625, 0.08, 0.65),
+        'zones': {'header': (0.2, 0.0, 1.0, 0.125),
+                  'title': (0.25, 0.19, 1.0, 0.31),
+                  'id_number': (0.25, 0.31, 1.0, 0.43),
+                  'name': (0.25, 0.43, 1.0, 0.585),
+                  'date_of_birth': (0.25, 0.585, 1.0, 0.665)},
+        'title_patterns': ('can cuoc', 'cong dan', 'citizen', 'identity card'),
+    },
+}
+
+# Fields read first: they tell the template and the validity of the card
+ANCHOR_FIELDS = ('header', 'title')
+
+# Labels printed before the values, in accents-removed lower case
+_LABELS = re.compile(r'^\W*(so|no\.?|ho va ten|ho ten|full name|ngay sinh|sinh ngay|date of birth)'
+                     r'(\W+(so|no\.?|ho va ten|ho ten|full name|ngay sinh|sinh ngay|date of birth))*\W*')
+_DATE = re.compile(r'(\d{1,2})\s*[/.\-]\s*(\d{1,2})\s*[/.\-]\s*(\d{4})')
+
+
+def normalize_boxes(bbox_arrays, image_shape):
+    """
+    :param bbox_arrays: N x 4 x 2 array of the text-region corners (x, y), in pixels.
+    :param image_shape: shape of the extracted-card image.
+    :return: N x 4 x 2 array of the corners, normalized by the card width and height.
+    """
+    boxes = np.asarray(bbox_arrays, dtype=np.float64).reshape(-1, 4, 2)
+    return boxes / np.array([image_shape[1], image_shape[0]], dtype=np.float64)
+
+
+def find_header(norm_boxes, max_y=0.2, min_width=0.3):
+    """
+    The header line is the widest text region near the top of the card.
+    :param norm_boxes: N x 4 x 2 array of normalized corners.
+    :param max_y: maximum normalized y of the header center.
+    :param min_width: minimum normalized width of the header.
+    :return: index of the header region, None if there is none.
+    """
+    if not len(norm_boxes):
+        return None
+    centers_y = norm_boxes[:, :, 1].mean(axis=1)
+    widths = norm_boxes[:, :, 0].max(axis=1) - norm_boxes[:, :, 0].min(axis=1)
+    candidates = np.flatnonzero((centers_y <= max_y) & (widths >= min_width))
+    if not len(candidates):
+        return None
+    return int(candidates[np.argmax(widths[candidates])])
+
+
+def align_to_template(norm_boxes, template, max_scale_change=0.3):
+    """
+    Map the text regions into the template frame, scaling and shifting the card so that its header line
+    lands on the header of the template. The card is kept as is if no header is found, or if the header
+    asks for a scale change larger than max_scale_change.
+    :param norm_boxes: N x 4 x 2 array of normalized corners.
+    :param template: one of TEMPLATES.
+    :param max_scale_change: maximum relative scale change.
+    :return: N x 2 array of the region centers in the template frame.
+    """
+    centers = norm_boxes.mean(axis=1)
+    header = find_header(norm_boxes)
+    if header is None:
+        return centers
+
+    template_x, template_y, template_width = template['header']
+    header_box = norm_boxes[header]
+    width = header_box[:, 0].max() - header_box[:, 0].min()
+    scale = template_width / width
+    if abs(scale - 1) > max_scale_change:
+        return centers
+
+    return (centers - centers[header]) * scale + np.array([template_x, template_y])
+
+
+def assign_fields(bbox_arrays, image_shape, template):
+    """
+    :param bbox_arrays: N x 4 x 2 array of the text-region corners (x, y), in pixels.
+    :param image_shape: shape of the extracted-card image.
+    :param template: one of TEMPLATES.
+    :return: dict field name -> array of the indices of its text regions (in reading order).
+    Regions outside every zone are left out.
+    """
+    boxes = np.asarray(bbox_arrays, dtype=np.float64).reshape(-1, 4, 2)
+    centers = align_to_template(normalize_boxes(boxes, image_shape), template)
+
+    fields = {}
+    free = np.ones(len(boxes), dtype=bool)
+    for field, (x0, y0, x1, y1) in template['zones'].items():
+        inside = free & (centers[:, 0] >= x0) & (centers[:, 0] < x1) & (centers[:, 1] >= y0) & (centers[:, 1] < y1)
+        indices = np.flatnonzero(inside)
+        free[indices] = False
+        if len(indices):
+            _, lines = reading_order(boxes[indices, 0].astype(np.int64))
+            indices = np.concatenate([indices[line] for line in lines])
+        fields[field] = indices
+
+    return fields
+
+
+def classify_template(title_noaccents):
+    """
+    :param title_noaccents: accents-removed, lower-case text of the header and title regions.
+    :return: name of the template (key of TEMPLATES), None if the title matches none.
+    """
+    for name, template in TEMPLATES.items():
+        if any(pattern in title_noaccents for pattern in template['title_patterns']):
+            return name
+    return None
+
+
+def strip_label(text, text_noaccents):
+    """
+    :param text: text of a field.
+    :param text_noaccents: the same text, accents removed and in lower case (same length as text).
+    :return: the text without the printed label(s) at its start ("Họ và tên / Full name:", "Số:"...).
+    """
+    match = _LABELS.match(text_noaccents)
+    if match is None or len(text_noaccents) != len(text):
+        return text.strip()
+    return text[match.end():].strip()
+
+
+def parse_id_number(text):
+    """
+    :param text: text of the id_number field.
+    :return: the digits of the longest run of digits (9 for CMND, 12 for CCCD), '' if there is none.
+    """
+    runs = re.findall(r'\d[\d ]*\d|\d', text)
+    if not runs:
+        return ''
+    return max((run.replace(' ', '') for run in runs), key=len)
+
+
+def parse_date(text):
+    """
+    :param text: text of the date_of_birth field.
+    :return: the date as dd/mm/yyyy, the text itself if it holds no date.
+    """
+    match = _DATE.search(text)
+    if match is None:
+        return text.strip()
+    day, month, year = match.groups()
+    return '{:02d}/{:02d}/{}'.format(int(day), int(month), year)
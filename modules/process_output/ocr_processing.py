@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 
@@ -28,86 +29,120 @@ def boxes(bbox):
     return bboxes
 
 
+def array_boxes(bbox_arrays):
+    """
+    :param bbox_arrays: list of 4 x 2 arrays of the text-region corners.
+    :return: list of coordinates pairs (x, y) of all angles of the text region.
+    """
+    return [[(int(x), int(y)) for x, y in bbox] for bbox in bbox_arrays]
+
+
 def add_to_data(data, bboxe):
     """
     :param data: (pandas Dataframe) raw ocr result dataframe.
     :param bboxe: list of coordinates pairs (x, y) of all angles of the text region.
     :return: A pandas Dataframe with angle's coordinates columns.
     """
-    pt1_x = []
-    pt1_y = []
-    pt2_x = []
-    pt2_y = []
-    pt3_x = []
-    pt3_y = []
-    pt4_x = []
-    pt4_y = []
-
-    for i in range(len(data)):
-        pt1_x.append(bboxe[i][0][0])
-        pt1_y.append(bboxe[i][0][1])
-        pt2_x.append(bboxe[i][1][0])
-        pt2_y.append(bboxe[i][1][1])
-        pt3_x.append(bboxe[i][2][0])
-        pt3_y.append(bboxe[i][2][1])
-        pt4_x.append(bboxe[i][3][0])
-        pt4_y.append(bboxe[i][3][1])
-
-    data.insert(1, 'pt1_x', pt1_x, True)
-    data.insert(2, 'pt1_y', pt1_y, True)
-    data.insert(3, 'pt2_x', pt2_x, True)
-    data.insert(4, 'pt2_y', pt2_y, True)
-    data.insert(5, 'pt3_x', pt3_x, True)
-    data.insert(6, 'pt3_y', pt3_y, True)
-    data.insert(7, 'pt4_y', pt4_x, True)
-    data.insert(8, 'pt4_y', pt4_y, True)
+    corners = np.asarray(bboxe, dtype=np.int64).reshape(-1, 4, 2)
+
+    data.insert(1, 'pt1_x', corners[:, 0, 0], True)
+    data.insert(2, 'pt1_y', corners[:, 0, 1], True)
+    data.insert(3, 'pt2_x', corners[:, 1, 0], True)
+    data.insert(4, 'pt2_y', corners[:, 1, 1], True)
+    data.insert(5, 'pt3_x', corners[:, 2, 0], True)
+    data.insert(6, 'pt3_y', corners[:, 2, 1], True)
+    data.insert(7, 'pt4_x', corners[:, 3, 0], True)
+    data.insert(8, 'pt4_y', corners[:, 3, 1], True)
     return data
 
 
+def reading_order(top_left, y_tolerance=4):
+    """
+    Group text regions into lines and order them for reading, in a single pass over the regions sorted top-down:
+    a region starts a new line when its top is more than y_tolerance below the top of the previous region.
+    Inside a line, regions are ordered left to right.
+    :param top_left: N x 2 integer array of the top-left corners (x, y) of the text regions.
+    :param y_tolerance: maximum vertical gap (in pixels) between two consecutive regions of the same line.
+    :return: region indices sorted top-down, list of lines (arrays of region indices, ordered left to right),
+    lines ordered top-down.
+    """
+    top_left = np.asarray(top_left, dtype=np.int64).reshape(-1, 2)
+    # quicksort, as DataFrame.sort_values, so regions of equal height keep the same order as before
+    by_y = np.argsort(top_left[:, 1], kind='quicksort')
+    y = top_left[by_y, 1]
+    starts = np.flatnonzero(np.diff(y) > y_tolerance) + 1
+
+    lines = []
+    for line in np.split(by_y, starts):
+        if len(line):
+            lines.append(line[np.argsort(top_left[line, 0], kind='quicksort')])
+
+    return by_y, lines
+
+
+def order_lines(bbox_arrays, texts, y_tolerance=4):
+    """
+    :param bbox_arrays: N x 4 x 2 array (or list of 4 x 2 arrays) of the text-region corners.
+    :param texts: predicted text of every text region.
+    :param y_tolerance: maximum vertical gap (in pixels) between two consecutive regions of the same line.
+    :return: list of the text lines, top-down, the texts of a line joined left to right.
+    """
+    corners = np.asarray(bbox_arrays, dtype=np.float64).reshape(-1, 4, 2)
+    _, lines = reading_order(corners[:, 0].astype(np.int64), y_tolerance)
+
+    return [' '.join(texts[index] for index in line) for line in lines]
+
+
+def top_lines(bbox_arrays, num_lines, y_tolerance=4):
+    """
+    :param bbox_arrays: N x 4 x 2 array (or list of 4 x 2 arrays) of the text-region corners.
+    :param num_lines: number of lines to keep.
+    :param y_tolerance: maximum vertical gap (in pixels) between two consecutive regions of the same line.
+    :return: list of the num_lines top-most lines (arrays of region indices, ordered left to right), top-down.
+    """
+    corners = np.asarray(bbox_arrays, dtype=np.float64).reshape(-1, 4, 2)
+    _, lines = reading_order(corners[:, 0].astype(np.int64), y_tolerance)
+
+    return lines[:num_lines]
+
+
 def sorting_detail(new_data):
     """
     :param new_data: A pandas Dataframe with angle's coordinates columns and VietOCR raw result.
     :return: A pandas Dataframe with top-down (according to coordinates) sorted VietOCR result.
     """
-    sorted_data = new_data.sort_values(by=['pt1_y'], ascending=True)
-    range_pt1_y = [0]
-
-    for i in range(len(sorted_data)):
-        try:
-            if (sorted_data.iloc[i + 1, 2] - 4) > sorted_data.iloc[i, 2]:
-                range_pt1_y.append(i + 1)
-        except IndexError:
-            range_pt1_y.append(i + 1)
-    text = []
-    img_name = []
-    for i in range(len(range_pt1_y)):
-        try:
-            text_1 = []
-            index1 = range_pt1_y[i]
-            index2 = range_pt1_y[i + 1]
-            print(f'Checkpoint1: {i}')
-            for j in range(len(sorted_data[index1:index2])):
-                sort_x = sorted_data[index1:index2].sort_values(by='pt1_x', ascending=True)
-                text_1.append(sort_x.iloc[j, 9])
-                print(f'Checkpoint2: {j}')
-                print(f'Checkpoint3: {sort_x.iloc[j, 9]}')
-
-            text.append(" ".join(text_1))
-            img_name.append(sorted_data.iloc[i, 0])
-        except IndexError:
-            print("Run success.")
-    sorted_data = pd.DataFrame(list(zip(img_name, text)),
-                               columns=['img_name', 'full_text'])
-
-    return sorted_data
-
-
-def sort_ocr_result(raw):
+    return _sorted_dataframe(new_data.iloc[:, 0].values, new_data[['pt1_x', 'pt1_y']].values,
+                             list(new_data['predicted_word']))
+
+
+def _sorted_dataframe(region_names, top_left, texts, y_tolerance=4):
+    """
+    :param region_names: text-region file names.
+    :param top_left: N x 2 integer array of the top-left corners (x, y) of the text regions.
+    :param texts: predicted text of every text region.
+    :param y_tolerance: maximum vertical gap (in pixels) between two consecutive regions of the same line.
+    :return: A pandas Dataframe (img_name, full_text) with one row per line.
+    """
+    by_y, lines = reading_order(top_left, y_tolerance)
+    full_text = [' '.join(texts[index] for index in line) for line in lines]
+    # img_name has always been the name of the i-th region top-down, not of a region of the i-th line
+    img_name = [region_names[index] for index in by_y[:len(lines)]]
+
+    return pd.DataFrame(list(zip(img_name, full_text)), columns=['img_name', 'full_text'])
+
+
+def sort_ocr_result(raw, bbox_arrays=None, y_tolerance=4):
     """
     :param raw: (pandas Dataframe) Raw result from VietOCR.
+    :param bbox_arrays: list of 4 x 2 arrays of the text-region corners, in the same order as raw.
+    The coordinates are read from the text-region file names if it is not given.
+    :param y_tolerance: maximum vertical gap (in pixels) between two consecutive regions of the same line.
     :return: top-down (according to coordinates) sorted result.
     """
-    new_data = add_to_data(raw, bboxe=boxes(split_img_name(raw['text_region_file'])))
-    sorted_result = sorting_detail(new_data)
+    if bbox_arrays is None:
+        bboxe = boxes(split_img_name(raw['text_region_file']))
+    else:
+        bboxe = array_boxes(bbox_arrays)
+    top_left = np.array([bbox[0] for bbox in bboxe], dtype=np.int64).reshape(-1, 2)
 
-    return sorted_result
+    return _sorted_dataframe(list(raw['text_region_file']), top_left, list(raw['predicted_word']), y_tolerance)
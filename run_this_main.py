@@ -1,11 +1,15 @@
 import argparse
+import logging
 import os
-import pandas as pd
-from exe.craft_text_regions_coordinates import get_text_regions_coordinates
-from exe.crop_text_regions import generate_words
-from exe.ocr_from_text_regions import vietocr_all
-from exe.ocr_from_text_regions import check_valid_predicted
+from exe.pipeline import Pipeline
+from exe.parallel import process_parallel
+from exe.server import serve
+from exe.results_writer import ResultsWriter
+from exe.telemetry import LOG_LEVELS, METRICS, configure_logging
 import time
+from collections import Counter
+
+logger = logging.getLogger('run_this_main')
 
 
 def remove_underscore(path_to_img):
@@ -16,71 +20,159 @@ def remove_underscore(path_to_img):
     """
     image_name = os.path.basename(path_to_img)
     image_name = image_name.replace('_', '-')
-    new_input_path = os.path.join(os.path.dirname(input_path), image_name)
-    os.rename(input_path, new_input_path)
+    new_input_path = os.path.join(os.path.dirname(path_to_img), image_name)
+    os.rename(path_to_img, new_input_path)
     return new_input_path
 
 
-parser = argparse.ArgumentParser("Vietnamese ID card extraction")
-parser.add_argument("--input", default=None, help="Path to a single raw input image")
-parser.add_argument("--folder", default=None, help="Path to a folder of raw images")
-
-args = parser.parse_args()
-
-input_path = args.input
-folder_path = args.folder
-start = time.time()
-
-try:
-    # Input is a single image
-    if not folder_path:
-        input_path = remove_underscore(input_path)
-
-        bbox_scores_coordinates = get_text_regions_coordinates(input_path)
-        text_regions_path, img_name_no_ext = generate_words(input_path, bbox_scores_coordinates)
-        raw_output_path, sorted_output_path, straighten = vietocr_all(text_regions_path, img_name_no_ext)
-        is_valid = check_valid_predicted(straighten)
-
-        print('Result at {}\nStraighten string: {}\nValid/Invalid? {}'.format(sorted_output_path, straighten, is_valid))
-
-    # Input is a path to a folder
-    else:
-        accepted_formats = [".jpg", ".jpeg", ".jp2", ".png", ".bmp", ".tiff", ".tif"]
-        im_files = [im_file for im_file in os.listdir(folder_path)
-                    if os.path.splitext(im_file)[1].lower() in accepted_formats]
-        files_path = []
-        strings = []
-        valid = []
-        for index, im_file in enumerate(im_files):
-            input_path = os.path.join(folder_path, im_file)
+def list_images(folder_path):
+    """
+    :param folder_path: Path to a folder of images.
+    :return: list of the names of the image files in the folder.
+    """
+    accepted_formats = [".jpg", ".jpeg", ".jp2", ".png", ".bmp", ".tiff", ".tif"]
+    return [im_file for im_file in os.listdir(folder_path) if os.path.splitext(im_file)[1].lower() in accepted_formats]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Vietnamese ID card extraction")
+    parser.add_argument("--input", default=None, help="Path to a single raw input image")
+    parser.add_argument("--folder", default=None, help="Path to a folder of raw images")
+    parser.add_argument("--save-crops", action="store_true", help="Also write the cropped text regions to image files")
+    parser.add_argument("--batch-size", type=int, default=4,
+                        help="Number of images per CRAFT forward pass in folder mode")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes in folder mode")
+    parser.add_argument("--serve", action="store_true", help="Run a local HTTP server instead of a single run")
+    parser.add_argument("--host", default="127.0.0.1", help="Address of the HTTP server")
+    parser.add_argument("--port", type=int, default=8000, help="Port of the HTTP server")
+    parser.add_argument("--batch-window-ms", type=float, default=10,
+                        help="Time the HTTP server waits to gather concurrent uploads into a batch")
+    parser.add_argument("--results-format", choices=["csv", "jsonl"], default="csv",
+                        help="Format of the folder-mode results file")
+    parser.add_argument("--flush-every", type=int, default=100,
+                        help="Number of images between two flushes of the results file to disk")
+    parser.add_argument("--cache", default=None,
+                        help="Path to a result cache folder, images already processed are not processed again")
+    parser.add_argument("--cache-size-mb", type=int, default=512, help="Maximum size of the result cache")
+    parser.add_argument("--artifacts", choices=["none", "minimal", "full"], default="full",
+                        help="CRAFT debug artifacts: none, minimal (polygons) or full (polygons, heatmap, overlay)")
+    parser.add_argument("--fuzzy-valid", action="store_true",
+                        help="Also accept OCR variants close to a card title in the validity check")
+    parser.add_argument("--fields", action="store_true",
+                        help="Only read the ID number, name, date of birth, header and title of the card")
+    parser.add_argument("--cascade-lines", type=int, default=0,
+                        help="Read the top lines first and reject images whose top lines hold no card title, "
+                             "0 reads every line")
+    parser.add_argument("--ocr-memo", type=int, default=0,
+                        help="Number of known printed labels memorized to skip VietOCR, 0 disables the memo")
+    parser.add_argument("--ocr-precision", choices=["float32", "int8"], default="float32",
+                        help="Precision of VietOCR: int8 quantizes its recurrent and linear layers")
+    parser.add_argument("--craft-precision", choices=["float32", "bf16", "int8"], default="float32",
+                        help="Precision of CRAFT and the refiner, the int8 models are saved after their calibration")
+    parser.add_argument("--calibration-folder", default=None,
+                        help="Folder of images calibrating the int8 CRAFT (the input images if it is not set)")
+    parser.add_argument("--detector-backend", choices=["torch", "torchscript", "onnxruntime"], default="torch",
+                        help="Run CRAFT and the refiner as eager PyTorch modules or as a single exported graph")
+    parser.add_argument("--no-optimize-craft", action="store_true",
+                        help="Keep CRAFT as loaded (no BatchNorm folding, no channels_last weights)")
+    parser.add_argument("--canvas-tiers", type=int, nargs="+", default=None,
+                        help="Adaptive canvas: detect at the smallest canvas size first, and at larger ones only "
+                             "when the text regions look poor (e.g. --canvas-tiers 640 960 1280)")
+    parser.add_argument("--parquet", action="store_true", help="Also convert the results file to Parquet at the end")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="INFO",
+                        help="DEBUG also logs every stage duration and every saved file, WARNING only the problems")
+    parser.add_argument("--metrics", default=None,
+                        help="Write the stage timings and counters at the end of the run, as JSON if the path ends "
+                             "with .json, in the Prometheus text format otherwise (e.g. result/metrics.prom)")
+
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    input_path = args.input
+    folder_path = args.folder
+    start = time.time()
+
+    try:
+        # The int8 CRAFT is calibrated on a few sample images the first time
+        calibration_images = None
+        if args.craft_precision == 'int8':
+            calibration_folder = args.calibration_folder or folder_path
+            if calibration_folder:
+                calibration_images = [os.path.join(calibration_folder, im_file)
+                                      for im_file in list_images(calibration_folder)[:8]]
+            elif input_path:
+                calibration_images = [input_path]
+
+        # Models are loaded once and reused for every image
+        # The server answers with JSON only, it writes no result files
+        pipeline = Pipeline(save_crops=args.save_crops, detection_batch_size=args.batch_size,
+                            result_path=None if args.serve else 'result', cache_path=args.cache,
+                            cache_size=args.cache_size_mb * 1024 * 1024, ocr_memo_size=args.ocr_memo,
+                            artifact_level=args.artifacts, fuzzy_valid=args.fuzzy_valid, fields=args.fields,
+                            cascade_lines=args.cascade_lines, ocr_precision=args.ocr_precision,
+                            craft_precision=args.craft_precision, calibration_images=calibration_images,
+                            detector_backend=args.detector_backend, optimize_craft=not args.no_optimize_craft,
+                            canvas_tiers=args.canvas_tiers)
+
+        # Serve uploaded images over HTTP
+        if args.serve:
+            serve(pipeline, args.host, args.port, args.batch_window_ms / 1000, args.batch_size)
+
+        # Input is a single image
+        elif not folder_path:
             input_path = remove_underscore(input_path)
 
-            bbox_scores_coordinates = get_text_regions_coordinates(input_path)
-            text_regions_path, img_name_no_ext = generate_words(input_path, bbox_scores_coordinates)
-            raw_output_path, sorted_output_path, straighten = vietocr_all(text_regions_path, img_name_no_ext)
-
-            files_path.append(input_path)
-            if not straighten:
-                straighten = ''
-
-            strings.append(straighten)
-            print('Straighten string: {}\n'.format(straighten))
-            is_valid = check_valid_predicted(straighten)
-            valid.append(is_valid)
-            print('{}/{}: Result at {}\nValid/Invalid? {}'.
-                  format(index + 1, len(im_files), sorted_output_path, is_valid))
-
-            result_df = pd.DataFrame(list(zip(files_path, strings, valid)),
-                                     columns=['files_path', 'strings', 'is_valid'])
-
-            result_path = 'result/check_valid'
-            if not os.path.isdir(result_path):
-                os.makedirs(result_path)
-
-            file_name = 'results_{}_over_{}.csv'.format(index + 1, len(im_files))
-            result_path = os.path.join(result_path, file_name)
-            result_df.to_csv(result_path)
-except Exception as e:
-    print(e)
-
-print('PROCESS COMPLETED in {} seconds'.format(time.time() - start))
+            result = pipeline.process(input_path)
+
+            # the result of a single image is the output of the run, not a log record
+            print('Result at {}\nStraighten string: {}\nValid/Invalid? {}'.format(result.output_path, result.straighten,
+                                                                                   result.is_valid))
+            if result.fields is not None:
+                print('Fields: {}'.format(result.fields))
+
+        # Input is a path to a folder
+        else:
+            im_files = list_images(folder_path)
+            input_paths = [remove_underscore(os.path.join(folder_path, im_file)) for im_file in im_files]
+
+            if args.workers > 1:
+                results = process_parallel(pipeline, input_paths, args.workers, args.batch_size)
+            else:
+                results = pipeline.extract(input_paths)
+
+            # One record is appended per image, the file always holds the results processed so far
+            result_path = os.path.join('result/check_valid', 'results.{}'.format(args.results_format))
+            # number of images decided at every cascade stage, and detected at every canvas size
+            stages = Counter()
+            canvases = Counter()
+            with ResultsWriter(result_path, args.flush_every, args.parquet) as writer:
+                for index, result in enumerate(results):
+                    writer.write(result)
+                    if result.stage is not None:
+                        stages['accepted' if result.is_valid else result.stage] += 1
+                    if result.canvas is not None:
+                        canvases[result.canvas] += 1
+                    logger.debug('Straighten string: %s', result.straighten)
+                    logger.info('%d/%d: Result at %s, Valid/Invalid? %s', index + 1, len(im_files),
+                                result.output_path, result.is_valid)
+            logger.info('All results at %s', result_path)
+            if args.cascade_lines:
+                logger.info('Cascade: %d rejected at detection, %d rejected at header, %d rejected after full OCR, '
+                            '%d accepted', stages['detection'], stages['header'], stages['full'], stages['accepted'])
+            if args.canvas_tiers:
+                logger.info('Canvas sizes: %s', ', '.join('{} images at {}'.format(count, canvas)
+                                                          for canvas, count in sorted(canvases.items())))
+            if pipeline.cache is not None:
+                logger.info('Result cache: %s', pipeline.cache.stats())
+            if pipeline.ocr_memo is not None:
+                logger.info('OCR memo: %s', pipeline.ocr_memo.stats())
+
+        # Wait for the debug artifacts still being written in the background
+        pipeline.close()
+    except Exception as e:
+        logger.error(e)
+
+    if args.metrics:
+        METRICS.write(args.metrics)
+        logger.info('Metrics at %s', args.metrics)
+    logger.info('PROCESS COMPLETED in %s seconds', time.time() - start)